@@ -1,12 +1,32 @@
 import os
+import sys
+import signal
 import sqlite3
 import threading
 import time
 import json
+import heapq
+import random
+import hashlib
+import re
+import codecs
+import atexit
+import uuid
+import queue
+import mmap
+import struct
+import shutil
+import gzip
+import zlib
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
-from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit
+from typing import Any, Dict, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from http.cookiejar import CookiePolicy
 from flask import (
     Flask,
     render_template_string,
@@ -40,21 +60,144 @@ SECRET_KEY = os.getenv("SECRET_KEY", ADMIN_PASSWORD)
 # ! MỚI: ĐƯỜNG DẪN FILE BACKUP TỪ SECRET FILES (RENDER)
 # Ví dụ trên Render bạn đặt Key là SECRET_BACKUP_FILE_PATH, Value là /etc/secrets/backup
 SECRET_BACKUP_FILE_PATH = os.getenv("SECRET_BACKUP_FILE_PATH")
+# SECRET_BACKUP_ATOMIC=1: restore lúc khởi động theo kiểu tất cả hoặc không (mặc định: bỏ qua dòng lỗi, nạp phần còn lại)
+SECRET_BACKUP_ATOMIC = os.getenv("SECRET_BACKUP_ATOMIC", "0").strip().lower() in ("1", "true", "yes", "on")
+# Lỗi / cảnh báo của lần restore lúc khởi động gần nhất (hiện trên dashboard và /health)
+STARTUP_RESTORE_KEY = "startup_restore_error"
 
 # DB path (Render dùng /data cho persistent)
 DATA_DIR = "/data"
 if not os.path.isdir(DATA_DIR):
     DATA_DIR = "."
 DB_PATH = os.path.join(DATA_DIR, "balance_watcher.db")
+# Lưu MỌI lần quét (thời điểm, số dư, độ trễ, trạng thái) ra file nhị phân theo API / ngày, ngoài SQLite
+SAMPLE_STORE_ENABLED = os.getenv("SAMPLE_STORE", "0").strip().lower() in ("1", "true", "yes", "on")
+SAMPLES_DIR = os.path.join(DATA_DIR, "samples")
+# Pool kết nối SQLite (WAL): số kết nối tối đa mỗi process, thời gian chờ khi DB bận
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "10000"))
+# NORMAL an toàn với WAL (không hỏng DB khi crash), nhanh hơn FULL vì ít fsync hơn
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL").strip().upper()
+if DB_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    DB_SYNCHRONOUS = "NORMAL"
 
 POLL_INTERVAL_DEFAULT = 30
 
+# WATCHER_MODE=embedded (mặc định): web process tự chạy watcher
+# WATCHER_MODE=off: web process KHÔNG bao giờ chạy watcher (dùng `python app.py watch` riêng)
+WATCHER_MODE = (os.getenv("WATCHER_MODE", "embedded") or "embedded").strip().lower()
+# Tuỳ chọn: ghim process watcher vào các CPU cố định, VD "1" hoặc "2,3"
+WATCHER_CPU_AFFINITY = os.getenv("WATCHER_CPU_AFFINITY", "")
+# Số request quét API chạy song song tối đa (ghi đè bằng setting "max_concurrency")
+MAX_CONCURRENCY_DEFAULT = 16
+MAX_CONCURRENCY_LIMIT = 128
+# Chu kỳ riêng từng API (cột apis.poll_interval, trống = dùng chu kỳ chung)
+POLL_INTERVAL_MIN_API = 2
+# Backoff: API lỗi liên tục nhân đôi chu kỳ tới tối đa x32 (trần 30 phút),
+# API không đổi số dư nhân đôi sau mỗi 5 lần quét tới tối đa x4
+FAIL_BACKOFF_MAX_EXP = 5
+FAIL_BACKOFF_MAX_SECONDS = 1800
+IDLE_BACKOFF_STEP = 5
+IDLE_BACKOFF_MAX_EXP = 2
+# Circuit breaker: ngắt sau N lỗi liên tiếp, nghỉ cooldown (nhân đôi nếu lần thử lại vẫn lỗi)
+BREAKER_API_THRESHOLD = 5
+BREAKER_HOST_THRESHOLD = 8
+BREAKER_COOLDOWN = 60
+BREAKER_COOLDOWN_MAX = 900
+# Lượt thử half_open không có kết quả sau ngần này giây (VD watcher lỗi giữa chừng) được coi là bỏ dở
+BREAKER_PROBE_TIMEOUT = 120
+# Loại lỗi được đếm vào cột apis.err_<loại>
+FAILURE_KINDS = ("timeout", "conn", "http", "json", "size", "extract")
+# Loại lỗi tính cho breaker theo host (lỗi mạng / server, không tính lỗi nội dung)
+HOST_FAILURE_KINDS = ("timeout", "conn", "http")
+# Bảng cấu hình được cache trong RAM (tên cache -> bảng) và các setting đổi liên tục không làm mất cache
+CACHED_TABLES = {"settings": "settings", "bots": "telegram_bots", "apis": "apis", "rules": "alert_rules"}
+VOLATILE_SETTINGS = ("last_run",)
+# Số dòng mỗi trang lịch sử (phân trang keyset theo id)
+HISTORY_PAGE_SIZE = 50
+HISTORY_PAGE_SIZE_MAX = 500
+# Bảng tổng hợp lịch sử: loại kỳ -> (tên bảng, độ dài tiền tố timestamp ISO UTC dùng làm khoá kỳ)
+ROLLUP_TABLES = {"hour": ("balance_rollup_hourly", 13), "day": ("balance_rollup_daily", 10)}
+# Dọn lịch sử thô cũ hơn setting "history_retention_days" (trống / 0 = giữ mãi): chạy mỗi giờ, xoá theo lô
+RETENTION_CHECK_INTERVAL = 3600
+RETENTION_DELETE_BATCH = 5000
+# Backup dạng NDJSON nén gzip (1 bản ghi / dòng): đọc DB theo lô, bộ nhớ không tăng theo số dòng lịch sử
+BACKUP_VERSION = 4
+BACKUP_CHUNK_ROWS = 2000
+# Restore ghi hàng loạt: số dòng lịch sử mỗi lô (mỗi lô 1 transaction khi không bật "tất cả hoặc không")
+RESTORE_CHUNK_ROWS = 5000
+# Ghi trễ (write-behind): gom thay đổi của watcher, ghi 1 transaction mỗi N giây (0 = cuối mỗi lượt quét)
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", "0"))
+# Giới hạn tốc độ theo host (token bucket) + jitter để các lần quét rải đều trong chu kỳ
+HOST_RATE_PER_SEC = float(os.getenv("HOST_RATE_PER_SEC", "2"))
+HOST_RATE_BURST = float(os.getenv("HOST_RATE_BURST", "4"))
+POLL_JITTER_RATIO = 0.1
+# Bầu leader giữa các worker gunicorn: lease trong DB, gia hạn định kỳ, hết hạn thì worker khác giành
+LEASE_TTL = 30
+LEASE_HEARTBEAT = 10
+WATCHER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+# Watcher tự thức dậy tối thiểu mỗi N giây để nạp API mới / cấu hình mới
+WATCHER_IDLE_RECHECK = 5
+
+# Giới hạn kích thước response mặc định (ghi đè theo từng API: apis.max_response_bytes)
+MAX_RESPONSE_BYTES_DEFAULT = int(os.getenv("MAX_RESPONSE_BYTES", str(8 * 1024 * 1024)))
+STREAM_CHUNK_SIZE = 64 * 1024
+# 1 mẫu = epoch (double) + số dư (double, NaN nếu không đọc được) + độ trễ ms (float) + mã trạng thái (byte)
+SAMPLE_RECORD = struct.Struct("<ddfB")
+SAMPLE_STATUSES = ("ok", "unchanged") + FAILURE_KINDS + ("internal",)
+SAMPLES_LIMIT_MAX = 100000
+
+# Pool kết nối HTTP keep-alive dùng chung (API số dư + Telegram)
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "64"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "16"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "15"))
+# Gửi Telegram nền: số thread gửi, số lần thử tối đa, backoff mũ (giây), thời gian chờ gửi nốt khi tắt
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "2"))
+NOTIFY_MAX_ATTEMPTS = 6
+NOTIFY_RETRY_BASE = 1
+NOTIFY_RETRY_MAX = 120
+NOTIFY_DRAIN_TIMEOUT = 5
+# Outbox: mỗi lần lấy tối đa N tin, giữ quyền gửi N giây (gia hạn trước mỗi lần gửi; quá hạn -> process
+# khác được lấy lại), kiểm tra tin mới mỗi N giây khi rảnh, giữ tin đã gửi / lỗi N ngày
+NOTIFY_CLAIM_BATCH = 50
+NOTIFY_CLAIM_TTL = 120
+NOTIFY_POLL_INTERVAL = 2
+NOTIFY_OUTBOX_KEEP_DAYS = 7
+# Gộp tin biến động cùng chat trong cửa sổ setting "notify_coalesce_seconds" thành 1 tin tổng hợp
+NOTIFY_COALESCE_MAX = 3600
+TELEGRAM_MAX_CHARS = 4096
+COALESCE_KINDS = ("change",)
+# Pool bot: outbox ghi bot_token = BOT_POOL_TOKEN nghĩa là "chọn 1 bot bất kỳ lúc gửi".
+# Giới hạn Telegram cho mỗi bot: ~30 tin/giây tổng, ~1 tin/giây mỗi chat
+BOT_POOL_TOKEN = "*"
+BOT_POOL_STRATEGY = (os.getenv("BOT_POOL_STRATEGY", "least_loaded") or "least_loaded").strip().lower()
+TELEGRAM_BOT_RATE = 30
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_CHAT_BURST = 1
+# Bot bị thu hồi token (401) / bị chặn ở 1 chat (403): tạm loại khỏi pool trong N giây
+BOT_DISABLE_SECONDS = 600
+# Email gửi nền qua 1 kết nối SMTP dùng lại: đóng sau N giây rảnh, thử lại tối đa N lần,
+# email đang gửi dở của leader đã chết được gửi lại sau N giây
+SMTP_IDLE_TIMEOUT = 60
+SMTP_TIMEOUT = 10
+EMAIL_MAX_ATTEMPTS = 3
+EMAIL_CLAIM_TTL = 120
+
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
 
+# Khoá ghi trong process (SQLite chỉ cho 1 writer); đọc không cần khoá nhờ WAL
 db_lock = threading.Lock()
 watcher_started = False
 watcher_running = False
+poll_executor: Optional[ThreadPoolExecutor] = None
+poll_executor_size = 0
+watcher_wakeup = threading.Event()
+watcher_is_leader = False
+# ETag / Last-Modified / digest body lần quét trước của từng API (api_id -> dict)
+fetch_validators: Dict[int, Dict[str, Optional[str]]] = {}
+fetch_validators_lock = threading.Lock()
 
 # =========================
 # Múi giờ Việt Nam
@@ -72,6 +215,13 @@ def fmt_time_label_vn(dt_utc: datetime) -> str:
         local = dt_utc
     return local.strftime("%H:%M %d/%m/%Y (VN)")
 
+def vn_period(ts: str, width: int) -> str:
+    """Khoá kỳ tổng hợp theo giờ VN ("YYYY-MM-DDTHH" / "YYYY-MM-DD") của 1 timestamp ISO UTC"""
+    dt = parse_iso_utc(ts)
+    if dt is None:
+        return ts[:width]
+    return dt.astimezone(VN_TZ).strftime("%Y-%m-%dT%H")[:width]
+
 def parse_iso_utc(s: str) -> Optional[datetime]:
     if not s:
         return None
@@ -107,6 +257,84 @@ def to_float(s: Optional[str], default: Optional[float] = None) -> Optional[floa
     except Exception:
         return default
 
+# =========================
+# HTTP CONNECTION POOL
+# =========================
+class _NoCookiePolicy(CookiePolicy):
+    # Mỗi lần quét độc lập như requests.get cũ: không giữ cookie giữa các API
+    netscape = True
+    rfc2965 = False
+    hide_cookie2 = False
+
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+    def domain_return_ok(self, domain, request):
+        return False
+
+    def path_return_ok(self, path, request):
+        return False
+
+class HttpPool:
+    """requests.Session sống lâu, mỗi host 1 pool keep-alive, timeout tách connect/read.
+
+    Số liệu stats() là của riêng process hiện tại (mỗi worker gunicorn 1 pool).
+    """
+
+    def __init__(self, pool_hosts: int, pool_maxsize: int, connect_timeout: float, read_timeout: float):
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_hosts = pool_hosts
+        self.pool_maxsize = pool_maxsize
+        self.session = requests.Session()
+        self.session.cookies.set_policy(_NoCookiePolicy())
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.adapter = adapter
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.post(url, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        hosts = []
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            idle = 0
+            if pool.pool is not None:
+                idle = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+            hosts.append({
+                "host": f"{pool.scheme}://{pool.host}:{pool.port}",
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+                "open_connections": idle,
+            })
+        opened = sum(h["connections_opened"] for h in hosts)
+        total = sum(h["requests"] for h in hosts)
+        return {
+            "hosts": hosts,
+            "open_connections": sum(h["open_connections"] for h in hosts),
+            "connections_opened": opened,
+            "requests": total,
+            "reuse_ratio": round(1 - opened / total, 4) if total else 0.0,
+            "pid": os.getpid(),
+            "pool_hosts": self.pool_hosts,
+            "pool_maxsize": self.pool_maxsize,
+            "timeout": {"connect": self.timeout[0], "read": self.timeout[1]},
+        }
+
+http_pool = HttpPool(HTTP_POOL_HOSTS, HTTP_POOL_MAXSIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
 # =========================
 # TEMPLATE: LOGIN
 # =========================
@@ -223,6 +451,11 @@ DASHBOARD_TEMPLATE = r"""
 </head>
 <body class="text-slate-100">
 <div class="min-h-screen px-4 py-6 md:px-8 md:py-8">
+    {% if startup_restore_error %}
+      <div class="max-w-6xl mx-auto mb-4 px-4 py-2 rounded-2xl text-xs border bg-red-900/60 text-red-200 border-red-500/40">
+        ⚠️ {{ startup_restore_error }} (lần khởi động gần nhất, xem log để biết chi tiết)
+      </div>
+    {% endif %}
     {% with messages = get_flashed_messages(with_categories=true) %}
       {% if messages %}
         <div class="max-w-6xl mx-auto mb-4 space-y-2">
@@ -274,11 +507,20 @@ DASHBOARD_TEMPLATE = r"""
                     <span class="text-slate-400">chưa đặt</span>
                 {% endif %}
             </div>
+            <div>Kết nối HTTP <span class="text-slate-500" title="Số liệu của riêng worker đang trả trang này">(worker {{ http_stats.pid }})</span>:
+                <span class="text-sky-300 font-semibold">{{ http_stats.open_connections }}</span> đang mở ·
+                tái sử dụng <span class="text-emerald-300 font-semibold">{{ "{:.0%}".format(http_stats.reuse_ratio) }}</span>
+                <a href="{{ url_for('stats') }}" class="text-slate-500 hover:text-sky-300">(chi tiết)</a>
+                {% if not watcher_is_leader %}
+                <span class="text-slate-600">· worker này không quét API, số liệu quét nằm ở worker leader</span>
+                {% endif %}
+            </div>
             <div>Trạng thái watcher:
                 {% if watcher_running %}
                     <span class="inline-flex items-center gap-1 px-2 py-0.5 rounded-full bg-emerald-900/60 text-emerald-300 text-[10px]">
                         <span class="w-1.5 h-1.5 rounded-full bg-emerald-400 animate-pulse"></span> Đang chạy
                     </span>
+                    <span class="text-slate-600" title="Worker đang giữ quyền quét">({{ watcher_leader }})</span>
                 {% else %}
                     <span class="inline-flex items-center px-2 py-0.5 rounded-full bg-slate-800 text-slate-300 text-[10px]">
                         Tạm dừng
@@ -317,7 +559,7 @@ DASHBOARD_TEMPLATE = r"""
                             <label class="block text-[10px] text-slate-400 mb-1">Bot mặc định (tuỳ chọn)</label>
                             <select name="default_bot_id"
                                 class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 focus:outline-none focus:ring-2 focus:ring-indigo-500 focus:border-indigo-400">
-                                <option value="">-- Gửi bằng TẤT CẢ bot --</option>
+                                <option value="">-- Tự chia tải giữa các bot --</option>
                                 {% for bot in bots %}
                                     <option value="{{ bot.id }}" {% if settings.default_bot_id and settings.default_bot_id == bot.id %}selected{% endif %}>
                                         {{ bot.bot_name }} (..{{ bot.bot_token[-6:] }})
@@ -334,13 +576,37 @@ DASHBOARD_TEMPLATE = r"""
                                 class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-indigo-500 focus:border-indigo-400">
                         </div>
                         
-                        <div class="md:col-span-2">
+                        <div>
+                            <label class="block text-[10px] text-slate-400 mb-1">Số API quét song song</label>
+                            <input type="number" min="1" max="128" step="1" name="max_concurrency"
+                                value="{{ settings.max_concurrency or '' }}"
+                                placeholder="VD: 16"
+                                class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-indigo-500 focus:border-indigo-400">
+                        </div>
+
+                        <div>
                             <label class="block text-[10px] text-slate-400 mb-1">Ngưỡng cảnh báo chung (VND)</label>
                             <input type="text" name="global_threshold"
                                 value="{{ settings.global_threshold or '' }}"
                                 placeholder="VD: 1,000,000 (bỏ trống nếu không cảnh báo)"
                                 class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-rose-500 focus:border-rose-400">
                         </div>
+
+                        <div>
+                            <label class="block text-[10px] text-slate-400 mb-1">Gộp tin biến động (giây)</label>
+                            <input type="number" min="0" max="3600" step="1" name="notify_coalesce_seconds"
+                                value="{{ settings.notify_coalesce_seconds or '' }}"
+                                placeholder="VD: 60 (bỏ trống = gửi ngay từng biến động)"
+                                class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-indigo-500 focus:border-indigo-400">
+                        </div>
+
+                        <div>
+                            <label class="block text-[10px] text-slate-400 mb-1">Giữ lịch sử chi tiết (ngày)</label>
+                            <input type="number" min="1" step="1" name="history_retention_days"
+                                value="{{ settings.history_retention_days or '' }}"
+                                placeholder="Bỏ trống = giữ mãi (tổng hợp giờ/ngày luôn giữ)"
+                                class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-indigo-500 focus:border-indigo-400">
+                        </div>
                     </div>
                     
                     <hr class="border-slate-700/60 my-4">
@@ -455,26 +721,58 @@ DASHBOARD_TEMPLATE = r"""
                     <h2 class="text-sm font-semibold text-fuchsia-300 uppercase tracking-[0.16em]">Backup / Restore</h2>
                 </div>
 
-                <p class="text-[10px] text-slate-400 mb-2">Tải xuống & phục hồi dữ liệu <span class="text-sky-300 font-semibold">JSON</span>.</p>
+                <p class="text-[10px] text-slate-400 mb-2">Tải xuống & phục hồi dữ liệu <span class="text-sky-300 font-semibold">NDJSON nén gzip</span> (vẫn nhận file .json cũ).</p>
 
                 <div class="grid grid-cols-1 md:grid-cols-2 gap-2 mb-4">
                     <a href="{{ url_for('download_backup') }}"
-                       class="w-full inline-flex items-center justify-center gap-2 px-4 py-2.5 rounded-2xl bg-slate-800 text-slate-100 text-[11px] border border-slate-600 hover:bg-slate-700 hover:border-fuchsia-500/60 hover:text-fuchsia-200 transition-all md:col-span-2">
-                        📦 Tải toàn bộ backup (.json)
+                       class="w-full inline-flex items-center justify-center gap-2 px-4 py-2.5 rounded-2xl bg-slate-800 text-slate-100 text-[11px] border border-slate-600 hover:bg-slate-700 hover:border-fuchsia-500/60 hover:text-fuchsia-200 transition-all">
+                        📦 Tải toàn bộ backup (.ndjson.gz)
+                    </a>
+                    {% if recent_backups %}
+                    <form method="get" action="{{ url_for('download_backup') }}" class="flex gap-2">
+                        <input type="hidden" name="mode" value="diff">
+                        <select name="since" title="Xuất phần thay đổi kể từ backup này"
+                                class="min-w-0 flex-1 px-2 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[10px] text-slate-100 focus:outline-none focus:ring-2 focus:ring-fuchsia-500">
+                            {% for b in recent_backups %}
+                            <option value="{{ b.backup_id }}" {% if b.backup_id == diff_parent_id %}selected{% endif %}>
+                                Từ {{ 'toàn bộ' if b.kind == 'full' else 'thay đổi' }} {{ b.created_vn }}
+                            </option>
+                            {% endfor %}
+                        </select>
+                        <button type="submit"
+                                class="inline-flex items-center justify-center gap-2 px-3 py-2.5 rounded-2xl bg-slate-800 text-slate-100 text-[11px] border border-slate-600 hover:bg-slate-700 hover:border-fuchsia-500/60 hover:text-fuchsia-200 transition-all">
+                            🧩 Tải phần thay đổi
+                        </button>
+                    </form>
+                    {% else %}
+                    <a href="{{ url_for('download_backup', mode='diff') }}"
+                       class="w-full inline-flex items-center justify-center gap-2 px-4 py-2.5 rounded-2xl bg-slate-800 text-slate-100 text-[11px] border border-slate-600 hover:bg-slate-700 hover:border-fuchsia-500/60 hover:text-fuchsia-200 transition-all">
+                        🧩 Tải phần thay đổi
                     </a>
+                    {% endif %}
+                    {% if last_backup %}
+                    <p class="text-[9px] text-slate-500 md:col-span-2">
+                        Backup gần nhất: <span class="text-sky-300">{{ last_backup.created_vn }}</span>
+                        ({{ 'toàn bộ' if last_backup.kind == 'full' else 'thay đổi' }}, lịch sử tới #{{ last_backup.watermark }})
+                    </p>
+                    {% endif %}
                 </div>
 
                 <form method="post" action="{{ url_for('restore_backup') }}" enctype="multipart/form-data" class="space-y-3">
-                    <label class="block text-[10px] text-slate-400 mb-1">Phục hồi từ file backup (.json)</label>
-                    <input type="file" name="backup_file" accept="application/json"
+                    <label class="block text-[10px] text-slate-400 mb-1">Phục hồi từ file backup (.ndjson.gz / .json)</label>
+                    <input type="file" name="backup_file" accept=".gz,.ndjson,.json,application/gzip,application/json"
                            class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-fuchsia-500 focus:border-fuchsia-400">
                     <label class="inline-flex items-center gap-2 text-[10px] text-slate-400">
                         <input type="checkbox" name="wipe" value="1" class="rounded border-slate-600 bg-slate-900">
                         Xoá hết dữ liệu cũ trước khi Restore
                     </label>
+                    <label class="inline-flex items-center gap-2 text-[10px] text-slate-400">
+                        <input type="checkbox" name="atomic" value="1" checked class="rounded border-slate-600 bg-slate-900">
+                        Tất cả hoặc không (lỗi 1 dòng thì huỷ cả lần Restore)
+                    </label>
                     <button type="submit"
                             class="w-full inline-flex items-center justify-center gap-2 px-4 py-2.5 rounded-2xl bg-gradient-to-r from-fuchsia-500 to-purple-600 text-white text-[11px] font-medium shadow-lg hover:-translate-y-0.5 hover:shadow-xl transition-all">
-                        ♻️ Restore từ JSON
+                        ♻️ Restore từ backup
                     </button>
                 </form>
             </div>
@@ -504,7 +802,31 @@ DASHBOARD_TEMPLATE = r"""
                             placeholder="Để trống = auto detect"
                             class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-sky-500 focus:border-sky-400">
                     </div>
+                    <div>
+                        <label class="block text-slate-400 mb-1">Chu kỳ riêng (giây)</label>
+                        <input type="number" min="2" step="1" name="poll_interval"
+                            placeholder="Để trống = dùng chu kỳ chung"
+                            class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-sky-500 focus:border-sky-400">
+                    </div>
+                    <div>
+                        <label class="block text-slate-400 mb-1">Giới hạn response (KB)</label>
+                        <input type="number" min="1" step="1" name="max_response_kb"
+                            placeholder="Để trống = {{ (max_response_default // 1024) }} KB"
+                            class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-sky-500 focus:border-sky-400">
+                    </div>
+                    <div>
+                        <label class="block text-slate-400 mb-1">Nhóm</label>
+                        <input type="text" name="api_group"
+                            placeholder="VD: shop, game (dùng cho quy tắc cảnh báo)"
+                            class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-sky-500 focus:border-sky-400">
+                    </div>
                     <div class="flex items-end">
+                        <label class="inline-flex items-center gap-2 text-slate-400 pb-2">
+                            <input type="checkbox" name="stream_json" value="1" class="rounded border-slate-600 bg-slate-900">
+                            Đọc streaming (dừng ngay khi thấy trường số dư)
+                        </label>
+                    </div>
+                    <div class="flex items-end md:col-span-2">
                         <button type="submit"
                             class="w-full inline-flex items-center justify-center gap-2 px-4 py-2.5 rounded-2xl bg-gradient-to-r from-sky-500 to-indigo-500 text-white text-[11px] font-medium shadow-lg hover:-translate-y-0.5 hover:shadow-xl transition-all">
                             ➕ Thêm API
@@ -518,6 +840,7 @@ DASHBOARD_TEMPLATE = r"""
                     <h2 class="text-sm font-semibold text-indigo-300 uppercase tracking-[0.16em]">Danh sách API</h2>
                     <span class="text-[9px] text-slate-500">
                         Lần chạy gần nhất: <span class="text-sky-300">{{ last_run_vn or 'chưa có' }}</span>
+                        · <a href="{{ url_for('history') }}" class="text-fuchsia-300 hover:text-fuchsia-200">Lịch sử biến động →</a>
                     </span>
                 </div>
                 <div class="overflow-x-auto scrollbar-thin">
@@ -528,8 +851,10 @@ DASHBOARD_TEMPLATE = r"""
                                 <th class="px-3 py-2 text-left text-slate-400 uppercase tracking-[0.14em]">Tên</th>
                                 <th class="px-3 py-2 text-left text-slate-400 uppercase tracking-[0.14em]">URL</th>
                                 <th class="px-3 py-2 text-left text-slate-400 uppercase tracking-[0.14em]">Trường</th>
+                                <th class="px-3 py-2 text-left text-slate-400 uppercase tracking-[0.14em]">Chu kỳ</th>
                                 <th class="px-3 py-2 text-left text-slate-400 uppercase tracking-[0.14em]">Số dư</th>
                                 <th class="px-3 py-2 text-left text-slate-400 uppercase tracking-[0.14em]">Update</th>
+                                <th class="px-3 py-2 text-left text-slate-400 uppercase tracking-[0.14em]">Kết nối</th>
                                 <th class="px-3 py-2 text-right text-slate-400 uppercase tracking-[0.14em]"></th>
                             </tr>
                         </thead>
@@ -537,9 +862,25 @@ DASHBOARD_TEMPLATE = r"""
                             {% for api in apis %}
                             <tr class="hover:bg-slate-800/80 transition-colors">
                                 <td class="px-3 py-2 text-slate-400">#{{ api.id }}</td>
-                                <td class="px-3 py-2 text-slate-100 font-medium">{{ api.name }}</td>
+                                <td class="px-3 py-2 text-slate-100 font-medium">
+                                    {{ api.name }}
+                                    {% if api.api_group %}
+                                        <span class="inline-flex ml-1 px-1.5 rounded-full bg-amber-900/40 text-amber-300 text-[9px]">{{ api.api_group }}</span>
+                                    {% endif %}
+                                </td>
                                 <td class="px-3 py-2 text-slate-500 max-w-[220px] truncate">{{ api.url }}</td>
-                                <td class="px-3 py-2 text-slate-400">{{ api.balance_field or 'auto' }}</td>
+                                <td class="px-3 py-2 text-slate-400">
+                                    {{ api.balance_field or 'auto' }}
+                                    {% if api.learned_path and api.learned_path != api.balance_field %}
+                                        <div class="text-[9px] text-sky-400/80" title="Đường dẫn số dư đã học">→ {{ api.learned_path }}</div>
+                                    {% endif %}
+                                    {% if api.stream_json %}
+                                        <span class="inline-flex mt-0.5 px-1.5 rounded-full bg-sky-900/40 text-sky-300 text-[9px]">stream</span>
+                                    {% endif %}
+                                </td>
+                                <td class="px-3 py-2 text-slate-400">
+                                    {% if api.poll_interval %}{{ api.poll_interval|int }}s{% else %}<span class="text-slate-500">chung</span>{% endif %}
+                                </td>
                                 <td class="px-3 py-2">
                                     {% if api.last_balance is not none %}
                                         <span class="inline-flex px-2 py-0.5 rounded-full bg-emerald-900/40 text-emerald-300">
@@ -554,6 +895,21 @@ DASHBOARD_TEMPLATE = r"""
                                 <td class="px-3 py-2 text-slate-500">
                                     {{ api.last_change_vn or '-' }}
                                 </td>
+                                <td class="px-3 py-2 whitespace-nowrap" title="{{ api.last_error or '' }}">
+                                    {% if api.breaker_state == 'open' %}
+                                        <span class="inline-flex px-2 py-0.5 rounded-full bg-rose-900/50 text-rose-300">Ngắt</span>
+                                    {% elif api.breaker_state == 'half_open' %}
+                                        <span class="inline-flex px-2 py-0.5 rounded-full bg-amber-900/50 text-amber-300">Thử lại</span>
+                                    {% else %}
+                                        <span class="inline-flex px-2 py-0.5 rounded-full bg-emerald-900/40 text-emerald-300">OK</span>
+                                    {% endif %}
+                                    {% if api.err_total %}
+                                        <div class="mt-0.5 text-[9px] text-slate-500">
+                                            timeout {{ api.err_timeout }} · kết nối {{ api.err_conn }} · HTTP {{ api.err_http }}<br>
+                                            JSON {{ api.err_json }} · quá lớn {{ api.err_size }} · không thấy số dư {{ api.err_extract }}
+                                        </div>
+                                    {% endif %}
+                                </td>
                                 <td class="px-3 py-2 text-right">
                                     <form method="post" action="{{ url_for('delete_api', api_id=api.id) }}"
                                           onsubmit="return confirm('Xoá API này khỏi danh sách theo dõi?');">
@@ -565,7 +921,7 @@ DASHBOARD_TEMPLATE = r"""
                             </tr>
                             {% else %}
                             <tr>
-                                <td colspan="7" class="px-3 py-4 text-center text-slate-500 text-[10px]">
+                                <td colspan="9" class="px-3 py-4 text-center text-slate-500 text-[10px]">
                                     Chưa có API nào.
                                 </td>
                             </tr>
@@ -574,6 +930,304 @@ DASHBOARD_TEMPLATE = r"""
                     </table>
                 </div>
             </div>
+
+            <div class="bg-slate-900/80 border border-slate-800 rounded-3xl p-5 shadow-2xl backdrop-blur-xl">
+                <div class="flex items-center justify-between mb-3">
+                    <h2 class="text-sm font-semibold text-amber-300 uppercase tracking-[0.16em]">Quy tắc cảnh báo</h2>
+                    <span class="text-[9px] text-slate-500">API không khớp quy tắc nào dùng Chat ID + ngưỡng chung</span>
+                </div>
+                <form method="post" action="{{ url_for('add_rule') }}" class="grid grid-cols-2 md:grid-cols-4 gap-3 text-[10px] mb-4">
+                    <div>
+                        <label class="block text-slate-400 mb-1">Tên quy tắc</label>
+                        <input type="text" name="name" required placeholder="VD: Shop - ban đêm"
+                            class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-amber-500 focus:border-amber-400">
+                    </div>
+                    <div>
+                        <label class="block text-slate-400 mb-1">Áp dụng cho</label>
+                        <select name="target"
+                            class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-amber-500 focus:border-amber-400">
+                            <option value="">Tất cả API</option>
+                            {% for api in apis %}
+                            <option value="api:{{ api.id }}">API #{{ api.id }} - {{ api.name }}</option>
+                            {% endfor %}
+                            {% for g in api_groups %}
+                            <option value="group:{{ g }}">Nhóm: {{ g }}</option>
+                            {% endfor %}
+                        </select>
+                    </div>
+                    <div>
+                        <label class="block text-slate-400 mb-1">Ngưỡng số dư thấp</label>
+                        <input type="text" name="threshold" placeholder="Trống = không báo"
+                            class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-amber-500 focus:border-amber-400">
+                    </div>
+                    <div>
+                        <label class="block text-slate-400 mb-1">Biến động tối thiểu</label>
+                        <input type="text" name="min_change" placeholder="Trống = mọi biến động"
+                            class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-amber-500 focus:border-amber-400">
+                    </div>
+                    <div>
+                        <label class="block text-slate-400 mb-1">Tốc độ tối đa (đ/phút)</label>
+                        <input type="text" name="max_rate" placeholder="Trống = không báo"
+                            class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-amber-500 focus:border-amber-400">
+                    </div>
+                    <div>
+                        <label class="block text-slate-400 mb-1">Giờ yên lặng (VN)</label>
+                        <div class="flex gap-1">
+                            <input type="text" name="quiet_start" placeholder="22:00"
+                                class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-amber-500 focus:border-amber-400">
+                            <input type="text" name="quiet_end" placeholder="07:00"
+                                class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-amber-500 focus:border-amber-400">
+                        </div>
+                    </div>
+                    <div>
+                        <label class="block text-slate-400 mb-1">Chat ID riêng</label>
+                        <input type="text" name="chat_id" placeholder="Trống = Chat ID mặc định"
+                            class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-amber-500 focus:border-amber-400">
+                    </div>
+                    <div>
+                        <label class="block text-slate-400 mb-1">Bot gửi</label>
+                        <select name="bot_id"
+                            class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 placeholder-slate-500 focus:outline-none focus:ring-2 focus:ring-amber-500 focus:border-amber-400">
+                            <option value="">Bot mặc định</option>
+                            {% for bot in bots %}
+                            <option value="{{ bot.id }}">{{ bot.bot_name }}</option>
+                            {% endfor %}
+                        </select>
+                    </div>
+                    <div class="col-span-2 md:col-span-4">
+                        <button type="submit"
+                            class="w-full inline-flex items-center justify-center gap-2 px-4 py-2.5 rounded-2xl bg-gradient-to-r from-amber-500 to-rose-500 text-white text-[11px] font-medium shadow-lg hover:-translate-y-0.5 hover:shadow-xl transition-all">
+                            ➕ Thêm quy tắc
+                        </button>
+                    </div>
+                </form>
+                <div class="overflow-x-auto scrollbar-thin">
+                    <table class="min-w-full text-[10px]">
+                        <thead class="bg-slate-950/80">
+                            <tr>
+                                <th class="px-3 py-2 text-left text-slate-400 uppercase tracking-[0.14em]">Tên</th>
+                                <th class="px-3 py-2 text-left text-slate-400 uppercase tracking-[0.14em]">Áp dụng</th>
+                                <th class="px-3 py-2 text-left text-slate-400 uppercase tracking-[0.14em]">Điều kiện</th>
+                                <th class="px-3 py-2 text-left text-slate-400 uppercase tracking-[0.14em]">Yên lặng</th>
+                                <th class="px-3 py-2 text-left text-slate-400 uppercase tracking-[0.14em]">Gửi tới</th>
+                                <th class="px-3 py-2 text-right text-slate-400 uppercase tracking-[0.14em]"></th>
+                            </tr>
+                        </thead>
+                        <tbody class="divide-y divide-slate-800">
+                            {% for rule in rules %}
+                            <tr class="hover:bg-slate-800/80 transition-colors">
+                                <td class="px-3 py-2 text-slate-100 font-medium">{{ rule.name }}</td>
+                                <td class="px-3 py-2 text-slate-400">
+                                    {% if rule.api_id is not none %}API #{{ rule.api_id }}{% elif rule.api_group %}Nhóm {{ rule.api_group }}{% else %}Tất cả{% endif %}
+                                </td>
+                                <td class="px-3 py-2 text-slate-400">
+                                    {% if rule.threshold is not none %}<div>Ngưỡng &lt; {{ "{:,.0f}".format(rule.threshold) }}đ</div>{% endif %}
+                                    {% if rule.min_change %}<div>Biến động ≥ {{ "{:,.0f}".format(rule.min_change) }}đ</div>{% endif %}
+                                    {% if rule.max_rate %}<div>Tốc độ &gt; {{ "{:,.0f}".format(rule.max_rate) }}đ/phút</div>{% endif %}
+                                </td>
+                                <td class="px-3 py-2 text-slate-500">
+                                    {% if rule.quiet_start and rule.quiet_end %}{{ rule.quiet_start }} - {{ rule.quiet_end }}{% else %}-{% endif %}
+                                </td>
+                                <td class="px-3 py-2 text-slate-500">
+                                    {{ rule.chat_id or 'Chat mặc định' }}
+                                    {% if rule.bot_name %}<div class="text-[9px] text-sky-400/80">{{ rule.bot_name }}</div>{% endif %}
+                                </td>
+                                <td class="px-3 py-2 text-right">
+                                    <form method="post" action="{{ url_for('delete_rule', rule_id=rule.id) }}"
+                                          onsubmit="return confirm('Xoá quy tắc này?');">
+                                        <button class="px-2 py-1 rounded-xl bg-slate-950 text-rose-400 hover:bg-rose-600/20 hover:text-rose-300">
+                                            ✖
+                                        </button>
+                                    </form>
+                                </td>
+                            </tr>
+                            {% else %}
+                            <tr>
+                                <td colspan="6" class="px-3 py-4 text-center text-slate-500 text-[10px]">
+                                    Chưa có quy tắc nào.
+                                </td>
+                            </tr>
+                            {% endfor %}
+                        </tbody>
+                    </table>
+                </div>
+            </div>
+        </div>
+    </div>
+</div>
+</body>
+</html>
+"""
+
+# =========================
+# TEMPLATE: LỊCH SỬ BIẾN ĐỘNG
+# =========================
+HISTORY_TEMPLATE = r"""
+<!DOCTYPE html>
+<html lang="vi">
+<head>
+    <meta charset="UTF-8">
+    <title>{{ title }} | Lịch sử biến động</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <script src="https://cdn.tailwindcss.com"></script>
+    <style>
+        body { 
+            font-family: system-ui, -apple-system, BlinkMacSystemFont, "SF Pro Text", sans-serif;
+            background-color: #020817;
+            background-image:
+                radial-gradient(circle at 0 0, rgba(129, 140, 248, 0.18), transparent 55%),
+                radial-gradient(circle at 100% 0, rgba(45, 212, 191, 0.10), transparent 55%),
+                radial-gradient(circle at 100% 100%, rgba(236, 72, 153, 0.10), transparent 55%);
+            min-height: 100vh;
+        }
+        .scrollbar-thin::-webkit-scrollbar { height:5px; width:5px; }
+        .scrollbar-thin::-webkit-scrollbar-thumb { background-color:rgba(148,163,253,0.4); border-radius:999px; }
+        .scrollbar-thin::-webkit-scrollbar-track { background-color:transparent; }
+    </style>
+</head>
+<body class="text-slate-100">
+<div class="min-h-screen px-4 py-6 md:px-8 md:py-8">
+    <div class="max-w-6xl mx-auto mb-5 flex flex-col md:flex-row md:items-end md:justify-between gap-3">
+        <div>
+            <a href="{{ url_for('dashboard') }}" class="text-[10px] text-slate-500 hover:text-sky-300">← Về Dashboard</a>
+            <h1 class="mt-2 text-3xl font-semibold tracking-tight bg-clip-text text-transparent bg-gradient-to-r from-indigo-300 via-sky-300 to-fuchsia-300">
+                Lịch sử biến động số dư
+            </h1>
+        </div>
+    </div>
+
+    <div class="max-w-6xl mx-auto space-y-5">
+        <div class="bg-slate-900/80 border border-slate-800 rounded-3xl p-5 shadow-2xl backdrop-blur-xl">
+            <form method="get" action="{{ url_for('history') }}" class="grid grid-cols-1 md:grid-cols-6 gap-3 text-[10px]">
+                <div>
+                    <label class="block text-slate-400 mb-1">API</label>
+                    <select name="api_id"
+                        class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 focus:outline-none focus:ring-2 focus:ring-indigo-500 focus:border-indigo-400">
+                        <option value="">-- Tất cả --</option>
+                        {% for api in apis %}
+                            <option value="{{ api.id }}" {% if filters.api_id == api.id %}selected{% endif %}>#{{ api.id }} {{ api.name }}</option>
+                        {% endfor %}
+                    </select>
+                </div>
+                <div>
+                    <label class="block text-slate-400 mb-1">Từ ngày (VN)</label>
+                    <input type="date" name="from" value="{{ filters.date_from or '' }}"
+                        class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 focus:outline-none focus:ring-2 focus:ring-indigo-500 focus:border-indigo-400">
+                </div>
+                <div>
+                    <label class="block text-slate-400 mb-1">Đến ngày (VN)</label>
+                    <input type="date" name="to" value="{{ filters.date_to or '' }}"
+                        class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 focus:outline-none focus:ring-2 focus:ring-indigo-500 focus:border-indigo-400">
+                </div>
+                <div>
+                    <label class="block text-slate-400 mb-1">Loại</label>
+                    <select name="direction"
+                        class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 focus:outline-none focus:ring-2 focus:ring-indigo-500 focus:border-indigo-400">
+                        <option value="">-- Tất cả --</option>
+                        <option value="in" {% if filters.direction == 'in' %}selected{% endif %}>Cộng tiền</option>
+                        <option value="out" {% if filters.direction == 'out' %}selected{% endif %}>Thanh toán</option>
+                    </select>
+                </div>
+                <div>
+                    <label class="block text-slate-400 mb-1">Hiển thị</label>
+                    <select name="view"
+                        class="w-full px-3 py-2 rounded-2xl bg-slate-950/80 border border-slate-700 text-[11px] text-slate-100 focus:outline-none focus:ring-2 focus:ring-indigo-500 focus:border-indigo-400">
+                        <option value="">Từng giao dịch</option>
+                        <option value="hour" {% if filters.view == 'hour' %}selected{% endif %}>Tổng hợp theo giờ</option>
+                        <option value="day" {% if filters.view == 'day' %}selected{% endif %}>Tổng hợp theo ngày</option>
+                    </select>
+                </div>
+                <div class="flex items-end">
+                    <button type="submit"
+                        class="w-full inline-flex items-center justify-center gap-2 px-4 py-2.5 rounded-2xl bg-gradient-to-r from-indigo-500 via-sky-500 to-fuchsia-500 text-white text-[11px] font-medium shadow-lg hover:-translate-y-0.5 hover:shadow-xl transition-all">
+                        🔎 Lọc
+                    </button>
+                </div>
+            </form>
+        </div>
+
+        <div class="bg-slate-900/80 border border-slate-800 rounded-3xl p-5 shadow-2xl backdrop-blur-xl">
+            <div class="overflow-x-auto scrollbar-thin">
+                {% if filters.view %}
+                <table class="min-w-full text-[10px]">
+                    <thead class="bg-slate-950/80">
+                        <tr>
+                            <th class="px-3 py-2 text-left text-slate-400 uppercase tracking-[0.14em]">Kỳ (VN)</th>
+                            <th class="px-3 py-2 text-left text-slate-400 uppercase tracking-[0.14em]">API</th>
+                            <th class="px-3 py-2 text-right text-slate-400 uppercase tracking-[0.14em]">Số GD</th>
+                            <th class="px-3 py-2 text-right text-slate-400 uppercase tracking-[0.14em]">Tổng cộng</th>
+                            <th class="px-3 py-2 text-right text-slate-400 uppercase tracking-[0.14em]">Tổng trừ</th>
+                            <th class="px-3 py-2 text-right text-slate-400 uppercase tracking-[0.14em]">Thấp nhất</th>
+                            <th class="px-3 py-2 text-right text-slate-400 uppercase tracking-[0.14em]">Cao nhất</th>
+                            <th class="px-3 py-2 text-right text-slate-400 uppercase tracking-[0.14em]">Cuối kỳ</th>
+                        </tr>
+                    </thead>
+                    <tbody class="divide-y divide-slate-800">
+                        {% for row in rows %}
+                        <tr class="hover:bg-slate-800/80 transition-colors">
+                            <td class="px-3 py-2 text-slate-400">{{ row.period_label }}</td>
+                            <td class="px-3 py-2 text-slate-100 font-medium">#{{ row.api_id }} {{ row.name or '' }}</td>
+                            <td class="px-3 py-2 text-right text-slate-200">{{ row.count }}</td>
+                            <td class="px-3 py-2 text-right text-emerald-300">+{{ "{:,.0f}".format(row.sum_in) }}đ</td>
+                            <td class="px-3 py-2 text-right text-rose-300">-{{ "{:,.0f}".format(row.sum_out) }}đ</td>
+                            <td class="px-3 py-2 text-right text-slate-300">{{ "{:,.0f}".format(row.min_balance) }}đ</td>
+                            <td class="px-3 py-2 text-right text-slate-300">{{ "{:,.0f}".format(row.max_balance) }}đ</td>
+                            <td class="px-3 py-2 text-right text-slate-200">{{ "{:,.0f}".format(row.close_balance) }}đ</td>
+                        </tr>
+                        {% else %}
+                        <tr>
+                            <td colspan="8" class="px-3 py-4 text-center text-slate-500 text-[10px]">
+                                Không có dữ liệu tổng hợp.
+                            </td>
+                        </tr>
+                        {% endfor %}
+                    </tbody>
+                </table>
+                {% else %}
+                <table class="min-w-full text-[10px]">
+                    <thead class="bg-slate-950/80">
+                        <tr>
+                            <th class="px-3 py-2 text-left text-slate-400 uppercase tracking-[0.14em]">Thời gian</th>
+                            <th class="px-3 py-2 text-left text-slate-400 uppercase tracking-[0.14em]">API</th>
+                            <th class="px-3 py-2 text-right text-slate-400 uppercase tracking-[0.14em]">Biến động</th>
+                            <th class="px-3 py-2 text-right text-slate-400 uppercase tracking-[0.14em]">Số dư cuối</th>
+                        </tr>
+                    </thead>
+                    <tbody class="divide-y divide-slate-800">
+                        {% for row in rows %}
+                        <tr class="hover:bg-slate-800/80 transition-colors">
+                            <td class="px-3 py-2 text-slate-400">{{ row.time_vn }}</td>
+                            <td class="px-3 py-2 text-slate-100 font-medium">#{{ row.api_id }} {{ row.name }}</td>
+                            <td class="px-3 py-2 text-right">
+                                {% if row.change_amount >= 0 %}
+                                    <span class="text-emerald-300">+{{ "{:,.0f}".format(row.change_amount) }}đ</span>
+                                {% else %}
+                                    <span class="text-rose-300">{{ "{:,.0f}".format(row.change_amount) }}đ</span>
+                                {% endif %}
+                            </td>
+                            <td class="px-3 py-2 text-right text-slate-200">{{ "{:,.0f}".format(row.new_balance) }}đ</td>
+                        </tr>
+                        {% else %}
+                        <tr>
+                            <td colspan="4" class="px-3 py-4 text-center text-slate-500 text-[10px]">
+                                Không có biến động nào.
+                            </td>
+                        </tr>
+                        {% endfor %}
+                    </tbody>
+                </table>
+                {% endif %}
+            </div>
+            <div class="mt-3 flex items-center justify-between text-[10px]">
+                {% if filters.before %}
+                    <a href="{{ url_for('history', **page_args) }}" class="text-slate-500 hover:text-sky-300">⇤ Mới nhất</a>
+                {% else %}
+                    <span></span>
+                {% endif %}
+                {% if next_cursor %}
+                    <a href="{{ url_for('history', before=next_cursor, **page_args) }}" class="text-sky-300 hover:text-sky-200">Cũ hơn →</a>
+                {% endif %}
+            </div>
         </div>
     </div>
 </div>
@@ -584,11 +1238,84 @@ DASHBOARD_TEMPLATE = r"""
 # =========================
 # DB HELPER
 # =========================
-def init_db():
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
+class DbPool:
+    """Pool kết nối SQLite chế độ WAL: đọc song song không cần khoá, ghi tuần tự qua db_lock"""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self.idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None: tự quản lý transaction (BEGIN IMMEDIATE khi ghi), đọc không giữ snapshot
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                               check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        if self.pid != os.getpid():
+            # Sau fork (gunicorn --preload): không dùng lại kết nối của process cha
+            with self.lock:
+                self.idle = queue.LifoQueue()
+                self.created = 0
+                self.pid = os.getpid()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self.created -= 1
+                    raise
+        return self.idle.get(timeout=30)
+
+    def _release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        self.idle.put(conn)
+
+    @contextmanager
+    def read(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def write(self):
+        with db_lock:
+            conn = self._acquire()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            finally:
+                self._release(conn)
 
+    def stats(self) -> Dict[str, Any]:
+        return {"size": self.size, "open": self.created, "idle": self.idle.qsize()}
+
+db = DbPool(DB_PATH, DB_POOL_SIZE)
+
+def init_db():
+    with db.write() as c:
         c.execute("""
         CREATE TABLE IF NOT EXISTS telegram_bots (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -606,6 +1333,7 @@ def init_db():
 
         setting_keys = [
             "default_chat_id", "default_bot_id", "last_run", "poll_interval", "global_threshold",
+            "max_concurrency", "history_retention_days", "notify_coalesce_seconds",
             "report_email", "smtp_server", "smtp_port", "smtp_user", "smtp_pass"
         ]
         for k in setting_keys:
@@ -621,6 +1349,34 @@ def init_db():
             last_change TEXT
         )
         """)
+        _ensure_column(c, "apis", "poll_interval", "REAL")
+        _ensure_column(c, "apis", "learned_path", "TEXT")
+        _ensure_column(c, "apis", "max_response_bytes", "INTEGER")
+        _ensure_column(c, "apis", "stream_json", "INTEGER NOT NULL DEFAULT 0")
+        for kind in FAILURE_KINDS:
+            _ensure_column(c, "apis", f"err_{kind}", "INTEGER NOT NULL DEFAULT 0")
+        _ensure_column(c, "apis", "last_error", "TEXT")
+        _ensure_column(c, "apis", "last_error_at", "TEXT")
+        _ensure_column(c, "apis", "breaker_state", "TEXT NOT NULL DEFAULT 'closed'")
+        _ensure_column(c, "apis", "api_group", "TEXT NOT NULL DEFAULT ''")
+
+        # Quy tắc cảnh báo theo API / nhóm API / tất cả (api_id NULL và api_group rỗng)
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS alert_rules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            api_id INTEGER,
+            api_group TEXT NOT NULL DEFAULT '',
+            threshold REAL,
+            min_change REAL,
+            max_rate REAL,
+            quiet_start TEXT NOT NULL DEFAULT '',
+            quiet_end TEXT NOT NULL DEFAULT '',
+            chat_id TEXT NOT NULL DEFAULT '',
+            bot_id INTEGER,
+            enabled INTEGER NOT NULL DEFAULT 1
+        )
+        """)
 
         c.execute("""
         CREATE TABLE IF NOT EXISTS balance_history (
@@ -633,121 +1389,808 @@ def init_db():
             FOREIGN KEY(api_id) REFERENCES apis(id) ON DELETE CASCADE
         )
         """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_history_api_id ON balance_history(api_id, id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_history_timestamp ON balance_history(timestamp, id)")
 
-        conn.commit()
-        conn.close()
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS watcher_lease (
+            name TEXT PRIMARY KEY,
+            owner TEXT,
+            acquired_at REAL,
+            heartbeat_at REAL,
+            expires_at REAL
+        )
+        """)
+        c.execute("INSERT OR IGNORE INTO watcher_lease (name, owner, expires_at) VALUES ('watcher', NULL, 0)")
 
-def get_settings() -> Dict[str, Optional[str]]:
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT key, value FROM settings")
-        rows = c.fetchall()
-        conn.close()
-    return {k: (v if v is not None else "") for k, v in rows}
+        # Phiên bản dữ liệu từng bảng cấu hình, tăng mỗi lần ghi -> cache trong RAM biết khi nào nạp lại
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+        """)
+        for name in CACHED_TABLES:
+            c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, 0)", (f"ver_{name}",))
 
-def set_setting(key: str, value: str):
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute(
-            "INSERT INTO settings (key, value) VALUES (?, ?) "
-            "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-            (key, value),
+        # Tổng hợp theo giờ / ngày (giờ VN), cập nhật dần mỗi khi ghi lịch sử -> còn nguyên sau khi dọn lịch sử thô
+        for table, _ in ROLLUP_TABLES.values():
+            c.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                api_id INTEGER NOT NULL,
+                period TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                sum_in REAL NOT NULL,
+                sum_out REAL NOT NULL,
+                min_balance REAL NOT NULL,
+                max_balance REAL NOT NULL,
+                close_balance REAL NOT NULL,
+                close_ts TEXT NOT NULL,
+                PRIMARY KEY (api_id, period)
+            )
+            """)
+        # Tin Telegram chờ gửi, ghi cùng transaction với trạng thái / lịch sử -> restart không mất, không gửi trùng
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idem_key TEXT NOT NULL UNIQUE,
+            kind TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            bot_token TEXT NOT NULL,
+            text TEXT NOT NULL,
+            payload TEXT NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            claimed_by TEXT,
+            claimed_until REAL,
+            created_at REAL NOT NULL,
+            sent_at REAL,
+            last_error TEXT
         )
-        conn.commit()
-        conn.close()
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status ON notification_outbox(status, next_attempt_at)")
 
-def get_bots() -> List[Dict[str, Any]]:
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute("SELECT * FROM telegram_bots ORDER BY id")
-        rows = c.fetchall()
-        conn.close()
-    return [dict(r) for r in rows]
+        # Email chờ gửi: worker web nào cũng ghi được, chỉ leader gửi -> /stats ở worker nào cũng thấy đúng
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            to_email TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            html TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            created_at REAL NOT NULL,
+            sent_at REAL,
+            last_error TEXT
+        )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_status ON email_outbox(status, next_attempt_at)")
 
-def get_apis() -> List[Dict[str, Any]]:
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute("SELECT * FROM apis ORDER BY id")
-        rows = c.fetchall()
-        conn.close()
-    return [dict(r) for r in rows]
+        # Backup đã tải (mốc balance_history.id cho backup thay đổi lần sau) và backup đã restore vào DB này
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS backup_log (
+            backup_id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            base_id TEXT,
+            parent_id TEXT,
+            since_id INTEGER NOT NULL DEFAULT 0,
+            watermark INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """)
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS backup_applied (
+            backup_id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            base_id TEXT,
+            applied_at TEXT NOT NULL
+        )
+        """)
 
-def add_bot_db(name: str, token: str):
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("INSERT INTO telegram_bots (bot_name, bot_token) VALUES (?, ?)", (name, token))
-        conn.commit()
-        conn.close()
+        c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('rollup_backfilled', 0)")
+        if not c.execute("SELECT value FROM meta WHERE key='rollup_backfilled'").fetchone()[0]:
+            # DB cũ: dựng tổng hợp từ toàn bộ lịch sử thô hiện có (1 lần)
+            cur = c.execute(
+                "SELECT api_id, name, timestamp, change_amount, new_balance FROM balance_history ORDER BY id"
+            )
+            while True:
+                chunk = cur.fetchmany(RETENTION_DELETE_BATCH)
+                if not chunk:
+                    break
+                _fold_into_rollups(c, [tuple(r) for r in chunk])
+            c.execute("UPDATE meta SET value=1 WHERE key='rollup_backfilled'")
+            c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('rollup_vn', 1)")
+        c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('rollup_vn', 0)")
+        if not c.execute("SELECT value FROM meta WHERE key='rollup_vn'").fetchone()[0]:
+            # DB cũ có kỳ theo UTC: dời kỳ giờ sang giờ VN (lệch đúng 7 giờ), dựng lại kỳ ngày từ kỳ giờ
+            _shift_hourly_rollups_to_vn(c)
+            _rebuild_daily_rollups(c)
+            c.execute("UPDATE meta SET value=1 WHERE key='rollup_vn'")
 
-def delete_bot_db(bot_id: int):
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("DELETE FROM telegram_bots WHERE id=?", (bot_id,))
-        conn.commit()
-        conn.close()
+def _ensure_column(c: sqlite3.Connection, table: str, column: str, decl: str):
+    # Nâng cấp DB cũ: thêm cột nếu chưa có
+    cols = {r[1] for r in c.execute(f"PRAGMA table_info({table})").fetchall()}
+    if column not in cols:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
 
-def add_api_db(name: str, url: str, balance_field: str) -> int:
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute(
-            "INSERT INTO apis (name, url, balance_field, last_balance, last_change) "
-            "VALUES (?, ?, ?, NULL, NULL)",
-            (name, url, balance_field or ""),
-        )
-        new_id = c.lastrowid
-        conn.commit()
-        conn.close()
-    return int(new_id)
+def _bump_version(c: sqlite3.Connection, *tables: str):
+    # Gọi trong cùng transaction với lệnh ghi
+    for name in tables:
+        c.execute("UPDATE meta SET value=value+1 WHERE key=?", (f"ver_{name}",))
 
-def delete_api_db(api_id: int):
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("DELETE FROM apis WHERE id=?", (api_id,))
-        c.execute("DELETE FROM balance_history WHERE api_id=?", (api_id,)) 
-        conn.commit()
-        conn.close()
+class CatalogCache:
+    """Cache settings / bots / apis trong RAM.
 
-def update_api_state(api_id: int, balance: float, changed_at: str):
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute(
+    Mỗi lần đọc chỉ kiểm tra `PRAGMA data_version` trên 1 kết nối riêng (đổi khi có bất kỳ
+    kết nối nào khác commit, kể cả process khác); khi đổi mới đọc bảng meta để biết bảng nào
+    cần nạp lại. Không có ghi mới thì không đụng tới DB.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn: Optional[sqlite3.Connection] = None
+        self.pid = os.getpid()
+        self.data_version: Optional[int] = None
+        self.versions: Dict[str, int] = {}
+        self.entries: Dict[str, Tuple[int, Any]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _current_versions(self) -> Dict[str, int]:
+        with self.lock:
+            if self.conn is None or self.pid != os.getpid():
+                self.conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                                            check_same_thread=False, isolation_level=None)
+                self.pid = os.getpid()
+                self.data_version = None
+            dv = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if dv != self.data_version:
+                rows = self.conn.execute("SELECT key, value FROM meta WHERE key LIKE 'ver_%'").fetchall()
+                self.versions = {k[4:]: v for k, v in rows}
+                self.data_version = dv
+            return self.versions
+
+    def get(self, name: str, loader):
+        """Giá trị trả về dùng chung giữa các thread: chỉ đọc (getter trả list / dict thì tự copy)"""
+        version = self._current_versions().get(name, 0)
+        entry = self.entries.get(name)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        # Đọc version TRƯỚC khi nạp: nếu có ghi chen giữa, lần sau sẽ thấy version mới và nạp lại
+        value = loader()
+        self.entries[name] = (version, value)
+        return value
+
+    def stats(self) -> Dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "versions": dict(self.versions)}
+
+catalog_cache = CatalogCache(DB_PATH)
+
+def _load_settings() -> Dict[str, Optional[str]]:
+    with db.read() as c:
+        rows = c.execute("SELECT key, value FROM settings").fetchall()
+    return {k: (v if v is not None else "") for k, v in rows}
+
+def _load_bots() -> List[Dict[str, Any]]:
+    with db.read() as c:
+        rows = c.execute("SELECT * FROM telegram_bots ORDER BY id").fetchall()
+    return [dict(r) for r in rows]
+
+def _load_apis() -> List[Dict[str, Any]]:
+    with db.read() as c:
+        rows = c.execute("SELECT * FROM apis ORDER BY id").fetchall()
+    return [dict(r) for r in rows]
+
+def get_settings() -> Dict[str, Optional[str]]:
+    return dict(catalog_cache.get("settings", _load_settings))
+
+def get_setting_fresh(key: str) -> str:
+    # Cho các key thay đổi liên tục (last_run) - không làm mất hiệu lực cache
+    with db.read() as c:
+        row = c.execute("SELECT value FROM settings WHERE key=?", (key,)).fetchone()
+    return (row[0] or "") if row else ""
+
+# Cột lỗi / breaker của apis do watcher ghi gần như mỗi chu kỳ: không làm mất hiệu lực cache "apis",
+# nơi cần hiển thị thì đọc thẳng DB qua get_api_health()
+API_HEALTH_COLUMNS = ("last_error", "last_error_at", "breaker_state") + tuple(f"err_{k}" for k in FAILURE_KINDS)
+
+def get_api_health() -> Dict[int, Dict[str, Any]]:
+    with db.read() as c:
+        rows = c.execute(f"SELECT id, {', '.join(API_HEALTH_COLUMNS)} FROM apis").fetchall()
+    return {r["id"]: {k: r[k] for k in API_HEALTH_COLUMNS} for r in rows}
+
+def set_setting(key: str, value: str):
+    with db.write() as c:
+        c.execute(
+            "INSERT INTO settings (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+            (key, value),
+        )
+        if key not in VOLATILE_SETTINGS:
+            _bump_version(c, "settings")
+
+def get_bots() -> List[Dict[str, Any]]:
+    return [dict(b) for b in catalog_cache.get("bots", _load_bots)]
+
+def get_apis() -> List[Dict[str, Any]]:
+    return [dict(a) for a in catalog_cache.get("apis", _load_apis)]
+
+def add_bot_db(name: str, token: str):
+    with db.write() as c:
+        c.execute("INSERT INTO telegram_bots (bot_name, bot_token) VALUES (?, ?)", (name, token))
+        _bump_version(c, "bots")
+
+def delete_bot_db(bot_id: int):
+    with db.write() as c:
+        c.execute("DELETE FROM telegram_bots WHERE id=?", (bot_id,))
+        _bump_version(c, "bots")
+
+def add_api_db(name: str, url: str, balance_field: str, poll_interval: Optional[float] = None,
+               max_response_bytes: Optional[int] = None, stream_json: bool = False, api_group: str = "") -> int:
+    with db.write() as c:
+        cur = c.execute(
+            "INSERT INTO apis (name, url, balance_field, last_balance, last_change, poll_interval, "
+            "max_response_bytes, stream_json, api_group) "
+            "VALUES (?, ?, ?, NULL, NULL, ?, ?, ?, ?)",
+            (name, url, balance_field or "", poll_interval, max_response_bytes, 1 if stream_json else 0,
+             (api_group or "").strip()),
+        )
+        new_id = cur.lastrowid
+        _bump_version(c, "apis")
+    return int(new_id)
+
+def delete_api_db(api_id: int):
+    with db.write() as c:
+        c.execute("DELETE FROM apis WHERE id=?", (api_id,))
+        c.execute("DELETE FROM balance_history WHERE api_id=?", (api_id,)) 
+        for table, _ in ROLLUP_TABLES.values():
+            c.execute(f"DELETE FROM {table} WHERE api_id=?", (api_id,))
+        c.execute("DELETE FROM alert_rules WHERE api_id=?", (api_id,))
+        _bump_version(c, "apis", "rules")
+
+def get_alert_rules() -> List[Dict[str, Any]]:
+    with db.read() as c:
+        rows = c.execute("SELECT * FROM alert_rules ORDER BY id").fetchall()
+    return [dict(r) for r in rows]
+
+def _insert_alert_rule(c: sqlite3.Connection, rule: Dict[str, Any]) -> int:
+    cur = c.execute(
+        "INSERT INTO alert_rules (name, api_id, api_group, threshold, min_change, max_rate, "
+        "quiet_start, quiet_end, chat_id, bot_id, enabled) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (rule.get("name") or "", rule.get("api_id"), rule.get("api_group") or "", rule.get("threshold"),
+         rule.get("min_change"), rule.get("max_rate"), rule.get("quiet_start") or "",
+         rule.get("quiet_end") or "", rule.get("chat_id") or "", rule.get("bot_id"),
+         0 if rule.get("enabled") in (0, False) else 1),
+    )
+    return int(cur.lastrowid)
+
+def add_alert_rule_db(rule: Dict[str, Any]) -> int:
+    with db.write() as c:
+        new_id = _insert_alert_rule(c, rule)
+        _bump_version(c, "rules")
+    return new_id
+
+def delete_alert_rule_db(rule_id: int):
+    with db.write() as c:
+        c.execute("DELETE FROM alert_rules WHERE id=?", (rule_id,))
+        _bump_version(c, "rules")
+
+def update_api_state(api_id: int, balance: float, changed_at: str):
+    with db.write() as c:
+        c.execute(
             "UPDATE apis SET last_balance=?, last_change=? WHERE id=?",
             (balance, changed_at, api_id),
         )
-        conn.commit()
-        conn.close()
+        _bump_version(c, "apis")
+
+def set_learned_path(api_id: int, path: str):
+    with db.write() as c:
+        c.execute("UPDATE apis SET learned_path=? WHERE id=?", (path, api_id))
+        _bump_version(c, "apis")
+
+def _fold_into_rollups(c: sqlite3.Connection, rows: List[tuple]):
+    """Cộng các dòng lịch sử (api_id, name, timestamp, change_amount, new_balance) vào bảng tổng hợp.
+
+    Kỳ tính theo giờ VN (trang Lịch sử lọc theo ngày VN). Gọi trong cùng transaction với lệnh INSERT vào balance_history.
+    """
+    for table, width in ROLLUP_TABLES.values():
+        c.executemany(
+            f"INSERT INTO {table} (api_id, period, count, sum_in, sum_out, min_balance, max_balance, "
+            "close_balance, close_ts) VALUES (?, ?, 1, max(?, 0), max(-?, 0), ?, ?, ?, ?) "
+            "ON CONFLICT(api_id, period) DO UPDATE SET "
+            "count=count+1, sum_in=sum_in+excluded.sum_in, sum_out=sum_out+excluded.sum_out, "
+            "min_balance=min(min_balance, excluded.min_balance), "
+            "max_balance=max(max_balance, excluded.max_balance), "
+            "close_balance=CASE WHEN excluded.close_ts>=close_ts THEN excluded.close_balance ELSE close_balance END, "
+            "close_ts=max(close_ts, excluded.close_ts)",
+            [(api_id, vn_period(ts, width), chg, chg, bal, bal, bal, ts) for api_id, _, ts, chg, bal in rows],
+        )
+
+def _shift_hourly_rollups_to_vn(c: sqlite3.Connection, api_ids: Optional[List[int]] = None):
+    """Đổi khoá kỳ giờ từ UTC sang giờ VN; qua bảng tạm vì dời tại chỗ có thể đụng khoá (api_id, period)"""
+    table = ROLLUP_TABLES["hour"][0]
+    where = f" WHERE api_id IN ({','.join('?' * len(api_ids))})" if api_ids else ""
+    params = tuple(api_ids or ())
+    c.execute("DROP TABLE IF EXISTS temp.rollup_shift")
+    c.execute(
+        "CREATE TEMP TABLE rollup_shift AS SELECT api_id, "
+        "strftime('%Y-%m-%dT%H', period || ':00:00', '+7 hours') AS period, count, sum_in, sum_out, "
+        f"min_balance, max_balance, close_balance, close_ts FROM {table}{where}",
+        params,
+    )
+    c.execute(f"DELETE FROM {table}{where}", params)
+    c.execute(f"INSERT INTO {table} SELECT * FROM rollup_shift")
+    c.execute("DROP TABLE rollup_shift")
+
+def _rebuild_daily_rollups(c: sqlite3.Connection, api_ids: Optional[List[int]] = None):
+    """Dựng lại kỳ ngày từ kỳ giờ (cùng múi giờ VN); close_balance lấy theo dòng có close_ts lớn nhất"""
+    hourly, daily = ROLLUP_TABLES["hour"][0], ROLLUP_TABLES["day"][0]
+    where = f" WHERE api_id IN ({','.join('?' * len(api_ids))})" if api_ids else ""
+    params = tuple(api_ids or ())
+    c.execute(f"DELETE FROM {daily}{where}", params)
+    c.execute(
+        f"INSERT INTO {daily} (api_id, period, count, sum_in, sum_out, min_balance, max_balance, "
+        "close_balance, close_ts) "
+        "SELECT g.api_id, g.day, g.cnt, g.sin, g.sout, g.lo, g.hi, "
+        f"(SELECT h.close_balance FROM {hourly} h WHERE h.api_id=g.api_id AND h.close_ts=g.cts "
+        "ORDER BY h.period DESC LIMIT 1), g.cts "
+        "FROM (SELECT api_id, substr(period, 1, 10) AS day, SUM(count) AS cnt, SUM(sum_in) AS sin, "
+        "SUM(sum_out) AS sout, MIN(min_balance) AS lo, MAX(max_balance) AS hi, MAX(close_ts) AS cts "
+        f"FROM {hourly}{where} GROUP BY api_id, substr(period, 1, 10)) g",
+        params,
+    )
 
 def log_transaction(api_id: int, name: str, timestamp: str, change_amount: float, new_balance: float):
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
+    with db.write() as c:
         c.execute(
             "INSERT INTO balance_history (api_id, name, timestamp, change_amount, new_balance) "
             "VALUES (?, ?, ?, ?, ?)",
             (api_id, name, timestamp, change_amount, new_balance)
         )
-        conn.commit()
-        conn.close()
+        _fold_into_rollups(c, [(api_id, name, timestamp, change_amount, new_balance)])
+
+def query_balance_history(api_id: Optional[int] = None, since: Optional[str] = None, until: Optional[str] = None,
+                          direction: Optional[str] = None, before_id: Optional[int] = None,
+                          limit: int = HISTORY_PAGE_SIZE) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    """Lịch sử mới nhất trước, phân trang keyset: trả về (rows, before_id của trang kế tiếp hoặc None).
+
+    since / until là chuỗi ISO UTC (so sánh với cột timestamp), direction = "in" | "out".
+    """
+    limit = max(1, min(int(limit), HISTORY_PAGE_SIZE_MAX))
+    where = []
+    params: List[Any] = []
+    if api_id is not None:
+        where.append("api_id=?")
+        params.append(api_id)
+    if since:
+        where.append("timestamp>=?")
+        params.append(since)
+    if until:
+        where.append("timestamp<?")
+        params.append(until)
+    if direction == "in":
+        where.append("change_amount>0")
+    elif direction == "out":
+        where.append("change_amount<0")
+    if before_id is not None:
+        where.append("id<?")
+        params.append(before_id)
+    sql = "SELECT * FROM balance_history"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(limit + 1)
+    with db.read() as c:
+        rows = [dict(r) for r in c.execute(sql, params).fetchall()]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]["id"]
+    return rows, next_cursor
+
+def query_balance_rollups(granularity: str, api_id: Optional[int] = None, since: Optional[str] = None,
+                          until: Optional[str] = None, before: Optional[Tuple[str, int]] = None,
+                          limit: int = HISTORY_PAGE_SIZE) -> Tuple[List[Dict[str, Any]], Optional[Tuple[str, int]]]:
+    """Tổng hợp theo "hour" | "day", kỳ mới nhất trước; phân trang keyset theo (period, api_id).
+
+    since / until là ngày / giờ VN dạng ISO (cùng múi giờ với khoá kỳ), được cắt về độ dài khoá kỳ trước khi so sánh.
+    """
+    table, width = ROLLUP_TABLES[granularity]
+    limit = max(1, min(int(limit), HISTORY_PAGE_SIZE_MAX))
+    where = []
+    params: List[Any] = []
+    if api_id is not None:
+        where.append("r.api_id=?")
+        params.append(api_id)
+    if since:
+        where.append("r.period>=?")
+        params.append(since[:width])
+    if until:
+        where.append("r.period<?")
+        params.append(until[:width])
+    if before is not None:
+        where.append("(r.period, r.api_id)<(?, ?)")
+        params.extend(before)
+    sql = f"SELECT r.*, a.name FROM {table} r LEFT JOIN apis a ON a.id=r.api_id"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY r.period DESC, r.api_id DESC LIMIT ?"
+    params.append(limit + 1)
+    with db.read() as c:
+        rows = [dict(r) for r in c.execute(sql, params).fetchall()]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = (rows[-1]["period"], rows[-1]["api_id"])
+    return rows, next_cursor
+
+def get_retention_days(settings: Dict[str, Optional[str]]) -> Optional[float]:
+    days = to_float(settings.get("history_retention_days") or "", None)
+    return days if days and days > 0 else None
+
+def prune_history(retention_days: float, now: Optional[datetime] = None) -> int:
+    """Xoá lịch sử thô cũ hơn retention_days (đã nằm trong bảng tổng hợp), mỗi lô 1 transaction ngắn"""
+    cutoff = ((now or datetime.utcnow()) - timedelta(days=retention_days)).isoformat()
+    deleted = 0
+    while True:
+        with db.write() as c:
+            cur = c.execute(
+                "DELETE FROM balance_history WHERE id IN "
+                "(SELECT id FROM balance_history WHERE timestamp<? ORDER BY timestamp LIMIT ?)",
+                (cutoff, RETENTION_DELETE_BATCH),
+            )
+            n = cur.rowcount
+        deleted += n
+        if n < RETENTION_DELETE_BATCH:
+            return deleted
+
+class WriteBuffer:
+    """Gom trạng thái / lịch sử / lỗi của watcher rồi ghi 1 transaction bằng executemany.
+
+    Chỉ thread watcher dùng. Số dư chưa flush được đọc lại qua pending_balance()
+    để so sánh đúng với lần quét kế tiếp.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.last_flush = time.monotonic()
+        self.flushes = 0
+        self.rows_written = 0
+        # Trạng thái breaker đã ghi (hoặc đang chờ ghi) vào DB - không xoá khi flush, vì cột này
+        # không làm mới cache "apis" nên api["breaker_state"] trong cache có thể đã cũ
+        self.breaker_known: Dict[int, str] = {}
+        self._reset()
+
+    def _reset(self):
+        self.states: Dict[int, Tuple[float, str]] = {}
+        self.history: List[tuple] = []
+        self.learned: Dict[int, str] = {}
+        self.failures: Dict[int, Dict[str, Any]] = {}
+        self.breaker_states: Dict[int, str] = {}
+        self.settings: Dict[str, str] = {}
+        self.notifications: List[tuple] = []
+
+    def discard(self) -> int:
+        """Bỏ mọi thứ chưa ghi (VD mất lease), trả về số mục bị bỏ"""
+        dropped = (len(self.states) + len(self.history) + len(self.learned) + len(self.failures)
+                   + len(self.breaker_states) + len(self.settings) + len(self.notifications))
+        self._reset()
+        self.breaker_known = {}
+        return dropped
+
+    def pending(self) -> bool:
+        return bool(self.states or self.history or self.learned or self.failures
+                    or self.breaker_states or self.settings or self.notifications)
+
+    def pending_change(self, api_id: int, default: Optional[str]) -> Optional[str]:
+        state = self.states.get(api_id)
+        return state[1] if state is not None else default
+
+    def pending_balance(self, api_id: int, default: Optional[float]) -> Optional[float]:
+        state = self.states.get(api_id)
+        return state[0] if state is not None else default
 
+    def set_state(self, api_id: int, balance: float, changed_at: str):
+        self.states[api_id] = (balance, changed_at)
+
+    def add_history(self, api_id: int, name: str, timestamp: str, change_amount: float, new_balance: float):
+        self.history.append((api_id, name, timestamp, change_amount, new_balance))
+
+    def set_learned_path(self, api_id: int, path: str):
+        self.learned[api_id] = path
+
+    def revert_events(self, events: List[Dict[str, Any]]):
+        """Bỏ số dư / lịch sử chưa ghi của các biến động (chưa tạo được cảnh báo) để lần quét sau phát hiện lại"""
+        keys = set()
+        for ev in events:
+            api_id = ev["api"]["id"]
+            if ev["prev_change"]:
+                self.states[api_id] = (ev["old"], ev["prev_change"])
+            else:
+                self.states.pop(api_id, None)
+            keys.add((api_id, ev["at"].isoformat() + "Z"))
+        self.history = [h for h in self.history if (h[0], h[2]) not in keys]
+
+    def add_notifications(self, rows: List[tuple]):
+        self.notifications.extend(rows)
+
+    def set_setting(self, key: str, value: str):
+        self.settings[key] = value
+
+    def add_failure(self, api_id: int, kind: str, message: str, failed_at: str, breaker_state: str):
+        f = self.failures.setdefault(api_id, {k: 0 for k in FAILURE_KINDS})
+        if kind in FAILURE_KINDS:
+            f[kind] += 1
+        f["last_error"] = message[:500]
+        f["last_error_at"] = failed_at
+        f["breaker_state"] = breaker_state
+        self.breaker_states.pop(api_id, None)
+        self.breaker_known[api_id] = breaker_state
+
+    def known_breaker_state(self, api_id: int, default: Optional[str]) -> str:
+        return self.breaker_known.get(api_id, default or "closed")
+
+    def load_breaker_states(self, health: Dict[int, Dict[str, Any]]):
+        """Nạp trạng thái breaker thật trong DB (lúc bắt đầu làm leader)"""
+        self.breaker_known = {api_id: h["breaker_state"] or "closed" for api_id, h in health.items()}
+
+    def set_breaker_state(self, api_id: int, breaker_state: str):
+        self.breaker_known[api_id] = breaker_state
+        if api_id in self.failures:
+            self.failures[api_id]["breaker_state"] = breaker_state
+        else:
+            self.breaker_states[api_id] = breaker_state
+
+    def due(self, now: Optional[float] = None) -> Optional[float]:
+        """Số giây tới lần flush kế tiếp (None nếu không có gì chờ ghi)"""
+        if not self.pending():
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.last_flush + self.interval - now)
+
+    def flush(self, force: bool = False) -> bool:
+        wait = self.due()
+        if wait is None or (wait > 0 and not force):
+            return False
+        err_sets = ", ".join(f"err_{k}=err_{k}+?" for k in FAILURE_KINDS)
+        with db.write() as c:
+            if self.states:
+                c.executemany(
+                    "UPDATE apis SET last_balance=?, last_change=? WHERE id=?",
+                    [(b, ts, api_id) for api_id, (b, ts) in self.states.items()],
+                )
+            if self.history:
+                c.executemany(
+                    "INSERT INTO balance_history (api_id, name, timestamp, change_amount, new_balance) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    self.history,
+                )
+                _fold_into_rollups(c, self.history)
+            if self.learned:
+                c.executemany(
+                    "UPDATE apis SET learned_path=? WHERE id=?",
+                    [(p, api_id) for api_id, p in self.learned.items()],
+                )
+            if self.failures:
+                c.executemany(
+                    f"UPDATE apis SET last_error=?, last_error_at=?, breaker_state=?, {err_sets} WHERE id=?",
+                    [
+                        (f["last_error"], f["last_error_at"], f["breaker_state"],
+                         *[f[k] for k in FAILURE_KINDS], api_id)
+                        for api_id, f in self.failures.items()
+                    ],
+                )
+            if self.breaker_states:
+                c.executemany(
+                    "UPDATE apis SET breaker_state=? WHERE id=?",
+                    [(st, api_id) for api_id, st in self.breaker_states.items()],
+                )
+            if self.settings:
+                c.executemany(
+                    "INSERT INTO settings (key, value) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                    list(self.settings.items()),
+                )
+                if any(k not in VOLATILE_SETTINGS for k in self.settings):
+                    _bump_version(c, "settings")
+            # Lỗi / breaker (cột trong API_HEALTH_COLUMNS) không đổi version: cache "apis" chỉ nạp lại khi
+            # số dư hoặc đường dẫn đã học đổi
+            if self.states or self.learned:
+                _bump_version(c, "apis")
+            if self.notifications:
+                _insert_notifications(c, self.notifications)
+        if self.notifications:
+            notifier.wake()
+        self.rows_written += (len(self.states) + len(self.history) + len(self.learned)
+                              + len(self.failures) + len(self.breaker_states) + len(self.settings)
+                              + len(self.notifications))
+        self.flushes += 1
+        self.last_flush = time.monotonic()
+        self._reset()
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "interval": self.interval,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "pending_states": len(self.states),
+            "pending_history": len(self.history),
+        }
+
+write_buffer = WriteBuffer(DB_FLUSH_INTERVAL)
+
+def outbox_rows(tokens: List[str], chat_id: str, text: str, kind: str,
+                payload: Dict[str, Any], key: str, delay: float = 0.0) -> List[tuple]:
+    """Dòng notification_outbox cho mỗi bot; idem_key suy ra từ `key` nên phát hiện lại cùng 1 sự kiện không tạo tin mới.
+
+    `delay` > 0: hoãn gửi để gom các biến động tiếp theo của cùng chat vào 1 tin tổng hợp.
+    """
+    now = time.time()
+    body = json.dumps(payload, ensure_ascii=False)
+    rows = []
+    for token in tokens:
+        token = (token or "").strip()
+        if chat_id and token:
+            idem = hashlib.blake2b(f"{key}|{chat_id}|{token}".encode("utf-8"), digest_size=16).hexdigest()
+            rows.append((idem, kind, chat_id, token, text, body, now, now + delay))
+    return rows
+
+def _insert_notifications(c: sqlite3.Connection, rows: List[tuple]):
+    c.executemany(
+        "INSERT OR IGNORE INTO notification_outbox "
+        "(idem_key, kind, chat_id, bot_token, text, payload, created_at, next_attempt_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+
+def claim_notifications(owner: str, limit: int, now: Optional[float] = None) -> List[Dict[str, Any]]:
+    """Nhận quyền gửi tối đa `limit` tin đến hạn (hoặc bị process khác bỏ dở quá NOTIFY_CLAIM_TTL)"""
+    now = time.time() if now is None else now
+    due_sql = ("FROM notification_outbox WHERE (status='pending' AND next_attempt_at<=?) "
+               "OR (status='sending' AND claimed_until<?)")
+    with db.read() as c:
+        if c.execute(f"SELECT 1 {due_sql} LIMIT 1", (now, now)).fetchone() is None:
+            return []
+    # Chọn + đánh dấu trong cùng 1 transaction ghi -> 2 process không nhận trùng 1 tin
+    with db.write() as c:
+        rows = [dict(r) for r in c.execute(f"SELECT * {due_sql} ORDER BY id LIMIT ?", (now, now, limit)).fetchall()]
+        # Tin biến động đến hạn kéo theo các tin biến động chưa đến hạn của cùng chat / bot -> gộp 1 tin
+        kinds = ", ".join("?" * len(COALESCE_KINDS))
+        taken = {r["id"] for r in rows}
+        for chat_id, token in {(r["chat_id"], r["bot_token"]) for r in rows if r["kind"] in COALESCE_KINDS}:
+            extra = c.execute(
+                f"SELECT * FROM notification_outbox WHERE status='pending' AND kind IN ({kinds}) "
+                "AND chat_id=? AND bot_token=? AND next_attempt_at>? ORDER BY id",
+                (*COALESCE_KINDS, chat_id, token, now),
+            ).fetchall()
+            rows.extend(dict(r) for r in extra if r["id"] not in taken)
+        c.executemany(
+            "UPDATE notification_outbox SET status='sending', claimed_by=?, claimed_until=?, attempts=attempts+1 "
+            "WHERE id=?",
+            [(owner, now + NOTIFY_CLAIM_TTL, r["id"]) for r in rows],
+        )
+    for r in rows:
+        r["attempts"] += 1
+    return rows
+
+def complete_notifications(owner: str, results: List[tuple]):
+    """results: (id, status, next_attempt_at, last_error, sent_at); bỏ qua tin đã bị process khác nhận lại"""
+    with db.write() as c:
+        c.executemany(
+            "UPDATE notification_outbox SET status=?, next_attempt_at=?, last_error=?, sent_at=?, "
+            "claimed_by=NULL, claimed_until=NULL WHERE id=? AND claimed_by=?",
+            [(st, nxt, err, sent, nid, owner) for nid, st, nxt, err, sent in results],
+        )
+
+def defer_notifications(owner: str, deferred: List[Tuple[int, float]]):
+    """deferred: (id, next_attempt_at) - trả tin về hàng chờ vì bot hết quota, không tính là 1 lần thử"""
+    with db.write() as c:
+        c.executemany(
+            "UPDATE notification_outbox SET status='pending', next_attempt_at=?, attempts=max(attempts-1, 0), "
+            "claimed_by=NULL, claimed_until=NULL WHERE id=? AND claimed_by=?",
+            [(due, nid, owner) for nid, due in deferred],
+        )
+
+def extend_claim(owner: str, ids: List[int], now: Optional[float] = None) -> bool:
+    """Gia hạn quyền gửi ngay trước khi gửi; False nếu có tin đã bị process khác nhận lại (không được gửi nữa)"""
+    if not ids:
+        return True
+    now = time.time() if now is None else now
+    with db.write() as c:
+        cur = c.execute(
+            f"UPDATE notification_outbox SET claimed_until=? WHERE id IN ({','.join('?' * len(ids))}) "
+            "AND status='sending' AND claimed_by=?",
+            (now + NOTIFY_CLAIM_TTL, *ids, owner),
+        )
+        return cur.rowcount == len(ids)
+
+def enqueue_email_db(to_email: str, subject: str, html_body: str):
+    now = time.time()
+    with db.write() as c:
+        c.execute(
+            "INSERT INTO email_outbox (to_email, subject, html, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+            (to_email, subject, html_body, now, now),
+        )
+
+def claim_email(now: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """Email đến hạn sớm nhất (hoặc đang gửi dở quá EMAIL_CLAIM_TTL); đánh dấu đang gửi"""
+    now = time.time() if now is None else now
+    due_sql = ("FROM email_outbox WHERE (status='pending' AND next_attempt_at<=?) "
+               "OR (status='sending' AND next_attempt_at<?)")
+    with db.read() as c:
+        if c.execute(f"SELECT 1 {due_sql} LIMIT 1", (now, now)).fetchone() is None:
+            return None
+    with db.write() as c:
+        row = c.execute(f"SELECT * {due_sql} ORDER BY next_attempt_at, id LIMIT 1", (now, now)).fetchone()
+        if row is None:
+            return None
+        c.execute(
+            "UPDATE email_outbox SET status='sending', attempts=attempts+1, next_attempt_at=? WHERE id=?",
+            (now + EMAIL_CLAIM_TTL, row["id"]),
+        )
+    job = dict(row)
+    job["attempts"] += 1
+    return job
+
+def complete_email(email_id: int, status: str, next_attempt_at: float, error: Optional[str]):
+    with db.write() as c:
+        c.execute(
+            "UPDATE email_outbox SET status=?, next_attempt_at=?, last_error=?, sent_at=? WHERE id=?",
+            (status, next_attempt_at, error, time.time() if status == "sent" else None, email_id),
+        )
+
+def email_counts() -> Dict[str, int]:
+    with db.read() as c:
+        rows = c.execute("SELECT status, COUNT(*) FROM email_outbox GROUP BY status").fetchall()
+    return {st: n for st, n in rows}
+
+def outbox_counts() -> Dict[str, int]:
+    with db.read() as c:
+        rows = c.execute("SELECT status, COUNT(*) FROM notification_outbox GROUP BY status").fetchall()
+    return {st: n for st, n in rows}
+
+def prune_outbox(keep_days: float = NOTIFY_OUTBOX_KEEP_DAYS) -> int:
+    cutoff = time.time() - keep_days * 86400
+    with db.write() as c:
+        cur = c.execute(
+            "DELETE FROM notification_outbox WHERE status IN ('sent', 'failed') AND created_at<?", (cutoff,),
+        )
+        removed = cur.rowcount
+        cur = c.execute("DELETE FROM email_outbox WHERE status IN ('sent', 'failed') AND created_at<?", (cutoff,))
+        return removed + cur.rowcount
+
+def acquire_watcher_lease(owner: str, now: float) -> bool:
+    """Giành hoặc gia hạn lease watcher; True nếu `owner` đang là leader"""
+    with db.write() as c:
+        cur = c.execute(
+            "UPDATE watcher_lease SET "
+            "acquired_at=CASE WHEN owner=? THEN acquired_at ELSE ? END, "
+            "owner=?, heartbeat_at=?, expires_at=? "
+            "WHERE name='watcher' AND (owner=? OR owner IS NULL OR expires_at < ?)",
+            (owner, now, owner, now, now + LEASE_TTL, owner, now),
+        )
+        ok = cur.rowcount == 1
+    return ok
+
+def release_watcher_lease(owner: str):
+    with db.write() as c:
+        c.execute("UPDATE watcher_lease SET owner=NULL, expires_at=0 WHERE name='watcher' AND owner=?", (owner,))
+
+def get_watcher_lease() -> Dict[str, Any]:
+    with db.read() as c:
+        row = c.execute("SELECT * FROM watcher_lease WHERE name='watcher'").fetchone()
+    return dict(row) if row else {}
 
 def wipe_table(table: str):
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
+    with db.write() as c:
         c.execute(f"DELETE FROM {table}")
-        conn.commit()
-        conn.close()
+        _bump_version(c, *[name for name, t in CACHED_TABLES.items() if t == table])
 
 # =========================
 # UTIL BALANCE
@@ -759,6 +2202,9 @@ def _get_by_path(data: Any, path: str) -> Any:
     for part in str(path).split("."):
         if isinstance(cur, dict):
             cur = cur.get(part)
+        elif isinstance(cur, list) and part.isdigit():
+            idx = int(part)
+            cur = cur[idx] if idx < len(cur) else None
         else:
             return None
     return cur
@@ -777,26 +2223,35 @@ def _parse_float_like(val: Any) -> Optional[float]:
     except Exception:
         return None
 
-def _search_balance_recursive(data: Any) -> Optional[float]:
+def _search_balance_path(data: Any, path: tuple = ()) -> Tuple[Optional[float], Optional[tuple]]:
     if isinstance(data, dict):
         for k, v in data.items():
             key = k.lower()
             if any(x in key for x in ["bal", "sodu", "so_du", "money", "credit"]):
                 num = _parse_float_like(v)
                 if num is not None:
-                    return num
-        for v in data.values():
-            found = _search_balance_recursive(v)
+                    return num, path + (k,)
+        for k, v in data.items():
+            found, found_path = _search_balance_path(v, path + (k,))
             if found is not None:
-                return found
+                return found, found_path
     elif isinstance(data, list):
-        for item in data:
-            found = _search_balance_recursive(item)
+        for i, item in enumerate(data):
+            found, found_path = _search_balance_path(item, path + (str(i),))
             if found is not None:
-                return found
-    return None
+                return found, found_path
+    return None, None
+
+def _search_balance_recursive(data: Any) -> Optional[float]:
+    return _search_balance_path(data)[0]
+
+def resolve_balance(data: Any, balance_field: str, learned_path: str = "") -> Tuple[Optional[float], Optional[str]]:
+    """Trả về (số dư, đường dẫn dạng "a.b.0.c") - thử đường dẫn đã học trước, rồi mới dò lại"""
+    if learned_path:
+        num = _parse_float_like(_get_by_path(data, learned_path))
+        if num is not None:
+            return num, learned_path
 
-def extract_balance_auto(data: Any, balance_field: str) -> Optional[float]:
     candidates: List[str] = []
     if balance_field:
         candidates.append(balance_field.strip())
@@ -823,275 +2278,2019 @@ def extract_balance_auto(data: Any, balance_field: str) -> Optional[float]:
         val = _get_by_path(data, p)
         num = _parse_float_like(val)
         if num is not None:
-            return num
-    return _search_balance_recursive(data)
+            return num, p
+
+    num, found_path = _search_balance_path(data)
+    if num is None:
+        return None, None
+    # Key chứa dấu "." không biểu diễn được bằng đường dẫn chấm -> không học
+    if any("." in str(part) for part in found_path):
+        return num, None
+    return num, ".".join(found_path)
+
+def extract_balance_auto(data: Any, balance_field: str) -> Optional[float]:
+    return resolve_balance(data, balance_field)[0]
+
+# =========================
+# STREAMING JSON (DỪNG SỚM KHI ĐÃ THẤY SỐ DƯ)
+# =========================
+class ResponseTooLarge(Exception):
+    pass
+
+_JSON_TOKEN_RE = re.compile(
+    r'\s*(?:([{}\[\]:,])|("(?:[^"\\]|\\.)*")|(-?[0-9][0-9.eE+-]*|true|false|null))'
+)
+
+class JsonPathScanner:
+    """Tokenizer JSON tăng dần: nạp từng đoạn text, trả về giá trị scalar tại `target_path`
+    ngay khi đọc tới nó mà không cần dựng cả document."""
+
+    def __init__(self, target_path: str):
+        self.target = tuple(p for p in target_path.split(".") if p)
+        self.buf = ""
+        # Mỗi frame: [loại "obj"/"arr", key hoặc chỉ số hiện tại, trạng thái]
+        self.stack: List[list] = []
+        self.top_done = False
+        self.hasher = hashlib.blake2b(digest_size=16)
+
+    def _path(self) -> tuple:
+        return tuple(str(f[1]) for f in self.stack)
+
+    def _after_value(self):
+        if self.stack:
+            self.stack[-1][2] = "comma_or_end"
+        else:
+            self.top_done = True
+
+    def feed(self, text: str, final: bool = False) -> Tuple[bool, Any]:
+        """Trả về (found, value); raise ValueError nếu JSON hỏng"""
+        self.buf += text
+        pos = 0
+        found, value = False, None
+        while not self.top_done:
+            m = _JSON_TOKEN_RE.match(self.buf, pos)
+            if m is None or m.end() == pos:
+                if self.buf[pos:].strip() and final:
+                    raise ValueError("JSON không hợp lệ")
+                break
+            punct, string, scalar = m.groups()
+            # Số / literal chạm cuối buffer có thể chưa đọc hết
+            if scalar is not None and m.end() == len(self.buf) and not final:
+                break
+            frame = self.stack[-1] if self.stack else None
+            state = frame[2] if frame else "value"
+            if punct in ("{", "["):
+                if state not in ("value", "value_or_end"):
+                    raise ValueError("JSON không hợp lệ")
+                if frame is not None:
+                    frame[2] = "child"
+                self.stack.append(["obj", None, "key_or_end"] if punct == "{" else ["arr", 0, "value_or_end"])
+            elif punct in ("}", "]"):
+                if frame is None or (punct == "}") != (frame[0] == "obj"):
+                    raise ValueError("JSON không hợp lệ")
+                self.stack.pop()
+                self._after_value()
+            elif punct == ":":
+                if state != "colon":
+                    raise ValueError("JSON không hợp lệ")
+                frame[2] = "value"
+            elif punct == ",":
+                if state != "comma_or_end":
+                    raise ValueError("JSON không hợp lệ")
+                if frame[0] == "obj":
+                    frame[2] = "key"
+                else:
+                    frame[1] += 1
+                    frame[2] = "value"
+            elif string is not None and state in ("key_or_end", "key"):
+                frame[1] = json.loads(string)
+                frame[2] = "colon"
+            else:
+                if state not in ("value", "value_or_end"):
+                    raise ValueError("JSON không hợp lệ")
+                if len(self.stack) == len(self.target) and self._path() == self.target:
+                    found, value = True, json.loads(string if string is not None else scalar)
+                self._after_value()
+            pos = m.end()
+            if found:
+                break
+        self.hasher.update(self.buf[:pos].encode("utf-8", "surrogatepass"))
+        self.buf = self.buf[pos:]
+        return found, value
+
+def read_body_capped(resp: requests.Response, max_bytes: int) -> bytes:
+    length = resp.headers.get("Content-Length")
+    if length and length.isdigit() and int(length) > max_bytes:
+        raise ResponseTooLarge(f"response {length} bytes > giới hạn {max_bytes}")
+    chunks = []
+    total = 0
+    for chunk in resp.iter_content(STREAM_CHUNK_SIZE):
+        total += len(chunk)
+        if total > max_bytes:
+            raise ResponseTooLarge(f"response > giới hạn {max_bytes} bytes")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+def stream_balance(resp: requests.Response, target_path: str, max_bytes: int) -> Dict[str, Any]:
+    """Đọc body theo từng chunk; dừng ngay khi thấy `target_path` mang giá trị số.
+
+    Trả về {"found", "value", "digest"} nếu dừng sớm, hoặc {"found": False, "body": bytes}
+    khi đọc hết mà không thấy / giá trị null, không phải số (để parse đầy đủ và dò lại đường dẫn).
+    """
+    length = resp.headers.get("Content-Length")
+    if length and length.isdigit() and int(length) > max_bytes:
+        raise ResponseTooLarge(f"response {length} bytes > giới hạn {max_bytes}")
+    scanner = JsonPathScanner(target_path)
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    chunks = []
+    total = 0
+    scanning = True
+    for chunk in resp.iter_content(STREAM_CHUNK_SIZE):
+        total += len(chunk)
+        if total > max_bytes:
+            raise ResponseTooLarge(f"response > giới hạn {max_bytes} bytes")
+        chunks.append(chunk)
+        if not scanning:
+            continue
+        try:
+            found, value = scanner.feed(decoder.decode(chunk))
+        except ValueError:
+            # JSON hỏng: đọc nốt để bước parse đầy đủ báo lỗi như bình thường
+            scanning = False
+            continue
+        if found:
+            if _parse_float_like(value) is not None:
+                return {"found": True, "value": value, "digest": scanner.hasher.hexdigest()}
+            # Đường dẫn còn đó nhưng không còn là số dư (API đổi cấu trúc): đọc hết để dò lại
+            scanning = False
+    return {"found": False, "body": b"".join(chunks)}
+
+# =========================
+# SAMPLE STORE (CHUỖI SỐ DƯ ĐẦY ĐỦ)
+# =========================
+class SampleStore:
+    """Ghi nối (append-only) mỗi lần quét vào SAMPLES_DIR/<api_id>/<YYYYMMDD>.seg, bản ghi cố định SAMPLE_RECORD.
+
+    Chỉ thread watcher ghi; đọc bằng mmap + tìm nhị phân theo thời điểm (bản ghi trong 1 file
+    tăng dần theo thời gian). Bản ghi dở dang cuối file (crash giữa chừng) bị bỏ qua khi đọc.
+    """
+
+    def __init__(self, root: str, enabled: bool):
+        self.root = root
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.files: Dict[int, Tuple[str, Any]] = {}
+        self.records = 0
+        self.errors = 0
+        self.last_error: Optional[str] = None
+
+    def _segment_path(self, api_id: int, day: str) -> str:
+        return os.path.join(self.root, str(int(api_id)), f"{day}.seg")
+
+    def append(self, api_id: int, ts: float, balance: Optional[float], latency: float, status: str):
+        if not self.enabled:
+            return
+        day = datetime.utcfromtimestamp(ts).strftime("%Y%m%d")
+        code = SAMPLE_STATUSES.index(status) if status in SAMPLE_STATUSES else len(SAMPLE_STATUSES) - 1
+        record = SAMPLE_RECORD.pack(ts, float("nan") if balance is None else balance, latency * 1000, code)
+        with self.lock:
+            current = self.files.get(api_id)
+            if current is None or current[0] != day:
+                if current is not None:
+                    current[1].close()
+                path = self._segment_path(api_id, day)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                current = (day, open(path, "ab"))
+                self.files[api_id] = current
+            current[1].write(record)
+            self.records += 1
+
+    def flush(self):
+        with self.lock:
+            for _, f in self.files.values():
+                f.flush()
+
+    def close(self, api_id: Optional[int] = None):
+        with self.lock:
+            for key in ([api_id] if api_id is not None else list(self.files)):
+                current = self.files.pop(key, None)
+                if current is not None:
+                    current[1].close()
+
+    def drop(self, api_id: int):
+        self.close(api_id)
+        shutil.rmtree(os.path.join(self.root, str(int(api_id))), ignore_errors=True)
+
+    def drop_except(self, api_ids: set) -> int:
+        """Xoá thư mục mẫu của các API không còn tồn tại (bị xoá khi process này chưa làm watcher)"""
+        if not os.path.isdir(self.root):
+            return 0
+        removed = 0
+        for api_dir in os.listdir(self.root):
+            if api_dir.isdigit() and int(api_dir) not in api_ids:
+                self.drop(int(api_dir))
+                removed += 1
+        return removed
+
+    def prune(self, retention_days: float, now: Optional[float] = None) -> int:
+        """Xoá các file segment của những ngày đã quá hạn giữ (không đụng file đang ghi)"""
+        if not os.path.isdir(self.root):
+            return 0
+        cutoff = datetime.utcfromtimestamp((now or time.time()) - retention_days * 86400).strftime("%Y%m%d")
+        with self.lock:
+            open_paths = {self._segment_path(api_id, day) for api_id, (day, _) in self.files.items()}
+        removed = 0
+        for api_dir in os.listdir(self.root):
+            folder = os.path.join(self.root, api_dir)
+            if not os.path.isdir(folder):
+                continue
+            for fname in os.listdir(folder):
+                path = os.path.join(folder, fname)
+                if fname.endswith(".seg") and fname[:-4] < cutoff and path not in open_paths:
+                    os.remove(path)
+                    removed += 1
+        return removed
+
+    def read(self, api_id: int, since: Optional[float] = None, until: Optional[float] = None,
+             limit: int = SAMPLES_LIMIT_MAX) -> List[Tuple[float, Optional[float], float, str]]:
+        """Mẫu cũ nhất trước trong [since, until): (epoch, số dư hoặc None, độ trễ ms, trạng thái)"""
+        folder = os.path.join(self.root, str(int(api_id)))
+        if not os.path.isdir(folder):
+            return []
+        self.flush()
+        first = datetime.utcfromtimestamp(since).strftime("%Y%m%d") if since is not None else ""
+        last = datetime.utcfromtimestamp(until).strftime("%Y%m%d") if until is not None else "99999999"
+        size = SAMPLE_RECORD.size
+        out: List[Tuple[float, Optional[float], float, str]] = []
+        for fname in sorted(os.listdir(folder)):
+            if not fname.endswith(".seg") or not (first <= fname[:-4] <= last):
+                continue
+            with open(os.path.join(folder, fname), "rb") as f:
+                n = os.fstat(f.fileno()).st_size // size
+                if n == 0:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    lo, hi = 0, n
+                    if since is not None:
+                        while lo < hi:
+                            mid = (lo + hi) // 2
+                            if SAMPLE_RECORD.unpack_from(mm, mid * size)[0] < since:
+                                lo = mid + 1
+                            else:
+                                hi = mid
+                    for i in range(lo, n):
+                        ts, balance, latency_ms, code = SAMPLE_RECORD.unpack_from(mm, i * size)
+                        if until is not None and ts >= until:
+                            break
+                        out.append((ts, None if balance != balance else balance, latency_ms,
+                                    SAMPLE_STATUSES[code] if code < len(SAMPLE_STATUSES) else "internal"))
+                        if len(out) >= limit:
+                            return out
+        return out
+
+    def record_error(self, e: Exception):
+        """Lỗi ghi file mẫu (đầy đĩa, quyền...): đếm và log khi lỗi đổi, không để lan ra watcher"""
+        self.errors += 1
+        message = f"{type(e).__name__}: {e}"
+        if message != self.last_error:
+            print(f"!! Lỗi ghi sample store: {message}")
+        self.last_error = message
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "open_segments": len(self.files), "records_written": self.records,
+                "errors": self.errors, "last_error": self.last_error}
+
+sample_store = SampleStore(SAMPLES_DIR, SAMPLE_STORE_ENABLED)
+
+# =========================
+# TELEGRAM (HÀNG ĐỢI GỬI NỀN)
+# =========================
+def deliver_telegram(token: str, chat_id: str, text: str) -> Tuple[str, Optional[float], Optional[str]]:
+    """Gửi 1 tin qua 1 bot: (trạng thái, retry_after giây nếu bị 429, mô tả lỗi).
+
+    Trạng thái: "ok" | "retry" (lỗi tạm thời) | "revoked" (401, token hỏng) |
+    "blocked" (403, bot bị chặn / bị kick khỏi chat) | "fail" (lỗi khác, gửi lại cũng vô ích).
+    """
+    url = f"https://api.telegram.org/bot{token}/sendMessage"
+    try:
+        resp = http_pool.post(
+            url,
+            data={"chat_id": chat_id, "text": text, "parse_mode": "HTML"},
+            timeout=(HTTP_CONNECT_TIMEOUT, 10),
+        )
+    except requests.RequestException as e:
+        return "retry", None, str(e)
+    if resp.status_code == 200:
+        return "ok", None, None
+    try:
+        payload = resp.json()
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict):
+        payload = {}
+    error = payload.get("description") or f"HTTP {resp.status_code}"
+    if resp.status_code == 429:
+        params = payload.get("parameters") if isinstance(payload.get("parameters"), dict) else {}
+        retry_after = to_float(str(params.get("retry_after") or resp.headers.get("Retry-After") or ""), None)
+        return "retry", retry_after, error
+    if resp.status_code >= 500:
+        return "retry", None, error
+    if resp.status_code == 401:
+        return "revoked", None, error
+    if resp.status_code == 403:
+        return "blocked", None, error
+    return "fail", None, error
+
+class BotPool:
+    """Các bot Telegram là 1 pool gửi: mỗi tin đi qua đúng 1 bot, thêm bot = tăng thông lượng.
+
+    Mỗi bot có token bucket tổng (TELEGRAM_BOT_RATE) và theo từng chat (TELEGRAM_CHAT_RATE); bucket nằm trong RAM
+    nhưng dispatcher chỉ chạy ở process leader nên đó là giới hạn của cả hệ thống, không nhân theo số worker.
+    Chọn bot đang ít việc nhất (least_loaded) hoặc xoay vòng (round_robin) trong số bot gửi được ngay.
+    """
+
+    def __init__(self, strategy: str):
+        self.strategy = strategy if strategy in ("least_loaded", "round_robin") else "least_loaded"
+        self.lock = threading.Lock()
+        self.bots: Dict[str, Dict[str, Any]] = {}
+        self.rr = 0
+
+    def _state(self, token: str) -> Dict[str, Any]:
+        st = self.bots.get(token)
+        if st is None:
+            st = {
+                "bucket": TokenBucket(TELEGRAM_BOT_RATE, TELEGRAM_BOT_RATE),
+                "chats": {},
+                "in_flight": 0,
+                "sent": 0,
+                "errors": 0,
+                "disabled_until": 0.0,
+                "blocked": {},
+                "last_error": None,
+            }
+            self.bots[token] = st
+        return st
+
+    def _chat_bucket(self, st: Dict[str, Any], chat_id: str) -> "TokenBucket":
+        if chat_id not in st["chats"]:
+            st["chats"][chat_id] = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+        return st["chats"][chat_id]
+
+    def acquire(self, chat_id: str, token: Optional[str] = None, exclude: Optional[set] = None) -> Tuple[Optional[str], float]:
+        """Chọn bot (hoặc dùng `token` cố định) và trừ quota: (token, 0) nếu gửi được ngay,
+        (None, số giây nên chờ) nếu mọi bot đang hết quota, (None, -1) nếu không còn bot nào dùng được.
+        """
+        candidates = [token] if token else [b["bot_token"] for b in get_bots()]
+        now = time.time()
+        with self.lock:
+            usable = []
+            for t in candidates:
+                st = self._state(t)
+                if (exclude and t in exclude) or st["disabled_until"] > now or st["blocked"].get(chat_id, 0) > now:
+                    continue
+                usable.append(t)
+            if not usable:
+                return None, -1.0
+            if self.strategy == "round_robin":
+                k = self.rr % len(usable)
+                usable = usable[k:] + usable[:k]
+                self.rr += 1
+            else:
+                usable.sort(key=lambda t: (self.bots[t]["in_flight"], self.bots[t]["sent"]))
+            best_wait = None
+            for t in usable:
+                st = self.bots[t]
+                chat_bucket = self._chat_bucket(st, chat_id)
+                wait = max(st["bucket"].wait_time(), chat_bucket.wait_time())
+                if wait <= 0 and st["bucket"].try_take() and chat_bucket.try_take():
+                    st["in_flight"] += 1
+                    return t, 0.0
+                best_wait = wait if best_wait is None else min(best_wait, wait)
+            return None, max(best_wait or 0.0, 0.01)
+
+    def release(self, token: str, chat_id: str, status: str, error: Optional[str]):
+        with self.lock:
+            st = self._state(token)
+            st["in_flight"] = max(0, st["in_flight"] - 1)
+            if status == "ok":
+                st["sent"] += 1
+                return
+            st["errors"] += 1
+            st["last_error"] = error
+            if status == "revoked":
+                st["disabled_until"] = time.time() + BOT_DISABLE_SECONDS
+            elif status == "blocked":
+                st["blocked"][chat_id] = time.time() + BOT_DISABLE_SECONDS
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        with self.lock:
+            return {
+                "strategy": self.strategy,
+                "bots": {
+                    f"..{t[-6:]}": {
+                        "sent": st["sent"],
+                        "errors": st["errors"],
+                        "in_flight": st["in_flight"],
+                        "disabled": st["disabled_until"] > now,
+                        "blocked_chats": sum(1 for until in st["blocked"].values() if until > now),
+                        "last_error": st["last_error"],
+                    }
+                    for t, st in self.bots.items()
+                },
+            }
+
+bot_pool = BotPool(BOT_POOL_STRATEGY)
+
+def render_digest(rows: List[Dict[str, Any]]) -> List[str]:
+    """Tin tổng hợp cho nhiều biến động: mỗi API 1 dòng (tổng biến động, số lần, số dư cuối), chia theo TELEGRAM_MAX_CHARS"""
+    return [text for text, _ in _digest_parts(rows)]
+
+def _digest_parts(rows: List[Dict[str, Any]]) -> List[Tuple[str, List[int]]]:
+    """Các phần của tin tổng hợp kèm id dòng outbox mà mỗi phần đã nói tới (1 API nằm trọn trong 1 phần)"""
+    per_api: Dict[Any, Dict[str, Any]] = {}
+    times = []
+    for r in rows:
+        try:
+            p = json.loads(r.get("payload") or "{}")
+        except ValueError:
+            p = {}
+        key = p.get("api_id", r["id"])
+        agg = per_api.setdefault(key, {"name": p.get("api_name") or f"#{key}", "net": 0.0, "count": 0,
+                                       "final": None, "ids": []})
+        agg["ids"].append(r["id"])
+        agg["net"] += float(p.get("diff") or 0)
+        agg["count"] += 1
+        if p.get("new_balance") is not None:
+            agg["final"] = float(p["new_balance"])
+        dt = parse_iso_utc(p.get("at") or "")
+        if dt:
+            times.append(dt)
+    lines = []
+    for agg in per_api.values():
+        sign = "+" if agg["net"] >= 0 else "-"
+        line = f"• <b>{agg['name']}</b>: {sign}{fmt_amount(abs(agg['net']))} ({agg['count']} lần)"
+        if agg["final"] is not None:
+            line += f" → <b>{fmt_amount(agg['final'])}</b>"
+        lines.append((line, agg["ids"]))
+    footer = ""
+    if times:
+        footer = f"\nThời gian: {fmt_time_label_vn(min(times))} → {fmt_time_label_vn(max(times))}"
+    title = f"📊 <b>TỔNG HỢP BIẾN ĐỘNG</b> ({len(rows)} thay đổi, {len(per_api)} API)"
+    # Chừa chỗ cho hậu tố " (i/n)" và footer
+    budget = TELEGRAM_MAX_CHARS - len(title) - len(footer) - 16
+    chunks: List[List[Tuple[str, List[int]]]] = [[]]
+    size = 0
+    for line, ids in lines:
+        line = line[:budget]
+        if chunks[-1] and size + len(line) + 1 > budget:
+            chunks.append([])
+            size = 0
+        chunks[-1].append((line, ids))
+        size += len(line) + 1
+    parts = []
+    for i, chunk in enumerate(chunks, 1):
+        suffix = f" ({i}/{len(chunks)})" if len(chunks) > 1 else ""
+        text = f"{title}{suffix}\n\n" + "\n".join(line for line, _ in chunk) + footer
+        parts.append((text, [nid for _, ids in chunk for nid in ids]))
+    return parts
+
+def coalesce_notifications(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Gom các dòng outbox đã nhận thành job gửi: biến động cùng chat / bot -> 1 tin tổng hợp, còn lại giữ nguyên.
+
+    "part_ids"[i] = id các dòng mà phần thứ i nói tới: gửi dở thì chỉ các dòng của phần chưa gửi được thử lại.
+    """
+    jobs: List[Dict[str, Any]] = []
+    groups: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+    for r in rows:
+        if r["kind"] in COALESCE_KINDS:
+            groups.setdefault((r["chat_id"], r["bot_token"]), []).append(r)
+        else:
+            groups[("", str(r["id"]))] = [r]
+    for group in groups.values():
+        group.sort(key=lambda r: r["id"])
+        first = group[0]
+        parts = [(first["text"], [first["id"]])] if len(group) == 1 else _digest_parts(group)
+        jobs.append({
+            "rows": group,
+            "chat_id": first["chat_id"],
+            "bot_token": first["bot_token"],
+            "parts": [text for text, _ in parts],
+            "part_ids": [ids for _, ids in parts],
+            "attempts": max(r["attempts"] for r in group),
+            "created_at": min(r["created_at"] for r in group),
+        })
+    return jobs
+
+class NotificationDispatcher:
+    """Gửi Telegram chạy nền từ bảng notification_outbox.
+
+    1 thread nhận (claim) từng lô tin đến hạn và ghi kết quả theo lô; NOTIFY_WORKERS thread gửi.
+    Chỉ process đang giữ lease watcher mới nhận tin; quyền gửi được gia hạn ngay trước mỗi lần gửi.
+    Lỗi tạm thời được hẹn lại theo backoff mũ, riêng HTTP 429 chờ đúng retry_after Telegram trả về.
+    Bot hết quota: tin được trả về outbox với next_attempt_at (không ngủ giữ chỗ trên thread gửi).
+    Process chết giữa chừng: tin đang giữ được process khác lấy lại sau NOTIFY_CLAIM_TTL.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self.jobs: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self.results: List[tuple] = []
+        self.deferred: List[Tuple[int, float]] = []
+        self.next_due: Optional[float] = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pid: Optional[int] = None
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.quota_deferred = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.last_error: Optional[str] = None
+
+    def start(self):
+        # Sau fork (gunicorn) thread cũ không còn -> khởi động lại trong process mới
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        threading.Thread(target=self._pump, daemon=True, name="notify-pump").start()
+        for i in range(self.workers):
+            threading.Thread(target=self._run, daemon=True, name=f"notify-{i}").start()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def _write_results(self):
+        with self.lock:
+            results, self.results = self.results, []
+            deferred, self.deferred = self.deferred, []
+        if results:
+            try:
+                complete_notifications(WATCHER_ID, results)
+            except Exception:
+                with self.lock:
+                    self.results = results + self.results
+        if deferred:
+            try:
+                defer_notifications(WATCHER_ID, deferred)
+            except Exception:
+                with self.lock:
+                    self.deferred = deferred + self.deferred
+
+    def _idle_wait(self) -> float:
+        # Rảnh: chờ tới lúc tin bị hoãn vì hết quota đến hạn (nếu sớm hơn chu kỳ kiểm tra)
+        with self.lock:
+            due, self.next_due = self.next_due, None
+        if due is None:
+            return NOTIFY_POLL_INTERVAL
+        return min(NOTIFY_POLL_INTERVAL, max(0.05, due - time.time()))
+
+    def _pump(self):
+        while True:
+            self.wakeup.clear()
+            self._write_results()
+            claimed = []
+            # Chỉ leader nhận tin, và chỉ khi hàng đợi trong RAM gần hết
+            if watcher_is_leader and self.jobs.unfinished_tasks < self.workers:
+                try:
+                    claimed = claim_notifications(WATCHER_ID, NOTIFY_CLAIM_BATCH)
+                except Exception:
+                    claimed = []
+                for job in coalesce_notifications(claimed):
+                    self.jobs.put(job)
+            if not claimed:
+                self.wakeup.wait(self._idle_wait())
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            status, retry_after, error = "ok", None, None
+            fixed = None if job["bot_token"] == BOT_POOL_TOKEN else job["bot_token"]
+            exclude: set = set()
+            claimed_ids = [r["id"] for r in job["rows"]]
+            pending = list(claimed_ids)
+            delivered: List[int] = []
+            lost = False
+            # Tin tổng hợp dài: gửi lần lượt từng phần, dừng ở phần đầu tiên bị lỗi; phần đã gửi không gửi lại
+            for part, part_ids in zip(job["parts"], job["part_ids"]):
+                try:
+                    # Gia hạn cả các dòng đã gửi: chúng chỉ được ghi "sent" khi job kết thúc
+                    lost = not extend_claim(WATCHER_ID, claimed_ids)
+                except Exception as e:
+                    status, retry_after, error = "retry", None, str(e)
+                    break
+                if lost:
+                    # Đã quá hạn giữ và bị process khác nhận lại: để process đó gửi, không gửi trùng
+                    break
+                while True:
+                    token, wait = bot_pool.acquire(job["chat_id"], fixed, exclude)
+                    if token is None:
+                        if wait < 0:
+                            status, retry_after, error = "fail", None, error or "Không còn bot nào gửi được tới chat này"
+                        else:
+                            # Hết quota: trả phần chưa gửi về outbox, hẹn đúng lúc có token
+                            status, retry_after, error = "defer", wait, None
+                        break
+                    try:
+                        status, retry_after, error = deliver_telegram(token, job["chat_id"], part)
+                    except Exception as e:
+                        status, retry_after, error = "retry", None, str(e)
+                    bot_pool.release(token, job["chat_id"], status, error)
+                    if status in ("revoked", "blocked") and fixed is None:
+                        # Token bị thu hồi / bot bị chặn: chuyển sang bot khác trong pool
+                        exclude.add(token)
+                        continue
+                    break
+                if status != "ok":
+                    break
+                delivered.extend(part_ids)
+                sent_ids = set(part_ids)
+                pending = [nid for nid in pending if nid not in sent_ids]
+            if lost:
+                # Vẫn ghi các phần đã gửi (chỉ áp dụng cho dòng còn thuộc process này), phần còn lại
+                # để process đang giữ quyền gửi
+                self._finish(job, delivered, [], "lost", None, None)
+            else:
+                self._finish(job, delivered, pending, status, retry_after, error)
+            self.jobs.task_done()
+            self.wakeup.set()
+
+    def _finish(self, job: Dict[str, Any], delivered: List[int], pending: List[int], status: str,
+                retry_after: Optional[float], error: Optional[str]):
+        """delivered: dòng đã có trong phần gửi thành công; pending: dòng còn lại, xử lý theo `status`"""
+        now = time.time()
+        with self.lock:
+            self.results.extend((nid, "sent", now, None, now) for nid in delivered)
+            if status == "lost":
+                return
+            if status == "defer":
+                self.quota_deferred += 1
+                due = now + (retry_after or 0)
+                self.deferred.extend((nid, due) for nid in pending)
+                self.next_due = due if self.next_due is None else min(self.next_due, due)
+            elif status == "ok":
+                self.sent += 1
+                latency = now - job["created_at"]
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+            elif status == "retry" and job["attempts"] < NOTIFY_MAX_ATTEMPTS:
+                self.retries += 1
+                if retry_after is not None:
+                    self.rate_limited += 1
+                    delay = retry_after
+                else:
+                    delay = min(NOTIFY_RETRY_MAX, NOTIFY_RETRY_BASE * (2 ** (job["attempts"] - 1)))
+                    delay *= 1 + random.uniform(0, POLL_JITTER_RATIO)
+                self.results.extend((nid, "pending", now + delay, error, None) for nid in pending)
+            else:
+                self.failed += 1
+                self.last_error = error
+                self.results.extend((nid, "failed", now, error, None) for nid in pending)
+                print(f"!! Gửi Telegram thất bại sau {job['attempts']} lần (chat {job['chat_id']}): {error}")
+
+    def drain(self, timeout: float) -> bool:
+        """Chờ gửi xong các tin đã nhận và ghi kết quả (tối đa `timeout` giây); True nếu xong"""
+        deadline = time.monotonic() + timeout
+        while self.jobs.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        self._write_results()
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            out = {
+                "workers": self.workers,
+                "running": self.pid == os.getpid(),
+                "in_memory": self.jobs.unfinished_tasks,
+                "sent": self.sent,
+                "failed": self.failed,
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+                "quota_deferred": self.quota_deferred,
+                "avg_latency_ms": round(self.latency_total / self.sent * 1000, 1) if self.sent else None,
+                "max_latency_ms": round(self.latency_max * 1000, 1),
+                "last_error": self.last_error,
+            }
+        out["outbox"] = outbox_counts()
+        out["bot_pool"] = bot_pool.stats()
+        return out
+
+notifier = NotificationDispatcher(NOTIFY_WORKERS)
+
+def send_telegram(tokens: List[str], chat_id: str, text: str, kind: str = "manual",
+                  payload: Optional[Dict[str, Any]] = None):
+    """Ghi tin vào outbox (không chờ mạng), mỗi bot 1 dòng; process chạy watcher sẽ gửi"""
+    rows = outbox_rows(tokens, chat_id, text, kind, payload or {}, f"{kind}:{uuid.uuid4().hex}")
+    if not rows:
+        return
+    with db.write() as c:
+        _insert_notifications(c, rows)
+    notifier.wake()
+
+# =========================
+# QUY TẮC CẢNH BÁO
+# =========================
+def _parse_hhmm(value: str) -> Optional[int]:
+    # "HH:MM" -> số phút trong ngày
+    try:
+        h, m = (value or "").strip().split(":")[:2]
+        minutes = int(h) * 60 + int(m)
+    except (ValueError, TypeError):
+        return None
+    return minutes if 0 <= minutes < 24 * 60 else None
+
+class AlertRule:
+    """1 quy tắc đã biên dịch (chuỗi -> số, giờ yên lặng -> phút trong ngày).
+
+    threshold: báo khi số dư rơi xuống dưới ngưỡng; min_change: bỏ qua biến động nhỏ hơn;
+    max_rate: báo khi tốc độ biến động (đ/phút so với lần đổi trước) vượt ngưỡng;
+    giờ yên lặng (giờ VN) chỉ chặn tin biến động thường, không chặn cảnh báo ngưỡng / tốc độ.
+    """
+
+    __slots__ = ("id", "tag", "name", "api_id", "api_group", "threshold", "min_change", "max_rate",
+                 "quiet_start", "quiet_end", "chat_id", "bot_id")
+
+    def __init__(self, row: Dict[str, Any]):
+        self.id = row.get("id")
+        # Quy tắc mặc định (từ settings) giữ idem_key dạng cũ
+        self.tag = f"#{self.id}" if self.id is not None else ""
+        self.name = row.get("name") or ""
+        self.api_id = int(row["api_id"]) if row.get("api_id") is not None else None
+        self.api_group = (row.get("api_group") or "").strip()
+        self.threshold = float(row["threshold"]) if row.get("threshold") is not None else None
+        self.min_change = float(row.get("min_change") or 0)
+        self.max_rate = float(row["max_rate"]) if row.get("max_rate") else None
+        self.quiet_start = _parse_hhmm(row.get("quiet_start") or "")
+        self.quiet_end = _parse_hhmm(row.get("quiet_end") or "")
+        self.chat_id = (row.get("chat_id") or "").strip()
+        self.bot_id = int(row["bot_id"]) if row.get("bot_id") not in (None, "") else None
+
+    def is_quiet(self, minute_of_day: int) -> bool:
+        if self.quiet_start is None or self.quiet_end is None or self.quiet_start == self.quiet_end:
+            return False
+        if self.quiet_start < self.quiet_end:
+            return self.quiet_start <= minute_of_day < self.quiet_end
+        # Qua nửa đêm, VD 22:00 -> 07:00
+        return minute_of_day >= self.quiet_start or minute_of_day < self.quiet_end
+
+class RuleSet:
+    """Quy tắc đã biên dịch, đánh chỉ mục theo API id / nhóm: tra cứu mỗi API là O(1).
+
+    1 object dùng chung qua catalog_cache cho mọi thread: chỉ đọc, các danh sách quy tắc là tuple.
+    """
+
+    def __init__(self, rules: List[AlertRule]):
+        by_api: Dict[int, List[AlertRule]] = {}
+        by_group: Dict[str, List[AlertRule]] = {}
+        global_rules: List[AlertRule] = []
+        for rule in rules:
+            if rule.api_id is not None:
+                by_api.setdefault(rule.api_id, []).append(rule)
+            elif rule.api_group:
+                by_group.setdefault(rule.api_group, []).append(rule)
+            else:
+                global_rules.append(rule)
+        self.by_api: Dict[int, Tuple[AlertRule, ...]] = {k: tuple(v) for k, v in by_api.items()}
+        self.by_group: Dict[str, Tuple[AlertRule, ...]] = {k: tuple(v) for k, v in by_group.items()}
+        self.global_rules: Tuple[AlertRule, ...] = tuple(global_rules)
+        self.count = len(rules)
+
+    def rules_for(self, api: Dict[str, Any]) -> Tuple[AlertRule, ...]:
+        """Chỉ dùng phạm vi cụ thể nhất có quy tắc: API > nhóm > toàn bộ (quy tắc riêng thay thế quy tắc chung)"""
+        return (self.by_api.get(api["id"]) or self.by_group.get((api.get("api_group") or "").strip())
+                or self.global_rules)
+
+def _compile_rules() -> RuleSet:
+    return RuleSet([AlertRule(r) for r in get_alert_rules() if r.get("enabled")])
+
+def get_rule_set() -> RuleSet:
+    # Chỉ biên dịch lại khi bảng alert_rules đổi (version trong meta); object dùng chung, không sửa
+    return catalog_cache.get("rules", _compile_rules)
+
+def default_alert_rule(settings: Dict[str, Optional[str]]) -> AlertRule:
+    """Quy tắc ngầm định cho API không khớp quy tắc nào: default_chat_id + global_threshold như trước"""
+    return AlertRule({
+        "threshold": to_float(settings.get("global_threshold") or "", None),
+        "chat_id": settings.get("default_chat_id") or "",
+    })
+
+def _change_message(name: str, diff: float, new_balance: float, time_label: str) -> str:
+    if diff < 0:
+        return (
+            f"🔻 <b>THANH TOÁN THÀNH CÔNG</b> ({name})\n\n"
+            f"Nội dung: Thanh toán / trừ số dư\n"
+            f"Tổng trừ: <b>-{fmt_amount(abs(diff))}</b>\n"
+            f"Số dư cuối: <b>{fmt_amount(new_balance)}</b>\n"
+            f"Thời gian: {time_label}"
+        )
+    return (
+        f"💰 <b>NẠP TIỀN THÀNH CÔNG</b> ({name})\n\n"
+        f"Nội dung: Nạp tiền vào tài khoản\n"
+        f"Biến động: <b>+{fmt_amount(diff)}</b>\n"
+        f"Số dư cuối: <b>{fmt_amount(new_balance)}</b>\n"
+        f"Thời gian: {time_label}"
+    )
+
+def evaluate_alerts(events: List[Dict[str, Any]], rule_set: RuleSet, fallback: AlertRule,
+                    bots: List[Dict[str, Any]], default_tokens: List[str], coalesce: float = 0.0) -> List[tuple]:
+    """Duyệt 1 lượt mọi biến động của chu kỳ qua các quy tắc, trả về các dòng notification_outbox"""
+    tokens_by_bot = {b["id"]: b["bot_token"] for b in bots}
+    rows: List[tuple] = []
+    for ev in events:
+        api = ev["api"]
+        api_id, name = api["id"], api["name"]
+        old_balance, new_balance, diff = ev["old"], ev["new"], ev["diff"]
+        at = ev["at"]
+        at_iso = at.isoformat() + "Z"
+        local = at.replace(tzinfo=timezone.utc).astimezone(VN_TZ)
+        minute_of_day = local.hour * 60 + local.minute
+        prev_dt = parse_iso_utc(ev["prev_change"])
+        # Nhiều quy tắc cùng phạm vi trỏ về 1 chat: mỗi loại tin chỉ gửi 1 lần cho 1 biến động
+        emitted: set = set()
+        for rule in rule_set.rules_for(api) or (fallback,):
+            chat_id = rule.chat_id or fallback.chat_id
+            tokens = [tokens_by_bot[rule.bot_id]] if rule.bot_id in tokens_by_bot else default_tokens
+            if not chat_id or not tokens:
+                continue
+            key = f"{rule.tag}:{api_id}:{ev['prev_change']}"
+            if ((chat_id, "change") not in emitted and abs(diff) >= max(rule.min_change, 1e-9)
+                    and not rule.is_quiet(minute_of_day)):
+                emitted.add((chat_id, "change"))
+                payload = {
+                    "api_id": api_id, "api_name": name, "old_balance": old_balance, "new_balance": new_balance,
+                    "diff": diff, "at": at_iso, "rule_id": rule.id,
+                }
+                rows += outbox_rows(tokens, chat_id, _change_message(name, diff, new_balance, ev["time_label"]),
+                                    "change", payload, f"change{key}:{new_balance!r}", coalesce)
+            thr = rule.threshold
+            if (chat_id, "threshold") not in emitted and thr is not None and old_balance >= thr and new_balance < thr:
+                emitted.add((chat_id, "threshold"))
+                alert_msg = (
+                    f"🚨 <b>CẢNH BÁO SỐ DƯ THẤP</b> ({name})\n\n"
+                    f"Tài khoản chỉ còn: <b>{fmt_amount(new_balance)}</b>\n"
+                    f"Ngưỡng cảnh báo: <b>{fmt_amount(thr)}</b>\n"
+                    f"Vui lòng nạp thêm để tránh gián đoạn dịch vụ."
+                )
+                payload = {"api_id": api_id, "api_name": name, "new_balance": new_balance, "threshold": thr,
+                           "at": at_iso, "rule_id": rule.id}
+                rows += outbox_rows(tokens, chat_id, alert_msg, "threshold", payload, f"threshold{key}:{thr!r}")
+            if rule.max_rate and prev_dt is not None:
+                minutes = max((at - prev_dt.replace(tzinfo=None)).total_seconds() / 60, 1 / 60)
+                rate = abs(diff) / minutes
+                if (chat_id, "rate") not in emitted and rate > rule.max_rate:
+                    emitted.add((chat_id, "rate"))
+                    rate_msg = (
+                        f"⚡ <b>BIẾN ĐỘNG NHANH BẤT THƯỜNG</b> ({name})\n\n"
+                        f"Biến động: <b>{'+' if diff >= 0 else '-'}{fmt_amount(abs(diff))}</b> trong {minutes:.1f} phút\n"
+                        f"Tốc độ: <b>{fmt_amount(rate)}/phút</b> (giới hạn {fmt_amount(rule.max_rate)}/phút)\n"
+                        f"Số dư cuối: <b>{fmt_amount(new_balance)}</b>\n"
+                        f"Thời gian: {ev['time_label']}"
+                    )
+                    payload = {"api_id": api_id, "api_name": name, "diff": diff, "rate_per_min": rate,
+                               "max_rate": rule.max_rate, "new_balance": new_balance, "at": at_iso,
+                               "rule_id": rule.id}
+                    rows += outbox_rows(tokens, chat_id, rate_msg, "rate", payload, f"rate{key}:{new_balance!r}")
+    return rows
+
+# =========================
+# WATCHER THREAD
+# =========================
+def get_poll_interval(settings: Dict[str, Optional[str]]) -> float:
+    poll_interval = to_float(settings.get("poll_interval") or "", None)
+    if poll_interval is None or poll_interval < 5:
+        return POLL_INTERVAL_DEFAULT
+    return poll_interval
+
+def get_coalesce_seconds(settings: Dict[str, Optional[str]]) -> float:
+    v = to_float(settings.get("notify_coalesce_seconds") or "", None)
+    return max(0.0, min(float(v), NOTIFY_COALESCE_MAX)) if v else 0.0
+
+def get_max_concurrency(settings: Dict[str, Optional[str]]) -> int:
+    n = to_float(settings.get("max_concurrency") or "", None)
+    if n is None or n < 1:
+        return MAX_CONCURRENCY_DEFAULT
+    return int(min(n, MAX_CONCURRENCY_LIMIT))
+
+class ApiScheduler:
+    """Hàng đợi ưu tiên (next_due, api_id): mỗi API có chu kỳ riêng, backoff khi lỗi / không đổi"""
+
+    def __init__(self):
+        self.heap: List[tuple] = []
+        self.entries: Dict[int, Dict[str, Any]] = {}
+        self.started = False
+
+    def sync(self, apis: List[Dict[str, Any]], default_interval: float, now: float,
+             running: Optional[set] = None) -> List[int]:
+        """Trả về các API đã biến mất (bị xoá / bỏ URL) kể từ lần sync trước.
+
+        `running` = các API đang quét dở trên pool, chưa có kết quả nên không xếp lịch lại.
+        """
+        running = running or set()
+        seen = set()
+        # Lần nạp đầu (khởi động): rải đều các API trong 1 chu kỳ thay vì dồn hết vào t=0
+        spread = not self.started
+        self.started = True
+        for api in apis:
+            if not api.get("url"):
+                continue
+            api_id = api["id"]
+            seen.add(api_id)
+            interval = to_float(str(api.get("poll_interval") or ""), None)
+            if interval is None or interval <= 0:
+                interval = default_interval
+            interval = max(float(interval), POLL_INTERVAL_MIN_API)
+            entry = self.entries.get(api_id)
+            if entry is None:
+                due = now + random.uniform(0, interval if spread else 1.0)
+                entry = {"interval": interval, "next_due": due, "failures": 0, "idle": 0}
+                self.entries[api_id] = entry
+                heapq.heappush(self.heap, (due, api_id))
+            elif entry["next_due"] is None and api_id not in running:
+                # Chu kỳ trước bị gián đoạn giữa chừng: xếp lịch lại ngay
+                entry["interval"] = interval
+                self._push(api_id, now)
+            elif entry["next_due"] is not None and entry["interval"] != interval:
+                entry["interval"] = interval
+                self._push(api_id, min(entry["next_due"], now + self._delay(entry)))
+        removed = [api_id for api_id in self.entries if api_id not in seen]
+        for api_id in removed:
+            del self.entries[api_id]
+        return removed
+
+    def _delay(self, entry: Dict[str, Any]) -> float:
+        interval = entry["interval"]
+        if entry["failures"]:
+            exp = min(entry["failures"] - 1, FAIL_BACKOFF_MAX_EXP)
+            return min(interval * (2 ** exp), max(interval, FAIL_BACKOFF_MAX_SECONDS))
+        exp = min(entry["idle"] // IDLE_BACKOFF_STEP, IDLE_BACKOFF_MAX_EXP)
+        return interval * (2 ** exp)
+
+    def _push(self, api_id: int, due: float):
+        self.entries[api_id]["next_due"] = due
+        heapq.heappush(self.heap, (due, api_id))
+
+    def pop_due(self, now: float) -> List[int]:
+        due_ids = []
+        while self.heap and self.heap[0][0] <= now:
+            due, api_id = heapq.heappop(self.heap)
+            entry = self.entries.get(api_id)
+            # Bỏ các bản ghi cũ (API đã xoá hoặc đã được xếp lịch lại)
+            if entry is None or entry["next_due"] != due:
+                continue
+            entry["next_due"] = None
+            due_ids.append(api_id)
+        return due_ids
+
+    def reschedule(self, api_id: int, now: float, ok: bool, changed: bool):
+        entry = self.entries.get(api_id)
+        if entry is None:
+            return
+        if not ok:
+            entry["failures"] += 1
+        else:
+            entry["failures"] = 0
+            entry["idle"] = 0 if changed else entry["idle"] + 1
+        delay = self._delay(entry)
+        delay *= 1 + random.uniform(-POLL_JITTER_RATIO, POLL_JITTER_RATIO)
+        self._push(api_id, now + max(delay, 0.5))
+
+    def defer(self, api_id: int, due: float):
+        # Bị breaker chặn: không tính là 1 lần quét, chỉ dời lịch tới lúc được thử lại
+        if api_id in self.entries:
+            self._push(api_id, due)
+
+    def seconds_until_next(self, now: float) -> Optional[float]:
+        while self.heap:
+            due, api_id = self.heap[0]
+            entry = self.entries.get(api_id)
+            if entry is None or entry["next_due"] != due:
+                heapq.heappop(self.heap)
+                continue
+            return max(0.0, due - now)
+        return None
+
+class TokenBucket:
+    """`rate` token/giây, tối đa `burst` token dồn lại"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = max(rate, 0.001)
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost: float = 1.0) -> float:
+        """Số giây phải chờ tới khi đủ `cost` token (0 nếu đã đủ)"""
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= cost:
+                return 0.0
+            return (cost - self.tokens) / self.rate
+
+    def try_take(self, cost: float = 1.0) -> bool:
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return True
+            return False
+
+class HostRateLimiter:
+    """Mỗi host 1 token bucket riêng, tránh dồn request vào cùng 1 shop"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.deferred = 0
+
+    def bucket(self, host: str) -> TokenBucket:
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate, self.burst)
+        return self.buckets[host]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rate_per_sec": self.rate,
+            "burst": self.burst,
+            "deferred": self.deferred,
+            "hosts": {h: round(b.tokens, 2) for h, b in list(self.buckets.items())},
+        }
+
+host_limiter = HostRateLimiter(HOST_RATE_PER_SEC, HOST_RATE_BURST)
+
+class CircuitBreaker:
+    """closed -> open (sau `threshold` lỗi liên tiếp) -> half_open (hết cooldown, cho 1 request thử)"""
+
+    def __init__(self, threshold: int):
+        self.threshold = threshold
+        self.state = "closed"
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.opened_at = 0.0
+        self.probing = False
+        self.probe_started = 0.0
+
+    def retry_at(self) -> float:
+        return self.opened_at + self.cooldown
+
+    def allow(self, now: float) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and now >= self.retry_at():
+            self.state = "half_open"
+            self.probing = False
+        if self.state == "half_open" and (not self.probing or now - self.probe_started >= BREAKER_PROBE_TIMEOUT):
+            self.probing = True
+            self.probe_started = now
+            return True
+        return False
+
+    def release(self):
+        """Trả lại lượt thử half_open khi không ghi nhận được kết quả"""
+        self.probing = False
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.probing = False
+
+    def record_failure(self, now: float):
+        self.probing = False
+        if self.state == "half_open":
+            self.cooldown = min(self.cooldown * 2, BREAKER_COOLDOWN_MAX)
+            self.state = "open"
+            self.opened_at = now
+            return
+        self.failures += 1
+        if self.state == "closed" and self.failures >= self.threshold:
+            self.state = "open"
+            self.opened_at = now
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "retry_at": self.retry_at() if self.state != "closed" else None,
+        }
+
+class BreakerBoard:
+    """Breaker theo từng API và theo từng host; chỉ thread watcher ghi"""
+
+    def __init__(self):
+        self.apis: Dict[int, CircuitBreaker] = {}
+        self.hosts: Dict[str, CircuitBreaker] = {}
+
+    @staticmethod
+    def host_of(url: str) -> str:
+        try:
+            return urlsplit(url).netloc.lower()
+        except Exception:
+            return ""
+
+    def for_api(self, api_id: int) -> CircuitBreaker:
+        if api_id not in self.apis:
+            self.apis[api_id] = CircuitBreaker(BREAKER_API_THRESHOLD)
+        return self.apis[api_id]
+
+    def for_host(self, host: str) -> CircuitBreaker:
+        if host not in self.hosts:
+            self.hosts[host] = CircuitBreaker(BREAKER_HOST_THRESHOLD)
+        return self.hosts[host]
+
+    def allow(self, api: Dict[str, Any], now: float) -> Tuple[bool, float]:
+        """(được gọi mạng hay không, thời điểm nên thử lại nếu bị chặn)"""
+        host_breaker = self.for_host(self.host_of(api["url"]))
+        if not host_breaker.allow(now):
+            return False, host_breaker.retry_at()
+        api_breaker = self.for_api(api["id"])
+        if not api_breaker.allow(now):
+            # Trả lại lượt thử của host nếu vừa lấy
+            if host_breaker.state == "half_open":
+                host_breaker.release()
+            return False, api_breaker.retry_at()
+        return True, now
+
+    def release(self, api: Dict[str, Any]):
+        """Lần quét đã được allow() nhưng không tới được record(): nhả lượt thử để API không bị kẹt"""
+        host_breaker = self.for_host(self.host_of(api["url"]))
+        api_breaker = self.for_api(api["id"])
+        if host_breaker.state == "half_open":
+            host_breaker.release()
+        if api_breaker.state == "half_open":
+            api_breaker.release()
+
+    def record(self, api: Dict[str, Any], now: float, kind: Optional[str]) -> str:
+        """Ghi nhận kết quả 1 lần quét (kind=None là thành công), trả về trạng thái breaker của API"""
+        host_breaker = self.for_host(self.host_of(api["url"]))
+        api_breaker = self.for_api(api["id"])
+        if kind is None:
+            host_breaker.record_success()
+            api_breaker.record_success()
+        else:
+            if kind in HOST_FAILURE_KINDS:
+                host_breaker.record_failure(now)
+            else:
+                # Host vẫn trả lời bình thường, chỉ nội dung có vấn đề
+                host_breaker.record_success()
+            api_breaker.record_failure(now)
+        return api_breaker.state
 
-def send_telegram(tokens: List[str], chat_id: str, text: str):
-    if not chat_id or not tokens:
+    def prune(self, api_ids: set):
+        for api_id in list(self.apis):
+            if api_id not in api_ids:
+                del self.apis[api_id]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hosts": {h: b.snapshot() for h, b in list(self.hosts.items())},
+            "open_apis": [i for i, b in list(self.apis.items()) if b.state != "closed"],
+        }
+
+breakers = BreakerBoard()
+
+def get_poll_executor(max_workers: int) -> ThreadPoolExecutor:
+    # Giữ pool giữa các chu kỳ, chỉ tạo lại khi đổi giới hạn song song
+    global poll_executor, poll_executor_size
+    if poll_executor is None or poll_executor_size != max_workers:
+        old = poll_executor
+        poll_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="poll")
+        poll_executor_size = max_workers
+        if old is not None:
+            old.shutdown(wait=False)
+    return poll_executor
+
+def remember_validators(api_id: int, validators: Optional[Dict[str, Optional[str]]]):
+    # Chỉ ghi nhớ sau khi body đã xử lý thành công, tránh "đóng băng" một response lỗi
+    if validators is None:
         return
-    for token in tokens:
-        token = (token or "").strip()
-        if not token:
-            continue
+    with fetch_validators_lock:
+        fetch_validators[api_id] = validators
+
+def classify_fetch_error(e: Exception) -> str:
+    if isinstance(e, requests.Timeout):
+        return "timeout"
+    if isinstance(e, requests.HTTPError):
+        return "http"
+    if isinstance(e, ResponseTooLarge):
+        return "size"
+    if isinstance(e, (json.JSONDecodeError, requests.exceptions.JSONDecodeError, UnicodeDecodeError)):
+        return "json"
+    # InvalidURL, InvalidHeader... cũng là ValueError nhưng thuộc phía kết nối, không phải body
+    return "conn"
+
+def fetch_api_json(api: Dict[str, Any]) -> Dict[str, Any]:
+    """Gọi 1 API số dư, trả về {"api", "data", "balance", "unchanged", "validators", "error", "latency"} (không bao giờ raise).
+
+    Gửi If-None-Match / If-Modified-Since nếu server có ETag / Last-Modified;
+    nếu không, so digest body với lần trước và bỏ qua parse JSON khi giống hệt.
+    Body vượt giới hạn kích thước bị huỷ; API bật stream_json dừng đọc ngay khi
+    thấy trường số dư (balance_field hoặc đường dẫn đã học).
+    """
+    result: Dict[str, Any] = {"api": api, "data": None, "balance": None, "unchanged": False,
+                              "validators": None, "error": None, "error_kind": None, "latency": 0.0}
+    started = time.monotonic()
+    url = api["url"]
+    with fetch_validators_lock:
+        prev = fetch_validators.get(api["id"])
+    if prev is not None and prev.get("url") != url:
+        prev = None
+    headers = {}
+    if prev is not None:
+        if prev.get("etag"):
+            headers["If-None-Match"] = prev["etag"]
+        if prev.get("last_modified"):
+            headers["If-Modified-Since"] = prev["last_modified"]
+    max_bytes = int(api.get("max_response_bytes") or 0) or MAX_RESPONSE_BYTES_DEFAULT
+    target_path = (api.get("learned_path") or api.get("balance_field") or "").strip()
+    resp = None
+    try:
+        resp = http_pool.get(url, headers=headers, stream=True)
+        if resp.status_code == 304 and prev is not None:
+            result["unchanged"] = True
+            return result
+        resp.raise_for_status()
+        body = None
+        if api.get("stream_json") and target_path:
+            streamed = stream_balance(resp, target_path, max_bytes)
+            if streamed["found"]:
+                digest = streamed["digest"]
+                result["balance"] = (_parse_float_like(streamed["value"]), target_path)
+            else:
+                body = streamed["body"]
+        else:
+            body = read_body_capped(resp, max_bytes)
+        if body is not None:
+            digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+        if prev is not None and prev.get("digest") == digest:
+            result["unchanged"] = True
+            return result
+        if body is not None:
+            result["data"] = json.loads(body)
+        result["validators"] = {
+            "url": url,
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "digest": digest,
+        }
+    except Exception as e:
+        result["error"] = str(e)
+        result["error_kind"] = classify_fetch_error(e)
+    finally:
+        # Dừng sớm / quá giới hạn: đóng kết nối thay vì trả về pool với body dở dang
+        if resp is not None:
+            resp.close()
+        result["latency"] = time.monotonic() - started
+    return result
+
+def submit_poll(api: Dict[str, Any], max_workers: int) -> Future:
+    """Đẩy 1 lần quét lên pool; xong là đánh thức watcher để xử lý ngay, không chờ API chậm nhất của lượt"""
+    fut = get_poll_executor(max_workers).submit(fetch_api_json, api)
+    fut.add_done_callback(lambda _fut: watcher_wakeup.set())
+    return fut
+
+def process_api_result(api: Dict[str, Any], data: Any,
+                       resolved: Optional[Tuple[Optional[float], Optional[str]]] = None,
+                       events: Optional[List[Dict[str, Any]]] = None) -> Optional[bool]:
+    """None = không đọc được số dư, True = số dư đổi (hoặc lần đầu), False = không đổi.
+
+    `resolved` = (số dư, đường dẫn) đã đọc sẵn bởi streaming reader, khi đó bỏ qua `data`.
+    Mỗi biến động được thêm vào `events`; cảnh báo do evaluate_alerts() tính 1 lượt cho cả chu kỳ.
+    """
+    api_id = api["id"]
+    name = api["name"]
+    field = api["balance_field"] or ""
+    old_balance = write_buffer.pending_balance(api_id, api["last_balance"])
+    # Mốc đổi số dư trước đó: cùng 1 lần đổi luôn cho cùng idem_key dù bị phát hiện lại
+    prev_change = write_buffer.pending_change(api_id, api.get("last_change")) or ""
+
+    learned_path = write_buffer.learned.get(api_id, api.get("learned_path") or "")
+    if resolved is not None:
+        new_balance, path = resolved
+    else:
+        new_balance, path = resolve_balance(data, field, learned_path)
+    if new_balance is None:
+        if learned_path:
+            # Đường dẫn đã học không còn đúng: bỏ đi để lần sau stream/dò lại từ balance_field
+            write_buffer.set_learned_path(api_id, "")
+        return None
+    if path and path != learned_path:
+        write_buffer.set_learned_path(api_id, path)
+
+    now = datetime.utcnow()
+
+    if old_balance is None:
+        write_buffer.set_state(api_id, new_balance, now.isoformat() + "Z")
+        return True
+
+    old_balance = float(old_balance)
+    diff = new_balance - old_balance
+    if abs(diff) < 1e-9:
+        return False
+
+    if events is not None:
+        events.append({
+            "api": api, "old": old_balance, "new": new_balance, "diff": diff, "at": now,
+            "time_label": fmt_time_label_vn(now), "prev_change": prev_change,
+        })
+    write_buffer.set_state(api_id, new_balance, now.isoformat() + "Z")
+    write_buffer.add_history(api_id, name, now.isoformat() + "Z", diff, new_balance)
+    return True
+
+def handle_poll_result(result: Dict[str, Any], scheduler: ApiScheduler, events: List[Dict[str, Any]]):
+    """Ghi nhận 1 kết quả quét: số dư, breaker, lỗi, mẫu, lịch quét kế tiếp (chỉ thread watcher gọi)"""
+    api = result["api"]
+    api_id = api["id"]
+    recorded = False
+    try:
+        status: Optional[bool] = None
+        error_kind, error_msg = result["error_kind"], result["error"]
+        if result["unchanged"]:
+            # Body giống hệt lần trước: không parse, không extract, không ghi DB
+            status = False
+        elif result["error"] is None:
+            try:
+                status = process_api_result(api, result["data"], result["balance"], events)
+                if status is None:
+                    error_kind, error_msg = "extract", "Không tìm thấy trường số dư"
+            except Exception as e:
+                status = None
+                error_kind, error_msg = "internal", f"Lỗi xử lý: {e}"
+            if status is not None:
+                remember_validators(api_id, result["validators"])
+        now_ts = time.time()
+        breaker_state = breakers.record(api, now_ts, error_kind)
+        recorded = True
+        scheduler.reschedule(api_id, now_ts, status is not None, bool(status))
+        if error_kind is not None:
+            write_buffer.add_failure(api_id, error_kind, error_msg or error_kind,
+                                     datetime.utcnow().isoformat() + "Z", breaker_state)
+        elif write_buffer.known_breaker_state(api_id, api.get("breaker_state")) != breaker_state:
+            write_buffer.set_breaker_state(api_id, breaker_state)
         try:
-            url = f"https://api.telegram.org/bot{token}/sendMessage"
-            requests.post(
-                url,
-                data={"chat_id": chat_id, "text": text, "parse_mode": "HTML"},
-                timeout=10,
+            sample_store.append(
+                api_id, now_ts,
+                write_buffer.pending_balance(api_id, api["last_balance"]) if status is not None else None,
+                result["latency"],
+                error_kind or ("unchanged" if status is False else "ok"),
             )
-        except Exception:
-            continue
+        except Exception as e:
+            # Kho mẫu là tuỳ chọn: lỗi ở đây không được chặn lượt tính cảnh báo cho các biến động đã gom
+            sample_store.record_error(e)
+    finally:
+        if not recorded:
+            breakers.release(api)
+
+def renew_leadership(last_beat: float) -> float:
+    """Gia hạn lease nếu tới hạn heartbeat; trả về thời điểm heartbeat gần nhất (0 nếu không còn là leader)"""
+    global watcher_is_leader
+    now = time.time()
+    if watcher_is_leader and now - last_beat < LEASE_HEARTBEAT:
+        return last_beat
+    try:
+        watcher_is_leader = acquire_watcher_lease(WATCHER_ID, now)
+    except Exception:
+        watcher_is_leader = False
+    return now if watcher_is_leader else 0.0
+
+def abandon_leadership():
+    """Mất lease: bỏ phần chưa ghi (leader mới tự quét lại) và quên validator để lần làm leader sau không bỏ sót biến động"""
+    dropped = write_buffer.discard()
+    with fetch_validators_lock:
+        fetch_validators.clear()
+    print(f"[{datetime.now()}] Watcher {WATCHER_ID} mất lease, bỏ {dropped} mục chưa ghi")
 
-# =========================
-# WATCHER THREAD
-# =========================
 def watcher_loop():
     global watcher_running
     watcher_running = True
+    scheduler = ApiScheduler()
+    # Các lần quét đang chạy trên pool -> API; kết quả được xử lý ngay khi về
+    inflight: Dict[Future, Dict[str, Any]] = {}
+    last_beat = 0.0
+    last_retention = 0.0
+    last_outbox_prune = 0.0
     while True:
+        wait: Optional[float] = None
+        was_leader = watcher_is_leader
+        last_beat = renew_leadership(last_beat)
+        if not watcher_is_leader:
+            if was_leader:
+                # Mất lease (VD bị treo quá TTL): không ghi gì thêm, bỏ lịch cũ, leader mới sẽ tiếp quản
+                abandon_leadership()
+                scheduler = ApiScheduler()
+                inflight = {}
+            watcher_wakeup.wait(LEASE_HEARTBEAT)
+            watcher_wakeup.clear()
+            continue
+        # Gửi Telegram / email chỉ chạy trong process leader (1 dispatcher cho cả hệ thống)
+        notifier.start()
+        email_dispatcher.start()
         try:
             settings = get_settings()
             apis = get_apis()
-            bots = get_bots()
-
-            poll_interval = to_float(settings.get("poll_interval") or "", None)
-            if poll_interval is None or poll_interval < 5:
-                poll_interval = POLL_INTERVAL_DEFAULT
-
-            default_chat_id = (settings.get("default_chat_id") or "").strip()
-            default_bot_id = settings.get("default_bot_id") or ""
-            global_threshold = to_float(settings.get("global_threshold") or "", None)
-
-            last_run_str = datetime.utcnow().isoformat() + "Z"
-            set_setting("last_run", last_run_str)
-
-            tokens_to_use: List[str] = []
-            if default_bot_id:
-                try:
-                    bid = int(default_bot_id)
-                    for b in bots:
-                        if b["id"] == bid:
-                            tokens_to_use = [b["bot_token"]]
-                            break
-                except ValueError:
-                    pass
-            if not tokens_to_use:
-                tokens_to_use = [b["bot_token"] for b in bots]
 
-            for api in apis:
-                api_id = api["id"]
-                name = api["name"]
-                url = api["url"]
-                field = api["balance_field"] or ""
-                old_balance = api["last_balance"]
+            now_ts = time.time()
+            first_sync = not scheduler.started
+            removed = scheduler.sync(apis, get_poll_interval(settings), now_ts, {a["id"] for a in inflight.values()})
+            # Dọn phía watcher (process đang giữ file segment mở), không phải ở worker web xử lý lệnh xoá
+            for api_id in removed:
+                sample_store.drop(api_id)
+                write_buffer.breaker_known.pop(api_id, None)
+                with fetch_validators_lock:
+                    fetch_validators.pop(api_id, None)
+            if first_sync:
+                sample_store.drop_except({a["id"] for a in apis})
+                write_buffer.load_breaker_states(get_api_health())
+            breakers.prune(set(scheduler.entries))
+            max_workers = get_max_concurrency(settings)
 
-                if not url:
+            apis_by_id = {a["id"]: a for a in apis}
+            submitted = False
+            for api_id in scheduler.pop_due(now_ts):
+                api = apis_by_id[api_id]
+                bucket = host_limiter.bucket(BreakerBoard.host_of(api["url"]))
+                rate_wait = bucket.wait_time()
+                if rate_wait > 0:
+                    # Host đã hết lượt: dời sang lúc có token (+ jitter nhỏ để không dồn cục)
+                    host_limiter.deferred += 1
+                    scheduler.defer(api_id, now_ts + rate_wait + random.uniform(0, 1 / bucket.rate))
                     continue
+                allowed, retry_at = breakers.allow(api, now_ts)
+                if allowed:
+                    bucket.try_take()
+                    # Không chờ ở đây: API treo chỉ giữ 1 worker của pool, các API khác vẫn được gửi đúng hạn
+                    inflight[submit_poll(api, max_workers)] = api
+                    submitted = True
+                else:
+                    # Circuit đang mở: không gọi mạng, hẹn lại lúc hết cooldown
+                    scheduler.defer(api_id, max(retry_at, now_ts + 1))
+            if submitted:
+                write_buffer.set_setting("last_run", datetime.utcnow().isoformat() + "Z")
 
-                try:
-                    resp = requests.get(url, timeout=15)
-                    resp.raise_for_status()
-                    data = resp.json()
-                except Exception:
-                    continue
+            done = [fut for fut in inflight if fut.done()]
+            if done:
+                bots = get_bots()
 
-                new_balance = extract_balance_auto(data, field)
-                if new_balance is None:
-                    continue
+                default_bot_id = settings.get("default_bot_id") or ""
+                coalesce = get_coalesce_seconds(settings)
 
-                now = datetime.utcnow()
-                time_label = fmt_time_label_vn(now)
+                tokens_to_use: List[str] = []
+                if default_bot_id:
+                    try:
+                        bid = int(default_bot_id)
+                        for b in bots:
+                            if b["id"] == bid:
+                                tokens_to_use = [b["bot_token"]]
+                                break
+                    except ValueError:
+                        pass
+                if not tokens_to_use and bots:
+                    # Không chọn bot cố định: mỗi tin chỉ gửi 1 lần, bot được chọn lúc gửi
+                    tokens_to_use = [BOT_POOL_TOKEN]
 
-                if old_balance is None:
-                    update_api_state(api_id, new_balance, now.isoformat() + "Z")
+                events: List[Dict[str, Any]] = []
+                # Fetch chạy song song trên pool, xử lý số dư / DB tuần tự trên thread watcher (Telegram chỉ enqueue)
+                for fut in done:
+                    inflight.pop(fut)
+                    result = fut.result()
+                    last_beat = renew_leadership(last_beat)
+                    if not watcher_is_leader:
+                        break
+                    if result["api"]["id"] not in scheduler.entries:
+                        # API bị xoá trong lúc đang quét: bỏ kết quả
+                        breakers.release(result["api"])
+                        continue
+                    handle_poll_result(result, scheduler, events)
+                if not watcher_is_leader:
+                    # Mất lease giữa lượt: dừng ngay, không flush phần đã gom
+                    abandon_leadership()
+                    scheduler = ApiScheduler()
+                    inflight = {}
                     continue
 
-                old_balance = float(old_balance)
-                diff = new_balance - old_balance
-
-                if abs(diff) >= 1e-9:
-                    if diff < 0:
-                        msg = (
-                            f"🔻 <b>THANH TOÁN THÀNH CÔNG</b> ({name})\n\n"
-                            f"Nội dung: Thanh toán / trừ số dư\n"
-                            f"Tổng trừ: <b>-{fmt_amount(abs(diff))}</b>\n"
-                            f"Số dư cuối: <b>{fmt_amount(new_balance)}</b>\n"
-                            f"Thời gian: {time_label}"
-                        )
-                    else:
-                        msg = (
-                            f"💰 <b>NẠP TIỀN THÀNH CÔNG</b> ({name})\n\n"
-                            f"Nội dung: Nạp tiền vào tài khoản\n"
-                            f"Biến động: <b>+{fmt_amount(diff)}</b>\n"
-                            f"Số dư cuối: <b>{fmt_amount(new_balance)}</b>\n"
-                            f"Thời gian: {time_label}"
-                        )
-
-                    settings = get_settings() 
-                    default_chat_id = (settings.get("default_chat_id") or "").strip()
-                    if default_chat_id and tokens_to_use:
-                        send_telegram(tokens_to_use, default_chat_id, msg)
+                # Cảnh báo: 1 lượt qua bộ quy tắc đã biên dịch cho mọi biến động vừa về
+                if events:
+                    try:
+                        write_buffer.add_notifications(evaluate_alerts(
+                            events, get_rule_set(), default_alert_rule(settings), bots, tokens_to_use, coalesce,
+                        ))
+                    except Exception as e:
+                        # Không ghi số dư mới mà thiếu tin cảnh báo: bỏ các biến động khỏi buffer và quên
+                        # validator để lần quét sau đọc lại body, phát hiện lại và tính cảnh báo lại
+                        print(f"!! Lỗi tính cảnh báo, bỏ {len(events)} biến động để quét lại: {e}")
+                        write_buffer.revert_events(events)
+                        with fetch_validators_lock:
+                            for ev in events:
+                                fetch_validators.pop(ev["api"]["id"], None)
 
-                    update_api_state(api_id, new_balance, now.isoformat() + "Z")
-                    log_transaction(api_id, name, now.isoformat() + "Z", diff, new_balance)
-                else:
-                    update_api_state(api_id, new_balance, api.get("last_change") or now.isoformat() + "Z")
+                # 1 transaction cho các kết quả vừa về (hoặc gom tiếp tới hạn DB_FLUSH_INTERVAL)
+                write_buffer.flush()
+                try:
+                    sample_store.flush()
+                except Exception as e:
+                    sample_store.record_error(e)
 
-                if global_threshold is not None:
-                    try:
-                        thr = float(global_threshold)
-                        if old_balance >= thr and new_balance < thr:
-                            alert_msg = (
-                                f"🚨 <b>CẢNH BÁO SỐ DƯ THẤP</b> ({name})\n\n"
-                                f"Tài khoản chỉ còn: <b>{fmt_amount(new_balance)}</b>\n"
-                                f"Ngưỡng cảnh báo: <b>{fmt_amount(thr)}</b>\n"
-                                f"Vui lòng nạp thêm để tránh gián đoạn dịch vụ."
-                            )
-                            settings = get_settings()
-                            default_chat_id = (settings.get("default_chat_id") or "").strip()
-                            if default_chat_id and tokens_to_use:
-                                send_telegram(tokens_to_use, default_chat_id, alert_msg)
-                    except Exception:
-                        pass
+            # Dọn lịch sử thô quá hạn (số liệu vẫn còn trong bảng tổng hợp)
+            retention_days = get_retention_days(settings)
+            if retention_days and time.time() - last_retention >= RETENTION_CHECK_INTERVAL:
+                last_retention = time.time()
+                prune_history(retention_days)
+                sample_store.prune(retention_days)
+            if time.time() - last_outbox_prune >= RETENTION_CHECK_INTERVAL:
+                last_outbox_prune = time.time()
+                prune_outbox()
 
+            wait = scheduler.seconds_until_next(time.time())
         except Exception:
             pass
 
         try:
-            settings = get_settings()
-            poll_interval = to_float(settings.get("poll_interval") or "", None)
-            if poll_interval is None or poll_interval < 5:
-                poll_interval = POLL_INTERVAL_DEFAULT
+            write_buffer.flush()
         except Exception:
-            poll_interval = POLL_INTERVAL_DEFAULT
-        time.sleep(poll_interval)
+            pass
+        flush_wait = write_buffer.due()
+        if flush_wait is not None and (wait is None or flush_wait < wait):
+            wait = flush_wait
+
+        # Ngủ đúng tới lúc API kế tiếp đến hạn (hoặc bị đánh thức khi thêm API / có kết quả quét)
+        if wait is None or wait > WATCHER_IDLE_RECHECK:
+            wait = WATCHER_IDLE_RECHECK
+        wait = min(wait, LEASE_HEARTBEAT)
+        watcher_wakeup.wait(wait)
+        watcher_wakeup.clear()
 
 def start_watcher_once():
     global watcher_started
+    if WATCHER_MODE == "off":
+        return
     if not watcher_started:
         watcher_started = True
         t = threading.Thread(target=watcher_loop, daemon=True)
         t.start()
+        atexit.register(_release_lease_on_exit)
+
+def _release_lease_on_exit():
+    if watcher_is_leader:
+        try:
+            write_buffer.flush(force=True)
+        except Exception:
+            pass
+    sample_store.close()
+    notifier.drain(NOTIFY_DRAIN_TIMEOUT)
+    email_dispatcher.drain(NOTIFY_DRAIN_TIMEOUT)
+    if watcher_is_leader:
+        try:
+            release_watcher_lease(WATCHER_ID)
+        except Exception:
+            pass
+
+def watcher_status() -> Dict[str, Any]:
+    """Trạng thái watcher toàn hệ thống (leader có thể là worker khác)"""
+    try:
+        lease = get_watcher_lease()
+    except Exception:
+        lease = {}
+    active = bool(lease.get("owner")) and (lease.get("expires_at") or 0) > time.time()
+    return {
+        "running": active,
+        "leader": lease.get("owner") if active else None,
+        "this_worker_is_leader": watcher_is_leader,
+        "this_worker_id": WATCHER_ID,
+    }
 
 # =========================
 # EMAIL HELPER (CHỈ ĐỂ TEST THỦ CÔNG)
 # =========================
-def send_email(to_email: str, subject: str, html_body: str) -> Optional[str]:
-    settings = get_settings()
+def _smtp_config(settings: Dict[str, Optional[str]]) -> Tuple[Optional[Tuple[str, int, str, str]], Optional[str]]:
+    """(server, port, user, pass) từ settings, hoặc (None, lỗi)"""
     smtp_server = (settings.get("smtp_server") or "").strip()
     smtp_port_str = (settings.get("smtp_port") or "").strip()
     smtp_user = (settings.get("smtp_user") or "").strip()
     smtp_pass = (settings.get("smtp_pass") or "").strip()
 
-    if not all([to_email, smtp_server, smtp_port_str, smtp_user, smtp_pass]):
-        return "Thiếu thông tin cấu hình SMTP."
+    if not all([smtp_server, smtp_port_str, smtp_user, smtp_pass]):
+        return None, "Thiếu thông tin cấu hình SMTP."
 
     try:
         smtp_port = int(smtp_port_str)
     except ValueError:
-        return f"SMTP Port không hợp lệ: {smtp_port_str}."
+        return None, f"SMTP Port không hợp lệ: {smtp_port_str}."
+    return (smtp_server, smtp_port, smtp_user, smtp_pass), None
 
-    msg = EmailMessage()
-    msg['Subject'] = subject
-    msg['From'] = smtp_user
-    msg['To'] = to_email
-    msg.set_content("Vui lòng xem nội dung email bằng trình duyệt hỗ trợ HTML.")
-    msg.add_alternative(html_body, subtype='html')
+class EmailDispatcher:
+    """Gửi email nền từ bảng email_outbox trên 1 thread của process leader, giữ 1 kết nối SMTP đã đăng nhập để dùng lại.
 
-    try:
+    Kết nối được mở lại khi cấu hình SMTP đổi, khi server đã ngắt, hoặc bị đóng chủ động
+    sau SMTP_IDLE_TIMEOUT giây không có email (tránh server tự ngắt giữa chừng).
+    Gửi lỗi: hẹn lại bằng next_attempt_at, không ngủ trên thread gửi nên email khác vẫn đi.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pid: Optional[int] = None
+        self.busy = False
+        self.server: Optional[smtplib.SMTP] = None
+        self.server_key: Optional[Tuple[str, int, str, str]] = None
+        self.last_used = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.connects = 0
+        self.last_error: Optional[str] = None
+
+    def start(self):
+        # Như notifier: thread cũ không còn sau fork -> khởi động lại trong process mới
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.server = None
+        threading.Thread(target=self._run, daemon=True, name="email").start()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def _close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+        self.server = None
+        self.server_key = None
+
+    def _connect(self, config: Tuple[str, int, str, str]):
+        smtp_server, smtp_port, smtp_user, smtp_pass = config
         context = ssl.create_default_context()
         if smtp_port == 465:
-            with smtplib.SMTP_SSL(smtp_server, smtp_port, timeout=10, context=context) as server:
-                server.login(smtp_user, smtp_pass)
-                server.send_message(msg)
+            server = smtplib.SMTP_SSL(smtp_server, smtp_port, timeout=SMTP_TIMEOUT, context=context)
         else:
-            with smtplib.SMTP(smtp_server, smtp_port, timeout=10) as server:
-                server.starttls(context=context)
-                server.login(smtp_user, smtp_pass)
-                server.send_message(msg)
-        return None 
-    except Exception as e:
-        return f"Lỗi gửi email: {e}"
+            server = smtplib.SMTP(smtp_server, smtp_port, timeout=SMTP_TIMEOUT)
+            server.starttls(context=context)
+        server.login(smtp_user, smtp_pass)
+        self.server = server
+        self.server_key = config
+        self.connects += 1
+
+    def _deliver(self, config: Tuple[str, int, str, str], job: Dict[str, Any]):
+        msg = EmailMessage()
+        msg['Subject'] = job["subject"]
+        msg['From'] = config[2]
+        msg['To'] = job["to_email"]
+        msg.set_content("Vui lòng xem nội dung email bằng trình duyệt hỗ trợ HTML.")
+        msg.add_alternative(job["html"], subtype='html')
+        if self.server is not None and self.server_key != config:
+            self._close()
+        if self.server is None:
+            self._connect(config)
+        try:
+            self.server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # Server đã ngắt kết nối cũ: mở lại 1 lần rồi gửi lại ngay
+            self._close()
+            self._connect(config)
+            self.server.send_message(msg)
+
+    def _run(self):
+        while True:
+            self.wakeup.clear()
+            job = None
+            if watcher_is_leader:
+                try:
+                    job = claim_email()
+                except Exception:
+                    job = None
+            if job is None:
+                if self.server is not None and time.time() - self.last_used >= SMTP_IDLE_TIMEOUT:
+                    self._close()
+                self.wakeup.wait(NOTIFY_POLL_INTERVAL)
+                continue
+            self.busy = True
+            try:
+                # Đọc cấu hình lúc gửi (không lưu mật khẩu SMTP vào hàng đợi)
+                config, error = _smtp_config(get_settings())
+                if error:
+                    raise ValueError(error)
+                self._deliver(config, job)
+                self.last_used = time.time()
+                self.sent += 1
+                complete_email(job["id"], "sent", time.time(), None)
+            except Exception as e:
+                self._close()
+                if job["attempts"] < EMAIL_MAX_ATTEMPTS:
+                    delay = min(NOTIFY_RETRY_MAX, NOTIFY_RETRY_BASE * (2 ** job["attempts"]))
+                    status, due = "pending", time.time() + delay
+                else:
+                    self.failed += 1
+                    self.last_error = f"Lỗi gửi email: {e}"
+                    print(f"!! Gửi email tới {job['to_email']} thất bại sau {job['attempts']} lần: {e}")
+                    status, due = "failed", time.time()
+                try:
+                    complete_email(job["id"], status, due, str(e)[:500])
+                except Exception:
+                    pass
+            finally:
+                self.busy = False
+
+    def drain(self, timeout: float) -> bool:
+        """Chờ email đang gửi xong (tối đa `timeout` giây); email còn trong bảng do leader kế tiếp gửi"""
+        deadline = time.monotonic() + timeout
+        while self.busy:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.pid == os.getpid(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "connects": self.connects,
+            "connected": self.server is not None,
+            "last_error": self.last_error,
+            "outbox": email_counts(),
+        }
+
+email_dispatcher = EmailDispatcher()
+
+def send_email(to_email: str, subject: str, html_body: str) -> Optional[str]:
+    """Kiểm tra cấu hình rồi đưa email vào hàng đợi gửi nền; trả về lỗi cấu hình hoặc None"""
+    if not to_email:
+        return "Thiếu thông tin cấu hình SMTP."
+    _, error = _smtp_config(get_settings())
+    if error:
+        return error
+    # Ghi vào email_outbox; process leader gửi (có thể không phải worker đang xử lý request này)
+    enqueue_email_db(to_email, subject, html_body)
+    email_dispatcher.wake()
+    return None
 
 # =========================
 # BACKUP IMPORT LOGIC (DÙNG CHUNG CHO RESTORE & STARTUP)
 # =========================
-def import_backup_data(payload: Dict, wipe: bool = False):
-    """Logic cốt lõi để import dữ liệu từ JSON vào DB"""
-    
-    # Khôi phục settings
-    settings = payload.get("settings", {})
-    if isinstance(settings, dict):
-        setting_keys = [
-            "default_chat_id", "default_bot_id", "poll_interval", "global_threshold",
-            "report_email", "smtp_server", "smtp_port", "smtp_user", "smtp_pass"
-        ]
-        for k in setting_keys:
-            if k in settings:
-                set_setting(k, str(settings.get(k) if settings.get(k) is not None else ""))
+@contextmanager
+def _shared_tx(c: sqlite3.Connection):
+    # Restore "tất cả hoặc không": mọi bước dùng chung 1 transaction đang mở
+    yield c
+
+def import_backup_data(payload: Dict, wipe: bool = False, atomic: bool = False) -> Dict[str, int]:
+    """Logic cốt lõi để import dữ liệu từ backup vào DB, trả về số dòng đã nạp theo từng loại.
+
+    Ghi hàng loạt (executemany), ID API cũ -> mới ánh xạ trong RAM.
+    atomic=True: cả lần restore là 1 transaction, gặp dòng lỗi thì huỷ toàn bộ (ValueError / sqlite3.Error).
+    atomic=False: mỗi phần / mỗi lô RESTORE_CHUNK_ROWS dòng lịch sử là 1 transaction, dòng lỗi được bỏ qua.
+    Restore lặp lại không nhân đôi dữ liệu: API khớp theo (tên, URL), dòng lịch sử đã có bị bỏ qua,
+    backup có backup_id đã restore rồi thì bỏ qua cả file.
+    """
+    if atomic:
+        with db.write() as c:
+            return _import_backup(payload, wipe, lambda: _shared_tx(c), strict=True)
+    return _import_backup(payload, wipe, db.write, strict=False)
 
-    if wipe:
-        wipe_table("telegram_bots")
-        wipe_table("apis")
-        wipe_table("balance_history")
+def _import_backup(payload: Dict, wipe: bool, tx, strict: bool) -> Dict[str, int]:
+    started = time.time()
+    stats = {"bots": 0, "apis": 0, "history": 0, "duplicates": 0, "rollups": 0, "alert_rules": 0, "skipped": 0,
+             "already_applied": 0, "missing_parent": 0}
+    info = payload.get("backup") or {}
+    backup_id = info.get("backup_id")
+    if info.get("kind") == "diff" and wipe:
+        raise ValueError("Backup thay đổi chỉ restore chồng lên dữ liệu có sẵn, không dùng cùng tuỳ chọn xoá dữ liệu cũ")
+
+    def bad_row(kind: str, e: Exception):
+        if strict:
+            raise ValueError(f"Dòng {kind} không hợp lệ: {e}")
+        stats["skipped"] += 1
 
-    # Khôi phục bots
     bots = payload.get("bots", [])
-    if isinstance(bots, list):
+    bots = bots if isinstance(bots, list) else []
+    apis_id_map: Dict[int, int] = {}
+
+    with tx() as c:
+        if backup_id and not wipe and c.execute("SELECT 1 FROM backup_applied WHERE backup_id=?", (backup_id,)).fetchone():
+            print(f">> Backup {backup_id} đã restore trước đó, bỏ qua.")
+            stats["already_applied"] = 1
+            return stats
+        parent_id = info.get("parent_id")
+        if parent_id and not c.execute(
+            "SELECT 1 FROM backup_applied WHERE backup_id=? UNION ALL SELECT 1 FROM backup_log WHERE backup_id=?",
+            (parent_id, parent_id),
+        ).fetchone():
+            if strict:
+                raise ValueError(f"Backup thay đổi này nối tiếp backup {parent_id}, hãy restore backup đó trước")
+            print(f"!! Backup thay đổi {backup_id} nối tiếp {parent_id} nhưng backup đó chưa được restore vào DB này.")
+            stats["missing_parent"] = 1
+
+        # Khôi phục settings
+        settings = payload.get("settings", {})
+        if isinstance(settings, dict):
+            setting_keys = [
+                "default_chat_id", "default_bot_id", "poll_interval", "global_threshold",
+                "max_concurrency", "history_retention_days", "notify_coalesce_seconds",
+                "report_email", "smtp_server", "smtp_port", "smtp_user", "smtp_pass"
+            ]
+            c.executemany(
+                "INSERT INTO settings (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                [(k, str(settings.get(k) if settings.get(k) is not None else "")) for k in setting_keys if k in settings],
+            )
+
+        if wipe:
+            for table in ("telegram_bots", "apis", "balance_history", "alert_rules", "backup_applied"):
+                c.execute(f"DELETE FROM {table}")
+            for table, _ in ROLLUP_TABLES.values():
+                c.execute(f"DELETE FROM {table}")
+
+        # Khôi phục bots (token trùng thì bỏ qua)
+        bot_rows = []
         for b in bots:
             try:
                 name = (b.get("bot_name") or "").strip()
                 token = (b.get("bot_token") or "").strip()
                 if name and token:
-                    try:
-                        add_bot_db(name, token)
-                    except sqlite3.IntegrityError:
-                        pass
-            except Exception:
-                continue
+                    bot_rows.append((name, token))
+            except Exception as e:
+                bad_row("bot", e)
+        if bot_rows:
+            stats["bots"] = c.executemany(
+                "INSERT OR IGNORE INTO telegram_bots (bot_name, bot_token) VALUES (?, ?)", bot_rows,
+            ).rowcount
 
-    # Khôi phục apis
-    apis = payload.get("apis", [])
-    apis_id_map = {} 
-    if isinstance(apis, list):
-        for a in apis:
+        # Khôi phục apis: cần ID mới từng dòng để ánh xạ lịch sử / quy tắc (vẫn trong cùng transaction).
+        # API đã có (cùng tên + URL) được dùng lại, chỉ cập nhật số dư nếu backup mới hơn
+        existing: Dict[Tuple[str, str], sqlite3.Row] = {}
+        for r in c.execute("SELECT id, name, url, last_change FROM apis ORDER BY id"):
+            existing.setdefault((r["name"], r["url"]), r)
+        apis = payload.get("apis", [])
+        for a in apis if isinstance(apis, list) else []:
             try:
                 name = (a.get("name") or "").strip()
                 url = (a.get("url") or "").strip()
-                field = (a.get("balance_field") or "").strip()
-                if name and url:
-                    old_id = a.get("id")
-                    new_id = add_api_db(name, url, field)
-                    if old_id is not None:
-                        apis_id_map[int(old_id)] = new_id
-                    try:
-                        last_bal = a.get("last_balance", None)
-                        last_chg = a.get("last_change", None)
-                        if last_bal is not None and last_chg:
-                            update_api_state(new_id, float(last_bal), str(last_chg))
-                    except Exception:
-                        pass
-            except Exception:
-                continue
+                if not name or not url:
+                    continue
+                max_bytes = to_float(str(a.get("max_response_bytes") or ""), None)
+                last_bal = a.get("last_balance", None)
+                last_chg = a.get("last_change", None)
+                has_state = last_bal is not None and bool(last_chg)
+                match = existing.get((name, url))
+                if match is not None:
+                    if has_state and str(last_chg) > (match["last_change"] or ""):
+                        c.execute(
+                            "UPDATE apis SET last_balance=?, last_change=? WHERE id=?",
+                            (float(last_bal), str(last_chg), match["id"]),
+                        )
+                    if a.get("id") is not None:
+                        apis_id_map[int(a["id"])] = int(match["id"])
+                    continue
+                cur = c.execute(
+                    "INSERT INTO apis (name, url, balance_field, last_balance, last_change, poll_interval, "
+                    "max_response_bytes, stream_json, api_group, learned_path) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (name, url, (a.get("balance_field") or "").strip(),
+                     float(last_bal) if has_state else None, str(last_chg) if has_state else None,
+                     to_float(str(a.get("poll_interval") or ""), None), int(max_bytes) if max_bytes else None,
+                     1 if a.get("stream_json") else 0, (a.get("api_group") or "").strip(),
+                     str(a.get("learned_path") or "")),
+                )
+                if a.get("id") is not None:
+                    apis_id_map[int(a["id"])] = int(cur.lastrowid)
+                existing[(name, url)] = c.execute(
+                    "SELECT id, name, url, last_change FROM apis WHERE id=?", (cur.lastrowid,),
+                ).fetchone()
+                stats["apis"] += 1
+            except Exception as e:
+                bad_row("api", e)
+        _bump_version(c, "settings", "bots", "apis", "rules")
+    print(f">> Restore: {stats['bots']} bot, {stats['apis']} API")
 
-    # Khôi phục Lịch sử (nếu có)
+    # Khôi phục Lịch sử (nếu có): mỗi lô 1 executemany + cộng dồn bảng tổng hợp; dòng đã có
+    # (cùng API, thời điểm, biến động, số dư) bị bỏ qua nên restore lại cùng backup không nhân đôi lịch sử
     history = payload.get("history", [])
     if isinstance(history, list) and apis_id_map:
-        for h in history:
-            try:
-                old_api_id = h.get("api_id")
-                new_api_id = apis_id_map.get(int(old_api_id))
-                if new_api_id:
-                    log_transaction(
-                        new_api_id,
-                        h.get("name", ""),
-                        h.get("timestamp", ""),
-                        float(h.get("change_amount", 0)),
-                        float(h.get("new_balance", 0))
+        total = len(history)
+        for start in range(0, total, RESTORE_CHUNK_ROWS):
+            rows = []
+            for h in history[start:start + RESTORE_CHUNK_ROWS]:
+                try:
+                    new_api_id = apis_id_map.get(int(h.get("api_id")))
+                    if new_api_id:
+                        rows.append((
+                            new_api_id, h.get("name", ""), h.get("timestamp", ""),
+                            float(h.get("change_amount", 0)), float(h.get("new_balance", 0)),
+                        ))
+                except Exception as e:
+                    bad_row("history", e)
+            if rows:
+                with tx() as c:
+                    seen = {tuple(r) for r in c.execute(
+                        "SELECT api_id, timestamp, change_amount, new_balance FROM balance_history "
+                        "WHERE timestamp BETWEEN ? AND ?",
+                        (min(r[2] for r in rows), max(r[2] for r in rows)),
+                    )}
+                    fresh = []
+                    for row in rows:
+                        key = (row[0], row[2], row[3], row[4])
+                        if key not in seen:
+                            seen.add(key)
+                            fresh.append(row)
+                    c.executemany(
+                        "INSERT INTO balance_history (api_id, name, timestamp, change_amount, new_balance) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        fresh,
                     )
-            except Exception:
+                    _fold_into_rollups(c, fresh)
+                stats["history"] += len(fresh)
+                stats["duplicates"] += len(rows) - len(fresh)
+            print(f">> Restore lịch sử: {min(start + RESTORE_CHUNK_ROWS, total)}/{total} dòng")
+
+    # Khôi phục tổng hợp (có cả phần lịch sử thô đã dọn) - ghi đè phần vừa cộng dồn từ history ở trên,
+    # trừ khi kỳ đó trong DB đã mới hơn (restore lại backup cũ không làm lùi số liệu)
+    rollups = payload.get("rollups", {})
+    # Backup cũ lưu kỳ theo UTC: dời kỳ giờ sang giờ VN, bỏ kỳ ngày và dựng lại từ kỳ giờ
+    utc_rollups = payload.get("rollup_tz") != "vn"
+    if isinstance(rollups, dict) and apis_id_map:
+        for granularity, (table, _) in ROLLUP_TABLES.items():
+            if utc_rollups and granularity != "hour":
                 continue
+            rows = []
+            for r in rollups.get(granularity) or []:
+                try:
+                    new_api_id = apis_id_map.get(int(r.get("api_id")))
+                    if new_api_id:
+                        period = str(r["period"])
+                        if utc_rollups:
+                            period = vn_period(period + ":00:00Z", len(period))
+                        rows.append((
+                            new_api_id, period, int(r.get("count", 0)),
+                            float(r.get("sum_in", 0)), float(r.get("sum_out", 0)),
+                            float(r["min_balance"]), float(r["max_balance"]),
+                            float(r["close_balance"]), str(r.get("close_ts", "")),
+                        ))
+                except Exception as e:
+                    bad_row("rollup", e)
+            if rows:
+                with tx() as c:
+                    c.executemany(
+                        f"INSERT INTO {table} (api_id, period, count, sum_in, sum_out, "
+                        "min_balance, max_balance, close_balance, close_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT(api_id, period) DO UPDATE SET "
+                        "count=excluded.count, sum_in=excluded.sum_in, sum_out=excluded.sum_out, "
+                        "min_balance=excluded.min_balance, max_balance=excluded.max_balance, "
+                        "close_balance=excluded.close_balance, close_ts=excluded.close_ts "
+                        f"WHERE excluded.close_ts > {table}.close_ts "
+                        f"OR (excluded.close_ts = {table}.close_ts AND excluded.count >= {table}.count)",
+                        rows,
+                    )
+                stats["rollups"] += len(rows)
+        if utc_rollups and stats["rollups"]:
+            with tx() as c:
+                _rebuild_daily_rollups(c, sorted(set(apis_id_map.values())))
+
+    # Khôi phục quy tắc cảnh báo (API / bot được ánh xạ sang ID mới)
+    rules = payload.get("alert_rules", [])
+    if isinstance(rules, list) and rules:
+        old_bot_tokens = {b.get("id"): b.get("bot_token") for b in bots if isinstance(b, dict)}
+        with tx() as c:
+            bot_ids_by_token = {r[1]: r[0] for r in c.execute("SELECT id, bot_token FROM telegram_bots")}
+            for r in rules:
+                try:
+                    rule = dict(r)
+                    if rule.get("api_id") is not None:
+                        rule["api_id"] = apis_id_map.get(int(rule["api_id"]))
+                        if rule["api_id"] is None:
+                            continue
+                    if rule.get("bot_id") is not None:
+                        rule["bot_id"] = bot_ids_by_token.get(old_bot_tokens.get(rule["bot_id"]))
+                    if c.execute(
+                        "SELECT 1 FROM alert_rules WHERE name=? AND api_id IS ? AND api_group=?",
+                        (rule.get("name") or "", rule.get("api_id"), rule.get("api_group") or ""),
+                    ).fetchone():
+                        continue
+                    _insert_alert_rule(c, rule)
+                    stats["alert_rules"] += 1
+                except Exception as e:
+                    bad_row("alert_rule", e)
+            _bump_version(c, "rules")
+
+    if backup_id:
+        with tx() as c:
+            c.execute(
+                "INSERT OR IGNORE INTO backup_applied (backup_id, kind, base_id, applied_at) VALUES (?, ?, ?, ?)",
+                (backup_id, info.get("kind") or "full", info.get("base_id"), datetime.utcnow().isoformat() + "Z"),
+            )
+
+    print(f">> Restore xong trong {time.time() - started:.1f}s: {stats}")
+    return stats
 
 # =========================
 # AUTH & ROUTES
@@ -1138,6 +4337,9 @@ def dashboard():
             self.last_run = d.get("last_run", "") or ""
             self.poll_interval = d.get("poll_interval", "")
             self.global_threshold = d.get("global_threshold", "")
+            self.max_concurrency = d.get("max_concurrency", "")
+            self.history_retention_days = d.get("history_retention_days", "")
+            self.notify_coalesce_seconds = d.get("notify_coalesce_seconds", "")
             self.report_email = d.get("report_email", "")
             self.smtp_server = d.get("smtp_server", "")
             self.smtp_port = d.get("smtp_port", "")
@@ -1145,23 +4347,38 @@ def dashboard():
 
     settings = SettingsObj(settings_raw)
 
-    last_run_iso = settings_raw.get("last_run", "") or ""
+    last_run_iso = get_setting_fresh("last_run")
     dt_last = parse_iso_utc(last_run_iso)
     last_run_vn = fmt_time_label_vn(dt_last) if dt_last else ""
 
+    health = get_api_health()
     apis = []
     for a in apis_raw:
         a2 = dict(a)
+        a2.update(health.get(a2["id"], {}))
         dt_chg = parse_iso_utc(a2.get("last_change") or "")
         a2["last_change_vn"] = fmt_time_label_vn(dt_chg) if dt_chg else "-"
+        a2["err_total"] = sum(int(a2.get(f"err_{k}") or 0) for k in FAILURE_KINDS)
         apis.append(a2)
 
-    effective_poll_interval = to_float(settings.poll_interval or "", None)
-    if effective_poll_interval is None or effective_poll_interval < 5:
-        effective_poll_interval = POLL_INTERVAL_DEFAULT
+    effective_poll_interval = get_poll_interval(settings_raw)
+    watcher_state = watcher_status()
 
     global_threshold = to_float(settings.global_threshold or "", None)
 
+    bot_names = {b["id"]: b["bot_name"] for b in bots}
+    rules = []
+    for r in get_alert_rules():
+        r["bot_name"] = bot_names.get(r["bot_id"], "")
+        rules.append(r)
+    api_groups = sorted({a["api_group"] for a in apis if a.get("api_group")})
+
+    recent_backups = get_recent_backups()
+    for b in recent_backups:
+        dt_backup = parse_iso_utc(b["created_at"])
+        b["created_vn"] = fmt_time_label_vn(dt_backup) if dt_backup else b["created_at"]
+    last_full = next((b for b in recent_backups if b["kind"] == "full"), None)
+
     return render_template_string(
         DASHBOARD_TEMPLATE,
         title=APP_TITLE,
@@ -1169,18 +4386,150 @@ def dashboard():
         apis=apis,
         settings=settings,
         poll_interval=POLL_INTERVAL_DEFAULT,
-        watcher_running=watcher_running,
+        watcher_running=watcher_state["running"],
+        watcher_leader=watcher_state["leader"],
         last_run_vn=last_run_vn,
         effective_poll_interval=int(effective_poll_interval),
         global_threshold=global_threshold,
+        http_stats=http_pool.stats(),
+        watcher_is_leader=watcher_is_leader,
+        startup_restore_error=settings_raw.get(STARTUP_RESTORE_KEY) or "",
+        max_response_default=MAX_RESPONSE_BYTES_DEFAULT,
+        rules=rules,
+        api_groups=api_groups,
+        last_backup=recent_backups[0] if recent_backups else None,
+        recent_backups=recent_backups,
+        diff_parent_id=last_full["backup_id"] if last_full else "",
+    )
+
+def _vn_date_bound(value: str, end_of_day: bool = False) -> Optional[datetime]:
+    # "YYYY-MM-DD" theo giờ VN -> đầu ngày (hoặc đầu ngày hôm sau nếu end_of_day), chưa gắn múi giờ
+    try:
+        d = datetime.strptime(value, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        return None
+    return d + timedelta(days=1) if end_of_day else d
+
+def _vn_date_to_utc_iso(value: str, end_of_day: bool = False) -> Optional[str]:
+    # "YYYY-MM-DD" theo giờ VN -> mốc ISO UTC (so với balance_history.timestamp)
+    d = _vn_date_bound(value, end_of_day)
+    if d is None:
+        return None
+    local = d.replace(tzinfo=VN_TZ)
+    return local.astimezone(timezone.utc).replace(tzinfo=None).isoformat()
+
+@app.route("/history")
+def history():
+    api_id = request.args.get("api_id", "").strip()
+    date_from = request.args.get("from", "").strip()
+    date_to = request.args.get("to", "").strip()
+    direction = request.args.get("direction", "").strip()
+    before = request.args.get("before", "").strip()
+    view = request.args.get("view", "").strip()
+
+    filters = {
+        "api_id": int(api_id) if api_id.isdigit() else None,
+        "date_from": date_from,
+        "date_to": date_to,
+        "direction": direction if direction in ("in", "out") else "",
+        "before": before or None,
+        "view": view if view in ROLLUP_TABLES else "",
+    }
+    if filters["view"]:
+        # Kỳ dài đọc bảng tổng hợp nhỏ thay vì quét lịch sử thô; cursor dạng "period|api_id".
+        # Khoá kỳ theo giờ VN nên lọc thẳng bằng ngày VN, không đổi sang UTC
+        since_vn = _vn_date_bound(date_from)
+        until_vn = _vn_date_bound(date_to, end_of_day=True)
+        period, _, cursor_api = before.partition("|")
+        rows, cursor = query_balance_rollups(
+            filters["view"],
+            api_id=filters["api_id"],
+            since=since_vn.isoformat() if since_vn else None,
+            until=until_vn.isoformat() if until_vn else None,
+            before=(period, int(cursor_api)) if period and cursor_api.isdigit() else None,
+        )
+        next_cursor = f"{cursor[0]}|{cursor[1]}" if cursor else None
+        for r in rows:
+            r["period_label"] = r["period"].replace("T", " ") + (":00" if filters["view"] == "hour" else "")
+    else:
+        rows, next_cursor = query_balance_history(
+            api_id=filters["api_id"],
+            since=_vn_date_to_utc_iso(date_from),
+            until=_vn_date_to_utc_iso(date_to, end_of_day=True),
+            direction=filters["direction"] or None,
+            before_id=int(before) if before.isdigit() else None,
+        )
+        for r in rows:
+            dt = parse_iso_utc(r.get("timestamp") or "")
+            r["time_vn"] = fmt_time_label_vn(dt) if dt else r.get("timestamp")
+
+    page_args = {k: v for k, v in {
+        "api_id": filters["api_id"], "from": date_from, "to": date_to, "direction": filters["direction"],
+        "view": filters["view"],
+    }.items() if v}
+
+    return render_template_string(
+        HISTORY_TEMPLATE,
+        title=APP_TITLE,
+        apis=get_apis(),
+        rows=rows,
+        filters=filters,
+        next_cursor=next_cursor,
+        page_args=page_args,
     )
 
+@app.route("/samples/<int:api_id>")
+def samples(api_id: int):
+    """Chuỗi mẫu đầy đủ của 1 API (JSON): ?since=&until= (epoch giây), ?limit="""
+    since = to_float(request.args.get("since", ""), None)
+    until = to_float(request.args.get("until", ""), None)
+    limit = int(to_float(request.args.get("limit", ""), None) or SAMPLES_LIMIT_MAX)
+    rows = sample_store.read(api_id, since, until, max(1, min(limit, SAMPLES_LIMIT_MAX)))
+    return {
+        "api_id": api_id,
+        "enabled": sample_store.enabled,
+        "fields": ["ts", "balance", "latency_ms", "status"],
+        "samples": [list(r) for r in rows],
+    }
+
 @app.route("/save_settings", methods=["POST"])
 def save_settings():
     default_chat_id = (request.form.get("default_chat_id") or "").strip()
     default_bot_id = (request.form.get("default_bot_id") or "").strip()
     poll_interval = (request.form.get("poll_interval") or "").strip()
     global_threshold = (request.form.get("global_threshold") or "").strip()
+    max_concurrency = (request.form.get("max_concurrency") or "").strip()
+    history_retention_days = (request.form.get("history_retention_days") or "").strip()
+    notify_coalesce_seconds = (request.form.get("notify_coalesce_seconds") or "").strip()
+
+    if max_concurrency:
+        try:
+            mc = int(float(max_concurrency))
+            if mc < 1 or mc > MAX_CONCURRENCY_LIMIT:
+                flash(f"Số API quét song song phải từ 1 đến {MAX_CONCURRENCY_LIMIT}.", "error")
+                return redirect(url_for("dashboard"))
+        except Exception:
+            flash("Số API quét song song không hợp lệ.", "error")
+            return redirect(url_for("dashboard"))
+
+    if history_retention_days:
+        try:
+            if int(float(history_retention_days)) < 1:
+                flash("Số ngày giữ lịch sử tối thiểu là 1.", "error")
+                return redirect(url_for("dashboard"))
+        except Exception:
+            flash("Số ngày giữ lịch sử không hợp lệ.", "error")
+            return redirect(url_for("dashboard"))
+
+    if notify_coalesce_seconds:
+        try:
+            ncs = int(float(notify_coalesce_seconds))
+            if ncs < 0 or ncs > NOTIFY_COALESCE_MAX:
+                flash(f"Thời gian gộp tin phải từ 0 đến {NOTIFY_COALESCE_MAX} giây.", "error")
+                return redirect(url_for("dashboard"))
+        except Exception:
+            flash("Thời gian gộp tin không hợp lệ.", "error")
+            return redirect(url_for("dashboard"))
 
     if poll_interval:
         try:
@@ -1196,6 +4545,9 @@ def save_settings():
     set_setting("default_bot_id", default_bot_id)
     set_setting("poll_interval", poll_interval)
     set_setting("global_threshold", global_threshold)
+    set_setting("max_concurrency", max_concurrency)
+    set_setting("history_retention_days", history_retention_days)
+    set_setting("notify_coalesce_seconds", notify_coalesce_seconds)
     
     set_setting("report_email", (request.form.get("report_email") or "").strip())
     set_setting("smtp_server", (request.form.get("smtp_server") or "").strip())
@@ -1264,7 +4616,7 @@ def test_bot():
 
     send_telegram([bot["bot_token"]], chat_id,
                   "✅ <b>Test thành công</b>\nBot đã kết nối và sẵn sàng gửi cảnh báo biến động số dư.")
-    flash("Đã gửi test message đến Telegram.", "ok")
+    flash("Đã đưa test message vào hàng đợi gửi Telegram.", "ok")
     return redirect(url_for("dashboard"))
 
 @app.route("/test_email", methods=["POST"])
@@ -1290,7 +4642,7 @@ def test_email():
     if error:
         flash(f"Gửi email test thất bại: {error}", "error")
     else:
-        flash(f"Đã gửi email test thành công đến {to_email}", "ok")
+        flash(f"Đã đưa email test vào hàng đợi gửi đến {to_email} (kết quả xem tại /stats).", "ok")
         
     return redirect(url_for("dashboard"))
 
@@ -1299,105 +4651,399 @@ def add_api():
     name = (request.form.get("name") or "").strip()
     url = (request.form.get("url") or "").strip()
     balance_field = (request.form.get("balance_field") or "").strip()
+    poll_interval_raw = (request.form.get("poll_interval") or "").strip()
+    max_response_kb = (request.form.get("max_response_kb") or "").strip()
+    stream_json = request.form.get("stream_json") == "1"
+    api_group = (request.form.get("api_group") or "").strip()
     if not name or not url:
         flash("Thiếu tên hoặc URL API.", "error")
         return redirect(url_for("dashboard"))
-    add_api_db(name, url, balance_field)
+    poll_interval = None
+    if poll_interval_raw:
+        poll_interval = to_float(poll_interval_raw, None)
+        if poll_interval is None or poll_interval < POLL_INTERVAL_MIN_API:
+            flash(f"Chu kỳ riêng tối thiểu là {POLL_INTERVAL_MIN_API} giây.", "error")
+            return redirect(url_for("dashboard"))
+    max_response_bytes = None
+    if max_response_kb:
+        kb = to_float(max_response_kb, None)
+        if kb is None or kb < 1:
+            flash("Giới hạn response không hợp lệ.", "error")
+            return redirect(url_for("dashboard"))
+        max_response_bytes = int(kb * 1024)
+    add_api_db(name, url, balance_field, poll_interval, max_response_bytes, stream_json, api_group)
+    watcher_wakeup.set()
     flash(f"Đã thêm API [{name}].", "ok")
     return redirect(url_for("dashboard"))
 
 @app.route("/delete_api/<int:api_id>", methods=["POST"])
 def delete_api(api_id: int):
     delete_api_db(api_id)
+    # File mẫu / validator do watcher dọn khi thấy API biến mất (watcher có thể ở process khác)
+    watcher_wakeup.set()
     flash(f"Đã xoá API ID {api_id}.", "ok")
     return redirect(url_for("dashboard"))
 
+@app.route("/add_rule", methods=["POST"])
+def add_rule():
+    name = (request.form.get("name") or "").strip()
+    if not name:
+        flash("Thiếu tên quy tắc.", "error")
+        return redirect(url_for("dashboard"))
+    rule: Dict[str, Any] = {"name": name, "chat_id": (request.form.get("chat_id") or "").strip()}
+
+    target = (request.form.get("target") or "").strip()
+    if target.startswith("api:"):
+        try:
+            rule["api_id"] = int(target[4:])
+        except ValueError:
+            flash("API không hợp lệ.", "error")
+            return redirect(url_for("dashboard"))
+    elif target.startswith("group:"):
+        rule["api_group"] = target[6:].strip()
+
+    for key, label in (("threshold", "Ngưỡng"), ("min_change", "Biến động tối thiểu"), ("max_rate", "Tốc độ tối đa")):
+        raw = (request.form.get(key) or "").strip()
+        if raw:
+            value = to_float(raw, None)
+            if value is None or value < 0:
+                flash(f"{label} phải là số không âm.", "error")
+                return redirect(url_for("dashboard"))
+            rule[key] = value
+
+    quiet_start = (request.form.get("quiet_start") or "").strip()
+    quiet_end = (request.form.get("quiet_end") or "").strip()
+    if quiet_start or quiet_end:
+        if _parse_hhmm(quiet_start) is None or _parse_hhmm(quiet_end) is None:
+            flash("Giờ yên lặng phải có dạng HH:MM (cả bắt đầu và kết thúc).", "error")
+            return redirect(url_for("dashboard"))
+        rule["quiet_start"], rule["quiet_end"] = quiet_start, quiet_end
+
+    bot_id = (request.form.get("bot_id") or "").strip()
+    if bot_id:
+        try:
+            rule["bot_id"] = int(bot_id)
+        except ValueError:
+            flash("ID bot không hợp lệ.", "error")
+            return redirect(url_for("dashboard"))
+
+    add_alert_rule_db(rule)
+    flash(f"Đã thêm quy tắc [{name}].", "ok")
+    return redirect(url_for("dashboard"))
+
+@app.route("/delete_rule/<int:rule_id>", methods=["POST"])
+def delete_rule(rule_id: int):
+    delete_alert_rule_db(rule_id)
+    flash(f"Đã xoá quy tắc ID {rule_id}.", "ok")
+    return redirect(url_for("dashboard"))
+
 # =========================
 # BACKUP & RESTORE
 # =========================
-def _get_balance_history():
-    with db_lock:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute("SELECT * FROM balance_history ORDER BY id")
-        rows = c.fetchall()
-        conn.close()
+def _iter_table_rows(table: str, where: str = "", params: tuple = (), chunk: int = BACKUP_CHUNK_ROWS):
+    # Keyset theo rowid: mỗi lô 1 lần đọc ngắn, không giữ transaction / kết nối trong lúc client tải
+    last = 0
+    cond = f" AND {where}" if where else ""
+    while True:
+        with db.read() as c:
+            rows = c.execute(
+                f"SELECT rowid AS _rowid, * FROM {table} WHERE rowid > ?{cond} ORDER BY rowid LIMIT ?",
+                (last, *params, chunk),
+            ).fetchall()
+        for r in rows:
+            row = dict(r)
+            last = row.pop("_rowid")
+            yield row
+        if len(rows) < chunk:
+            return
+
+def get_last_backup(kind: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    with db.read() as c:
+        if kind:
+            row = c.execute("SELECT * FROM backup_log WHERE kind=? ORDER BY rowid DESC LIMIT 1", (kind,)).fetchone()
+        else:
+            row = c.execute("SELECT * FROM backup_log ORDER BY rowid DESC LIMIT 1").fetchone()
+    return dict(row) if row else None
+
+def get_backup(backup_id: str) -> Optional[Dict[str, Any]]:
+    with db.read() as c:
+        row = c.execute("SELECT * FROM backup_log WHERE backup_id=?", (backup_id,)).fetchone()
+    return dict(row) if row else None
+
+def get_recent_backups(limit: int = 10) -> List[Dict[str, Any]]:
+    with db.read() as c:
+        rows = c.execute("SELECT * FROM backup_log ORDER BY rowid DESC LIMIT ?", (limit,)).fetchall()
     return [dict(r) for r in rows]
 
+def new_backup_header(parent: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Header backup: toàn bộ (parent=None) hoặc chỉ phần thay đổi sau backup `parent` (mốc balance_history.id)"""
+    with db.read() as c:
+        watermark = c.execute("SELECT COALESCE(MAX(id), 0) FROM balance_history").fetchone()[0]
+    header = {
+        "type": "header", "version": BACKUP_VERSION, "generated_at_utc": datetime.utcnow().isoformat() + "Z",
+        "backup_id": uuid.uuid4().hex, "kind": "full", "base_id": None, "parent_id": None,
+        "since": 0, "watermark": int(watermark), "rollup_tz": "vn",
+    }
+    if parent:
+        header.update({
+            "kind": "diff", "base_id": parent.get("base_id") or parent["backup_id"],
+            "parent_id": parent["backup_id"], "since": int(parent["watermark"]),
+        })
+    return header
+
+def iter_backup_records(header: Dict[str, Any]):
+    """Các bản ghi backup theo thứ tự restore: header, settings, bots, apis, history, rollups, quy tắc.
+
+    Cấu hình / bot / API / quy tắc luôn đủ (nhỏ); lịch sử chỉ gồm id trong (since, watermark],
+    tổng hợp chỉ gồm các kỳ có lịch sử mới (close_ts >= thời điểm sớm nhất của phần lịch sử đó).
+    """
+    since, watermark = header["since"], header["watermark"]
+    yield header
+    yield {"type": "settings", "data": get_settings()}
+    for b in get_bots():
+        yield {"type": "bot", "data": b}
+    for a in get_apis():
+        yield {"type": "api", "data": a}
+    for h in _iter_table_rows("balance_history", "rowid > ? AND rowid <= ?", (since, watermark)):
+        yield {"type": "history", "data": h}
+    rollup_where, rollup_params = "", ()
+    if since:
+        with db.read() as c:
+            first_ts = c.execute(
+                "SELECT MIN(timestamp) FROM balance_history WHERE id > ? AND id <= ?", (since, watermark),
+            ).fetchone()[0]
+        rollup_where, rollup_params = "close_ts >= ?", (first_ts,)
+    if not since or first_ts:
+        for granularity, (table, _) in ROLLUP_TABLES.items():
+            for r in _iter_table_rows(table, rollup_where, rollup_params):
+                yield {"type": "rollup", "granularity": granularity, "data": r}
+    for r in get_alert_rules():
+        yield {"type": "alert_rule", "data": r}
+
+def _record_backup(header: Dict[str, Any]):
+    with db.write() as c:
+        c.execute(
+            "INSERT OR IGNORE INTO backup_log (backup_id, kind, base_id, parent_id, since_id, watermark, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (header["backup_id"], header["kind"], header["base_id"], header["parent_id"], header["since"],
+             header["watermark"], header["generated_at_utc"]),
+        )
+
+def iter_backup_gzip(header: Dict[str, Any]):
+    # Nén gzip từng phần khi sinh dòng; chỉ trả ra khi zlib có dữ liệu
+    z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for rec in iter_backup_records(header):
+        out = z.compress((json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8"))
+        if out:
+            yield out
+    yield z.flush()
+    # Chỉ ghi nhận khi client đã nhận hết file: backup thay đổi lần sau nối tiếp từ mốc này
+    _record_backup(header)
+
+# Loại bản ghi NDJSON -> danh sách trong payload (dạng JSON version 3)
+BACKUP_RECORD_LISTS = {"bot": "bots", "api": "apis", "history": "history", "alert_rule": "alert_rules"}
+
+def _read_backup_ndjson(header: Dict[str, Any], lines) -> Dict[str, Any]:
+    payload: Dict[str, Any] = {
+        "settings": {}, "rollups": {g: [] for g in ROLLUP_TABLES},
+        "version": header.get("version"), "generated_at_utc": header.get("generated_at_utc"),
+        "rollup_tz": header.get("rollup_tz"),
+        "backup": {k: header.get(k) for k in ("backup_id", "kind", "base_id", "parent_id", "since", "watermark")},
+    }
+    for key in BACKUP_RECORD_LISTS.values():
+        payload[key] = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        rec = json.loads(line)
+        kind = rec.get("type")
+        if kind == "settings":
+            payload["settings"] = rec.get("data") or {}
+        elif kind == "rollup":
+            payload["rollups"].setdefault(rec.get("granularity"), []).append(rec.get("data") or {})
+        elif kind in BACKUP_RECORD_LISTS:
+            payload[BACKUP_RECORD_LISTS[kind]].append(rec.get("data") or {})
+    return payload
+
+def read_backup_file(fileobj) -> Dict[str, Any]:
+    """Đọc file backup (binary): NDJSON nén gzip / không nén (version 4) hoặc JSON 1 khối (version 3)"""
+    magic = fileobj.read(2)
+    fileobj.seek(0)
+    if magic == b"\x1f\x8b":
+        fileobj = gzip.GzipFile(fileobj=fileobj, mode="rb")
+    reader = codecs.getreader("utf-8")(fileobj)
+    first = reader.readline()
+    try:
+        head = json.loads(first)
+    except ValueError:
+        head = None
+    if isinstance(head, dict) and head.get("type") == "header":
+        return _read_backup_ndjson(head, reader)
+    if isinstance(head, dict):
+        return head
+    payload = json.loads(first + reader.read())
+    if not isinstance(payload, dict):
+        raise ValueError("Định dạng backup không hợp lệ")
+    return payload
+
 @app.route("/download_backup")
 def download_backup():
-    data = {
-        "settings": get_settings(),
-        "bots": get_bots(),
-        "apis": get_apis(),
-        "history": _get_balance_history(),
-        "generated_at_utc": datetime.utcnow().isoformat() + "Z",
-        "version": 3,
-    }
-    backup_json = json.dumps(data, ensure_ascii=False, indent=2)
+    parent = None
+    if request.args.get("mode") == "diff":
+        # Mặc định nối từ backup toàn bộ gần nhất (không từ lần tải gần nhất: file đó có thể đã bị bỏ,
+        # mỗi file thay đổi đã chứa đủ từ mốc backup toàn bộ); ?since=<backup_id> để chọn mốc khác
+        since_id = (request.args.get("since") or "").strip()
+        parent = get_backup(since_id) if since_id else get_last_backup("full")
+        if not parent:
+            if since_id:
+                flash(f"Không tìm thấy backup {since_id} để so sánh.", "error")
+            else:
+                flash("Chưa có backup toàn bộ nào để so sánh, hãy tải backup toàn bộ trước.", "error")
+            return redirect(url_for("dashboard"))
+    header = new_backup_header(parent)
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    filename = f"balance_watcher_backup_{stamp}_{header['kind']}.ndjson.gz"
     return Response(
-        backup_json,
-        mimetype="application/json",
-        headers={"Content-Disposition": 'attachment; filename="balance_watcher_backup.json"'},
+        iter_backup_gzip(header),
+        mimetype="application/gzip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
 
 @app.route("/restore_backup", methods=["POST"])
 def restore_backup():
     file = request.files.get("backup_file")
-    if not file or not file.filename.lower().endswith(".json"):
-        flash("Vui lòng chọn file .json hợp lệ.", "error")
+    if not file or not file.filename.lower().endswith((".json", ".ndjson", ".gz")):
+        flash("Vui lòng chọn file backup .ndjson.gz hoặc .json hợp lệ.", "error")
         return redirect(url_for("dashboard"))
 
     try:
-        payload = json.loads(file.read().decode("utf-8"))
+        payload = read_backup_file(file.stream)
     except Exception as e:
-        flash(f"Không đọc được JSON: {e}", "error")
-        return redirect(url_for("dashboard"))
-
-    if not isinstance(payload, dict):
-        flash("Định dạng backup không hợp lệ.", "error")
+        flash(f"Không đọc được file backup: {e}", "error")
         return redirect(url_for("dashboard"))
 
     wipe = (request.form.get("wipe") == "1")
-    
+    atomic = (request.form.get("atomic") == "1")
+
     # Gọi logic import
-    import_backup_data(payload, wipe)
+    try:
+        stats = import_backup_data(payload, wipe, atomic)
+    except (ValueError, sqlite3.Error) as e:
+        flash(f"Restore thất bại, dữ liệu cũ được giữ nguyên: {e}", "error")
+        return redirect(url_for("dashboard"))
+    watcher_wakeup.set()
 
-    flash("Phục hồi dữ liệu từ JSON thành công.", "ok")
+    if stats["already_applied"]:
+        flash("Backup này đã được restore trước đó, không có gì thay đổi.", "ok")
+        return redirect(url_for("dashboard"))
+    if stats["missing_parent"]:
+        parent_id = (payload.get("backup") or {}).get("parent_id")
+        flash(f"Cảnh báo: backup nối tiếp {parent_id} chưa được restore vào DB này, lịch sử có thể bị thiếu đoạn.", "error")
+    flash(
+        f"Phục hồi dữ liệu từ backup thành công: {stats['apis']} API, {stats['history']} dòng lịch sử mới"
+        + (f", bỏ qua {stats['skipped']} dòng lỗi." if stats["skipped"] else "."),
+        "ok",
+    )
     return redirect(url_for("dashboard"))
 
 @app.route("/health")
 def health():
-    return {"status": "ok", "watcher_running": watcher_running}
+    status = watcher_status()
+    return {"status": "ok", "watcher_running": status["running"], "watcher_leader": status["this_worker_is_leader"],
+            "startup_restore_ok": not get_setting_fresh(STARTUP_RESTORE_KEY)}
+
+@app.route("/stats")
+def stats():
+    return {
+        "watcher": watcher_status(),
+        "http_pool": http_pool.stats(),
+        "db_pool": db.stats(),
+        "write_buffer": write_buffer.stats(),
+        "catalog_cache": catalog_cache.stats(),
+        "sample_store": sample_store.stats(),
+        "notifications": notifier.stats(),
+        "email": email_dispatcher.stats(),
+        "breakers": breakers.stats(),
+        "rate_limits": host_limiter.stats(),
+    }
 
 # =========================
 # KHỞI ĐỘNG & AUTO RESTORE
 # =========================
-def init_and_run():
+def restore_secret_backup(path: str, atomic: bool = SECRET_BACKUP_ATOMIC) -> Optional[str]:
+    """Restore file backup lúc khởi động; trả về lỗi / cảnh báo (đồng thời lưu vào settings STARTUP_RESTORE_KEY)"""
+    print(f"[{datetime.now()}] Phát hiện Secret Backup tại: {path}. Đang tự động khôi phục...")
+    problem = None
+    try:
+        with open(path, 'rb') as f:
+            backup_data = read_backup_file(f)
+
+        # Kiểm tra xem DB có trống không, nếu trống thì mới nạp (hoặc nạp đè)
+        # Ở đây ta sẽ nạp đè các cấu hình nhưng KHÔNG xoá dữ liệu cũ (wipe=False)
+        # để đảm bảo an toàn, trừ khi bạn muốn force wipe.
+        # Nếu Render khởi động lại (re-deploy), DB trong /data vẫn còn, nên ta chỉ merge config.
+        # Nếu không dùng disk /data, DB sẽ trống, nó sẽ nạp mới.
+        stats = import_backup_data(backup_data, wipe=False, atomic=atomic)
+        if stats["already_applied"]:
+            # Khởi động lại với cùng file: giữ nguyên kết quả (và cảnh báo) của lần nạp trước
+            return None
+        warnings = []
+        if stats["skipped"]:
+            warnings.append(f"bỏ qua {stats['skipped']} dòng lỗi")
+        if stats["missing_parent"]:
+            warnings.append(f"backup nối tiếp {(backup_data.get('backup') or {}).get('parent_id')} chưa được restore")
+        if warnings:
+            problem = "Khôi phục Secret Backup có cảnh báo: " + ", ".join(warnings) + "."
+        else:
+            print(">> Đã khôi phục dữ liệu từ Secret File thành công.")
+    except Exception as e:
+        problem = f"Khôi phục Secret Backup thất bại, chưa nạp gì vào DB: {e}"
+    if problem:
+        print(f"!! {problem}")
+    try:
+        set_setting(STARTUP_RESTORE_KEY, problem or "")
+    except Exception:
+        pass
+    return problem
+
+def init_and_run(start_watcher: bool = True):
     init_db()
     
     # ! TÍNH NĂNG MỚI: AUTO RESTORE TỪ SECRET FILE KHI KHỞI ĐỘNG
     if SECRET_BACKUP_FILE_PATH and os.path.exists(SECRET_BACKUP_FILE_PATH):
-        print(f"[{datetime.now()}] Phát hiện Secret Backup tại: {SECRET_BACKUP_FILE_PATH}. Đang tự động khôi phục...")
+        restore_secret_backup(SECRET_BACKUP_FILE_PATH)
+    
+    if start_watcher:
+        start_watcher_once()
+
+def run_watcher_forever():
+    """`python app.py watch`: chỉ chạy watcher ở foreground, không khởi động Flask"""
+    global watcher_started
+    watcher_started = True
+    if WATCHER_CPU_AFFINITY and hasattr(os, "sched_setaffinity"):
         try:
-            with open(SECRET_BACKUP_FILE_PATH, 'r', encoding='utf-8') as f:
-                backup_data = json.load(f)
-            
-            # Kiểm tra xem DB có trống không, nếu trống thì mới nạp (hoặc nạp đè)
-            # Ở đây ta sẽ nạp đè các cấu hình nhưng KHÔNG xoá dữ liệu cũ (wipe=False) 
-            # để đảm bảo an toàn, trừ khi bạn muốn force wipe.
-            # Nếu Render khởi động lại (re-deploy), DB trong /data vẫn còn, nên ta chỉ merge config.
-            # Nếu không dùng disk /data, DB sẽ trống, nó sẽ nạp mới.
-            import_backup_data(backup_data, wipe=False)
-            print(">> Đã khôi phục dữ liệu từ Secret File thành công.")
+            cpus = {int(x) for x in WATCHER_CPU_AFFINITY.split(",") if x.strip()}
+            os.sched_setaffinity(0, cpus)
+            print(f">> Watcher ghim vào CPU {sorted(cpus)}")
         except Exception as e:
-            print(f"!! Lỗi khi đọc Secret Backup: {e}")
-    
-    start_watcher_once()
+            print(f"!! Không đặt được CPU affinity: {e}")
+    # SIGTERM -> thoát sạch để atexit trả lease cho process khác
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    atexit.register(_release_lease_on_exit)
+    print(f"[{datetime.now()}] Watcher độc lập {WATCHER_ID} đang chạy (DB: {DB_PATH})")
+    try:
+        watcher_loop()
+    except KeyboardInterrupt:
+        pass
 
-init_and_run()
+WATCH_COMMAND = __name__ == "__main__" and sys.argv[1:2] == ["watch"]
+
+init_and_run(start_watcher=not WATCH_COMMAND)
 
 if __name__ == "__main__":
-    port = int(os.getenv("PORT", "5000"))
-    app.run(host="0.0.0.0", port=port)
+    if WATCH_COMMAND:
+        run_watcher_forever()
+    else:
+        port = int(os.getenv("PORT", "5000"))
+        app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,24 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py khởi tạo DB + watcher ngay khi import: tắt watcher và cho DB mặc định vào thư mục tạm
+os.environ["WATCHER_MODE"] = "off"
+os.chdir(tempfile.mkdtemp(prefix="balance_watcher_test_"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """Module app trỏ vào 1 DB SQLite mới trong tmp_path"""
+    path = str(tmp_path / "balance_watcher.db")
+    monkeypatch.setattr(app_module, "db", app_module.DbPool(path, 2))
+    monkeypatch.setattr(app_module, "catalog_cache", app_module.CatalogCache(path))
+    app_module.init_db()
+    app_module.write_buffer._reset()
+    yield app_module
+    app_module.write_buffer._reset()
@@ -0,0 +1,99 @@
+from datetime import datetime
+
+
+API = {"id": 1, "name": "Shop A", "api_group": "shops"}
+
+
+def _event(old, new, at=datetime(2026, 1, 2, 3, 0), prev_change=None, api=API):
+    return {"api": api, "old": old, "new": new, "diff": new - old, "at": at, "prev_change": prev_change,
+            "time_label": "x"}
+
+
+def _rules(app, *rows):
+    return app.RuleSet([app.AlertRule(dict(r, id=i)) for i, r in enumerate(rows, 1)])
+
+
+def _kinds(rows):
+    # (kind, chat_id, bot_token) mỗi dòng outbox
+    return sorted((r[1], r[2], r[3]) for r in rows)
+
+
+def test_fallback_rule_uses_default_chat_and_threshold(app):
+    fallback = app.default_alert_rule({"global_threshold": "500", "default_chat_id": "100"})
+    rows = app.evaluate_alerts([_event(1000, 400)], _rules(app), fallback, [], ["tok"])
+    assert _kinds(rows) == [("change", "100", "tok"), ("threshold", "100", "tok")]
+    # Đã dưới ngưỡng từ trước: không báo lại
+    rows = app.evaluate_alerts([_event(400, 300)], _rules(app), fallback, [], ["tok"])
+    assert _kinds(rows) == [("change", "100", "tok")]
+
+
+def test_most_specific_scope_wins(app):
+    fallback = app.default_alert_rule({})
+    rule_set = _rules(
+        app,
+        {"chat_id": "global"},
+        {"api_group": "shops", "chat_id": "group"},
+        {"api_id": 1, "chat_id": "api"},
+    )
+    chats = lambda api: {r[2] for r in app.evaluate_alerts([_event(1, 2, api=api)], rule_set, fallback, [], ["t"])}
+    assert chats(API) == {"api"}
+    assert chats({"id": 2, "name": "B", "api_group": "shops"}) == {"group"}
+    assert chats({"id": 3, "name": "C", "api_group": ""}) == {"global"}
+
+
+def test_rules_sharing_a_chat_emit_each_kind_once(app):
+    rule_set = _rules(app, {"api_id": 1, "chat_id": "100", "threshold": 50},
+                      {"api_id": 1, "chat_id": "100", "threshold": 80})
+    rows = app.evaluate_alerts([_event(100, 10)], rule_set, app.default_alert_rule({}), [], ["tok"])
+    assert _kinds(rows) == [("change", "100", "tok"), ("threshold", "100", "tok")]
+
+
+def test_quiet_hours_and_min_change_only_silence_change_messages(app):
+    # 03:00 UTC = 10:00 giờ VN
+    rule_set = _rules(app, {"api_id": 1, "chat_id": "100", "threshold": 50, "quiet_start": "09:00",
+                            "quiet_end": "11:00"})
+    rows = app.evaluate_alerts([_event(100, 10)], rule_set, app.default_alert_rule({}), [], ["tok"])
+    assert _kinds(rows) == [("threshold", "100", "tok")]
+    rule_set = _rules(app, {"api_id": 1, "chat_id": "100", "min_change": 1000})
+    assert app.evaluate_alerts([_event(100, 10)], rule_set, app.default_alert_rule({}), [], ["tok"]) == []
+
+
+def test_max_rate_alert(app):
+    rule_set = _rules(app, {"api_id": 1, "chat_id": "100", "max_rate": 10, "min_change": 10**9})
+    fast = _event(1000, 0, at=datetime(2026, 1, 2, 3, 10), prev_change="2026-01-02T03:00:00Z")
+    slow = _event(1000, 950, at=datetime(2026, 1, 2, 3, 10), prev_change="2026-01-02T03:00:00Z")
+    fallback = app.default_alert_rule({})
+    assert _kinds(app.evaluate_alerts([fast], rule_set, fallback, [], ["tok"])) == [("rate", "100", "tok")]
+    assert app.evaluate_alerts([slow], rule_set, fallback, [], ["tok"]) == []
+
+
+def test_rule_bot_overrides_default_tokens(app):
+    rule_set = _rules(app, {"api_id": 1, "chat_id": "100", "bot_id": 9})
+    bots = [{"id": 9, "bot_token": "bot9"}]
+    rows = app.evaluate_alerts([_event(1, 2)], rule_set, app.default_alert_rule({}), bots, ["a", "b"])
+    assert _kinds(rows) == [("change", "100", "bot9")]
+    rows = app.evaluate_alerts([_event(1, 2)], _rules(app, {"chat_id": "100"}), app.default_alert_rule({}),
+                               bots, ["a", "b"])
+    assert _kinds(rows) == [("change", "100", "a"), ("change", "100", "b")]
+
+
+def test_same_event_yields_same_idem_keys(app):
+    rule_set = _rules(app, {"chat_id": "100", "threshold": 50})
+    ev = _event(100, 10, prev_change="2026-01-02T02:00:00Z")
+    first = app.evaluate_alerts([ev], rule_set, app.default_alert_rule({}), [], ["tok"])
+    second = app.evaluate_alerts([ev], rule_set, app.default_alert_rule({}), [], ["tok"])
+    assert [r[0] for r in first] == [r[0] for r in second]
+    assert len({r[0] for r in first}) == 2
+
+
+def test_revert_events_restores_previous_balance(app):
+    buf = app.write_buffer
+    ev = _event(100, 10, prev_change="2026-01-02T02:00:00Z")
+    stamp = ev["at"].isoformat() + "Z"
+    buf.set_state(1, 10, stamp)
+    buf.add_history(1, "Shop A", stamp, -90, 10)
+    buf.add_history(2, "Shop B", stamp, 5, 5)
+    buf.revert_events([ev])
+    assert buf.pending_balance(1, None) == 100
+    assert buf.pending_change(1, None) == "2026-01-02T02:00:00Z"
+    assert [h[0] for h in buf.history] == [2]
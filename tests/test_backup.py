@@ -0,0 +1,196 @@
+import gzip
+import io
+import json
+
+import pytest
+
+
+def _add_history(app, api_id, start, n):
+    rows = [(api_id, "Shop A", f"2026-01-02T{(start + i) // 60:02d}:{(start + i) % 60:02d}:00Z", 1.0, float(start + i))
+            for i in range(n)]
+    with app.db.write() as c:
+        c.executemany(
+            "INSERT INTO balance_history (api_id, name, timestamp, change_amount, new_balance) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        app._fold_into_rollups(c, rows)
+
+
+def _download(app, parent=None) -> bytes:
+    return b"".join(app.iter_backup_gzip(app.new_backup_header(parent)))
+
+
+def _counts(app):
+    with app.db.read() as c:
+        return {t: c.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+                for t in ("telegram_bots", "apis", "balance_history", "balance_rollup_daily", "alert_rules")}
+
+
+@pytest.fixture
+def seeded(app):
+    app.add_bot_db("Bot", "123:abc")
+    api_id = app.add_api_db("Shop A", "http://shop-a.test", "data.balance")
+    app.add_alert_rule_db({"name": "low", "api_id": api_id, "threshold": 5})
+    _add_history(app, api_id, 0, 30)
+    return app
+
+
+@pytest.fixture
+def fresh_db(app, tmp_path, monkeypatch):
+    """Chuyển app sang 1 DB trống khác (đích restore)"""
+    def switch():
+        path = str(tmp_path / "restored.db")
+        monkeypatch.setattr(app, "db", app.DbPool(path, 2))
+        monkeypatch.setattr(app, "catalog_cache", app.CatalogCache(path))
+        app.init_db()
+    return switch
+
+
+V3 = {
+    "version": 3,
+    "generated_at_utc": "2026-01-02T00:00:00Z",
+    "settings": {"default_chat_id": "100", "poll_interval": "30"},
+    "bots": [{"bot_name": "Bot", "bot_token": "123:abc"}],
+    "apis": [{"id": 7, "name": "Shop A", "url": "http://shop-a.test", "balance_field": "balance",
+              "last_balance": 2.0, "last_change": "2026-01-02T00:01:00Z"}],
+    "history": [
+        {"api_id": 7, "name": "Shop A", "timestamp": "2026-01-02T00:00:00Z", "change_amount": 1, "new_balance": 1},
+        {"api_id": 7, "name": "Shop A", "timestamp": "2026-01-02T00:01:00Z", "change_amount": 1, "new_balance": 2},
+    ],
+}
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_read_v3_json(app, indent):
+    raw = json.dumps(V3, indent=indent, ensure_ascii=False).encode("utf-8")
+    assert app.read_backup_file(io.BytesIO(raw)) == V3
+    assert app.read_backup_file(io.BytesIO(gzip.compress(raw))) == V3
+
+
+def test_read_v3_rejects_non_object(app):
+    with pytest.raises(ValueError):
+        app.read_backup_file(io.BytesIO(b"[1, 2]"))
+
+
+def test_read_v4_ndjson(seeded):
+    app = seeded
+    raw = _download(app)
+    payload = app.read_backup_file(io.BytesIO(raw))
+    assert payload["version"] == app.BACKUP_VERSION and payload["rollup_tz"] == "vn"
+    assert payload["backup"]["kind"] == "full" and payload["backup"]["watermark"] == 30
+    assert [b["bot_name"] for b in payload["bots"]] == ["Bot"]
+    assert [a["name"] for a in payload["apis"]] == ["Shop A"]
+    assert len(payload["history"]) == 30 and len(payload["alert_rules"]) == 1
+    assert payload["rollups"]["day"]
+    # Cùng nội dung không nén cũng đọc được
+    assert app.read_backup_file(io.BytesIO(gzip.decompress(raw))) == payload
+
+
+def test_v3_restore_into_empty_db(app):
+    stats = app.import_backup_data(json.loads(json.dumps(V3)), atomic=True)
+    assert (stats["bots"], stats["apis"], stats["history"]) == (1, 1, 2)
+    assert app.get_settings()["default_chat_id"] == "100"
+    assert _counts(app)["balance_history"] == 2
+
+
+def test_restoring_the_same_file_twice_adds_nothing(seeded, fresh_db):
+    app = seeded
+    raw = _download(app)
+    expected = _counts(app)
+    fresh_db()
+    first = app.import_backup_data(app.read_backup_file(io.BytesIO(raw)), atomic=True)
+    assert first["history"] == 30 and _counts(app) == expected
+    second = app.import_backup_data(app.read_backup_file(io.BytesIO(raw)), atomic=True)
+    assert second["already_applied"] == 1 and _counts(app) == expected
+
+
+def test_restoring_a_legacy_file_twice_skips_existing_rows(app):
+    app.import_backup_data(json.loads(json.dumps(V3)))
+    expected = _counts(app)
+    stats = app.import_backup_data(json.loads(json.dumps(V3)))
+    assert (stats["apis"], stats["history"], stats["duplicates"]) == (0, 0, 2)
+    assert _counts(app) == expected
+
+
+def test_diff_chains_from_last_full_backup(seeded):
+    app = seeded
+    _download(app)
+    full = app.get_last_backup("full")
+    _add_history(app, 1, 30, 5)
+    first = app.read_backup_file(io.BytesIO(_download(app, app.get_last_backup("full"))))
+    _add_history(app, 1, 35, 5)
+    # Bản thay đổi trước có thể đã bị bỏ: mặc định vẫn tính từ backup toàn bộ
+    second = app.read_backup_file(io.BytesIO(_download(app, app.get_last_backup("full"))))
+    assert first["backup"]["parent_id"] == second["backup"]["parent_id"] == full["backup_id"]
+    assert (len(first["history"]), len(second["history"])) == (5, 10)
+    since = app.read_backup_file(io.BytesIO(_download(app, app.get_backup(first["backup"]["backup_id"]))))
+    assert since["backup"]["parent_id"] == first["backup"]["backup_id"] and len(since["history"]) == 5
+
+
+def test_diff_without_parent_is_refused_in_atomic_mode(seeded, fresh_db):
+    app = seeded
+    _download(app)
+    _add_history(app, 1, 30, 5)
+    diff = _download(app, app.get_last_backup("full"))
+    fresh_db()
+    with pytest.raises(ValueError):
+        app.import_backup_data(app.read_backup_file(io.BytesIO(diff)), atomic=True)
+    assert _counts(app)["balance_history"] == 0
+    stats = app.import_backup_data(app.read_backup_file(io.BytesIO(diff)))
+    assert stats["missing_parent"] == 1 and stats["history"] == 5
+
+
+def _v3_with_bad_history():
+    payload = json.loads(json.dumps(V3))
+    payload["history"].append({"api_id": 7, "name": "Shop A", "timestamp": "2026-01-02T00:02:00Z",
+                               "change_amount": "abc", "new_balance": 3})
+    return payload
+
+
+def test_atomic_restore_rolls_back_on_bad_row(app):
+    with pytest.raises(ValueError):
+        app.import_backup_data(_v3_with_bad_history(), atomic=True)
+    assert _counts(app) == dict.fromkeys(_counts(app), 0)
+    assert app.get_settings().get("default_chat_id") == ""
+
+
+def test_tolerant_restore_skips_bad_row_and_continues(app):
+    stats = app.import_backup_data(_v3_with_bad_history())
+    assert (stats["skipped"], stats["apis"], stats["history"]) == (1, 1, 2)
+    assert _counts(app)["balance_history"] == 2
+
+
+def test_restore_remaps_api_ids_and_folds_rollups(app):
+    app.add_api_db("Other", "http://other.test", "")
+    payload = json.loads(json.dumps(V3))
+    payload["alert_rules"] = [{"name": "low", "api_id": 7, "threshold": 1}]
+    app.import_backup_data(payload, atomic=True)
+    with app.db.read() as c:
+        new_id = c.execute("SELECT id FROM apis WHERE name='Shop A'").fetchone()[0]
+        assert new_id != 7
+        assert {r[0] for r in c.execute("SELECT api_id FROM balance_history")} == {new_id}
+        assert [r[0] for r in c.execute("SELECT api_id FROM alert_rules")] == [new_id]
+        day = c.execute("SELECT api_id, count, close_balance FROM balance_rollup_daily").fetchall()
+    assert [tuple(r) for r in day] == [(new_id, 2, 2.0)]
+
+
+def test_startup_restore_is_tolerant_and_reports_problems(app, tmp_path):
+    path = tmp_path / "backup.json"
+    path.write_text(json.dumps(_v3_with_bad_history()), encoding="utf-8")
+    problem = app.restore_secret_backup(str(path))
+    assert "bỏ qua 1 dòng lỗi" in problem
+    assert _counts(app)["balance_history"] == 2
+    assert app.get_setting_fresh(app.STARTUP_RESTORE_KEY) == problem
+    client = app.app.test_client()
+    assert client.get("/health").get_json()["startup_restore_ok"] is False
+
+
+def test_atomic_startup_restore_failure_is_recorded(app, tmp_path):
+    path = tmp_path / "backup.json"
+    path.write_text(json.dumps(_v3_with_bad_history()), encoding="utf-8")
+    problem = app.restore_secret_backup(str(path), atomic=True)
+    assert problem.startswith("Khôi phục Secret Backup thất bại")
+    assert _counts(app)["apis"] == 0
+    path.write_text(json.dumps(V3), encoding="utf-8")
+    assert app.restore_secret_backup(str(path), atomic=True) is None
+    assert app.get_setting_fresh(app.STARTUP_RESTORE_KEY) == ""
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+
+class FakeResponse:
+    """Đủ cho stream_balance: headers + iter_content theo từng chunk"""
+
+    def __init__(self, body: bytes, chunk: int = 7):
+        self.headers = {}
+        self.body = body
+        self.chunk = chunk
+        self.read = 0
+
+    def iter_content(self, size):
+        for i in range(0, len(self.body), self.chunk):
+            self.read = i + self.chunk
+            yield self.body[i:i + self.chunk]
+
+
+def test_resolve_balance_prefers_learned_path(app):
+    data = {"balance": 1, "data": {"wallet": {"amount": "1,234.5"}}}
+    assert app.resolve_balance(data, "", "data.wallet.amount") == (1234.5, "data.wallet.amount")
+
+
+def test_resolve_balance_uses_configured_field_then_candidates(app):
+    assert app.resolve_balance({"x": {"y": 7}, "balance": 1}, "x.y") == (7.0, "x.y")
+    assert app.resolve_balance({"data": {"sodu": "50000"}}, "") == (50000.0, "data.sodu")
+
+
+def test_resolve_balance_falls_back_when_learned_path_stops_matching(app):
+    data = {"result": {"balance": 42}}
+    assert app.resolve_balance(data, "", "data.balance") == (42.0, "result.balance")
+
+
+def test_resolve_balance_searches_nested_lists(app):
+    value, path = app.resolve_balance({"items": [{"id": 1}, {"balance": "9"}]}, "")
+    assert value == 9.0
+    assert path == "items.1.balance"
+    assert app.resolve_balance({"status": "ok"}, "") == (None, None)
+
+
+def test_scanner_finds_value_across_chunks(app):
+    doc = json.dumps({"meta": {"balance": "skip"}, "data": {"list": [1, 2], "balance": 12345.5}, "tail": "x" * 50})
+    scanner = app.JsonPathScanner("data.balance")
+    found, value = False, None
+    for i in range(0, len(doc), 3):
+        found, value = scanner.feed(doc[i:i + 3])
+        if found:
+            break
+    assert found and value == 12345.5
+    assert i < len(doc) - 50
+
+
+def test_scanner_matches_array_indexes(app):
+    scanner = app.JsonPathScanner("rows.1.v")
+    assert scanner.feed('{"rows": [{"v": 1}, {"v": 2}]}', final=True) == (True, 2)
+
+
+def test_scanner_rejects_broken_json(app):
+    scanner = app.JsonPathScanner("a")
+    with pytest.raises(ValueError):
+        scanner.feed('{"a" 1}', final=True)
+
+
+def test_stream_balance_stops_early(app):
+    body = json.dumps({"balance": 100, "pad": "x" * 500}).encode()
+    resp = FakeResponse(body)
+    out = app.stream_balance(resp, "balance", 10_000)
+    assert out["found"] and out["value"] == 100
+    assert resp.read < len(body)
+
+
+def test_stream_balance_reads_full_body_on_null_value(app):
+    body = json.dumps({"balance": None, "data": {"balance": 5}}).encode()
+    out = app.stream_balance(FakeResponse(body), "balance", 10_000)
+    assert out == {"found": False, "body": body}
+    assert app.resolve_balance(json.loads(out["body"]), "", "balance") == (5.0, "data.balance")
+
+
+def test_stream_balance_enforces_size_cap(app):
+    body = json.dumps({"pad": "x" * 500, "balance": 1}).encode()
+    with pytest.raises(app.ResponseTooLarge):
+        app.stream_balance(FakeResponse(body), "balance", 100)
@@ -0,0 +1,73 @@
+import threading
+import time
+
+
+def _bots(app, *tokens):
+    for i, token in enumerate(tokens):
+        app.add_bot_db(f"Bot {i}", token)
+
+
+def test_least_loaded_picks_idle_bot(app):
+    _bots(app, "t1", "t2")
+    pool = app.BotPool("least_loaded")
+    first, _ = pool.acquire("c1")
+    second, _ = pool.acquire("c2")
+    assert {first, second} == {"t1", "t2"}
+    pool.release(first, "c1", "ok", None)
+    third, _ = pool.acquire("c3")
+    assert third == first
+
+
+def test_round_robin_rotates(app):
+    _bots(app, "t1", "t2")
+    pool = app.BotPool("round_robin")
+    picked = []
+    for i in range(4):
+        token, _ = pool.acquire(f"c{i}")
+        pool.release(token, f"c{i}", "ok", None)
+        picked.append(token)
+    assert picked == ["t1", "t2", "t1", "t2"]
+
+
+def test_per_chat_quota_spills_to_other_bot_then_waits(app):
+    _bots(app, "t1", "t2")
+    pool = app.BotPool("least_loaded")
+    assert {pool.acquire("c1")[0], pool.acquire("c1")[0]} == {"t1", "t2"}
+    token, wait = pool.acquire("c1")
+    assert token is None and 0 < wait <= 1 / app.TELEGRAM_CHAT_RATE
+    # Chat khác không bị ảnh hưởng
+    assert pool.acquire("c2")[0] is not None
+
+
+def test_revoked_bot_leaves_the_pool(app):
+    _bots(app, "t1", "t2")
+    pool = app.BotPool("least_loaded")
+    token, _ = pool.acquire("c1")
+    pool.release(token, "c1", "revoked", "401")
+    other = ({"t1", "t2"} - {token}).pop()
+    assert pool.acquire("c2")[0] == other
+    assert pool.acquire("c3", token) == (None, -1.0)
+
+
+def test_out_of_quota_message_is_deferred_not_failed(app, monkeypatch):
+    pool = app.BotPool("least_loaded")
+    monkeypatch.setattr(app, "bot_pool", pool)
+    monkeypatch.setattr(app, "deliver_telegram", lambda *a: ("ok", None, None))
+    assert pool.acquire("100", "tok")[0] == "tok"
+    rows = app.outbox_rows(["tok"], "100", "hello", "manual", {}, "k")
+    with app.db.write() as c:
+        app._insert_notifications(c, rows)
+    (job,) = app.coalesce_notifications(app.claim_notifications(app.WATCHER_ID, 10))
+
+    started = time.time()
+    dispatcher = app.NotificationDispatcher(1)
+    threading.Thread(target=dispatcher._run, daemon=True).start()
+    dispatcher.jobs.put(job)
+    dispatcher.jobs.join()
+    dispatcher._write_results()
+
+    assert dispatcher.quota_deferred == 1 and dispatcher.failed == 0
+    with app.db.read() as c:
+        row = c.execute("SELECT * FROM notification_outbox").fetchone()
+    assert (row["status"], row["attempts"], row["claimed_by"]) == ("pending", 0, None)
+    assert started < row["next_attempt_at"] <= time.time() + 1 / app.TELEGRAM_CHAT_RATE
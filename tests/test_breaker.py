@@ -0,0 +1,62 @@
+import json
+
+import requests
+
+
+def test_opens_after_threshold_and_waits_for_cooldown(app):
+    br = app.CircuitBreaker(3)
+    for _ in range(2):
+        br.record_failure(0.0)
+    assert br.state == "closed" and br.allow(0.0)
+    br.record_failure(10.0)
+    assert br.state == "open"
+    assert not br.allow(10.0 + app.BREAKER_COOLDOWN - 1)
+    assert br.allow(10.0 + app.BREAKER_COOLDOWN)
+    assert br.state == "half_open"
+
+
+def test_half_open_grants_a_single_probe(app):
+    br = app.CircuitBreaker(1)
+    br.record_failure(0.0)
+    t = app.BREAKER_COOLDOWN
+    assert br.allow(t)
+    assert not br.allow(t + 1)
+    br.record_success()
+    assert br.state == "closed" and br.failures == 0 and br.allow(t + 2)
+
+
+def test_failed_probe_doubles_cooldown(app):
+    br = app.CircuitBreaker(1)
+    br.record_failure(0.0)
+    t = app.BREAKER_COOLDOWN
+    assert br.allow(t)
+    br.record_failure(t)
+    assert br.state == "open"
+    assert br.cooldown == min(app.BREAKER_COOLDOWN * 2, app.BREAKER_COOLDOWN_MAX)
+    assert not br.allow(t + app.BREAKER_COOLDOWN)
+    assert br.allow(t + br.cooldown)
+
+
+def test_released_probe_can_be_retried(app):
+    br = app.CircuitBreaker(1)
+    br.record_failure(0.0)
+    t = app.BREAKER_COOLDOWN
+    assert br.allow(t)
+    br.release()
+    assert br.allow(t + 1)
+
+
+def test_lost_probe_is_regranted_after_timeout(app):
+    br = app.CircuitBreaker(1)
+    br.record_failure(0.0)
+    t = app.BREAKER_COOLDOWN
+    assert br.allow(t)
+    assert not br.allow(t + app.BREAKER_PROBE_TIMEOUT - 1)
+    assert br.allow(t + app.BREAKER_PROBE_TIMEOUT)
+
+
+def test_classify_fetch_error(app):
+    assert app.classify_fetch_error(json.JSONDecodeError("bad", "<html>", 0)) == "json"
+    assert app.classify_fetch_error(requests.exceptions.InvalidURL("bad url")) == "conn"
+    assert app.classify_fetch_error(requests.exceptions.ConnectionError("down")) == "conn"
+    assert app.classify_fetch_error(requests.Timeout()) == "timeout"
@@ -0,0 +1,63 @@
+import sqlite3
+
+
+def test_repeated_reads_hit_the_cache(app):
+    app.add_api_db("Shop A", "http://shop-a.test", "")
+    first = app.get_apis()
+    misses = app.catalog_cache.misses
+    for _ in range(5):
+        assert app.get_apis() == first
+    assert app.catalog_cache.misses == misses
+
+
+def test_write_helpers_invalidate_only_their_table(app):
+    app.get_apis()
+    app.get_settings()
+    misses = app.catalog_cache.misses
+    app.set_setting("poll_interval", "45")
+    assert app.get_settings()["poll_interval"] == "45"
+    app.get_apis()
+    assert app.catalog_cache.misses == misses + 1
+
+
+def test_write_from_another_connection_is_seen(app):
+    assert app.get_bots() == []
+    # Giống process khác ghi vào cùng file DB
+    other = sqlite3.connect(app.db.path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    other.execute("INSERT INTO telegram_bots (bot_name, bot_token) VALUES ('Bot', '123:abc')")
+    app._bump_version(other, "bots")
+    other.execute("COMMIT")
+    other.close()
+    assert [b["bot_name"] for b in app.get_bots()] == ["Bot"]
+
+
+def test_failure_only_flush_keeps_apis_cached(app):
+    api_id = app.add_api_db("Shop A", "http://shop-a.test", "")
+    app.get_apis()
+    misses = app.catalog_cache.misses
+    buf = app.write_buffer
+    buf.add_failure(api_id, "timeout", "timed out", "2026-01-02T00:00:00Z", "closed")
+    buf.set_breaker_state(api_id, "open")
+    assert buf.flush(force=True)
+    app.get_apis()
+    assert app.catalog_cache.misses == misses
+    # Cột lỗi vẫn đọc được qua get_api_health (không qua cache)
+    health = app.get_api_health()[api_id]
+    assert (health["err_timeout"], health["breaker_state"]) == (1, "open")
+    assert buf.known_breaker_state(api_id, "closed") == "open"
+
+
+def test_balance_flush_reloads_apis(app):
+    api_id = app.add_api_db("Shop A", "http://shop-a.test", "")
+    app.get_apis()
+    app.write_buffer.set_state(api_id, 10.0, "2026-01-02T00:00:00Z")
+    app.write_buffer.flush(force=True)
+    assert app.get_apis()[0]["last_balance"] == 10.0
+
+
+def test_rule_set_is_shared_and_immutable(app):
+    app.add_alert_rule_db({"name": "r", "threshold": 5})
+    rule_set = app.get_rule_set()
+    assert app.get_rule_set() is rule_set
+    assert isinstance(rule_set.rules_for({"id": 1, "api_group": ""}), tuple)
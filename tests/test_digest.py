@@ -0,0 +1,55 @@
+import json
+
+
+def _row(nid, api_id, diff, new_balance, kind="change", chat_id="100", token="tok", attempts=1, name=None):
+    payload = {"api_id": api_id, "api_name": name or f"API {api_id}", "diff": diff, "new_balance": new_balance,
+               "at": f"2026-01-02T03:{nid % 60:02d}:00Z"}
+    return {"id": nid, "kind": kind, "chat_id": chat_id, "bot_token": token, "text": f"tin {nid}",
+            "payload": json.dumps(payload), "attempts": attempts, "created_at": 1000.0 + nid}
+
+
+def test_render_digest_sums_changes_per_api(app):
+    rows = [_row(1, 7, 100, 1100), _row(2, 7, -30, 1070), _row(3, 8, 5, 55)]
+    (text,) = app.render_digest(rows)
+    assert "(3 thay đổi, 2 API)" in text
+    assert f"<b>API 7</b>: +{app.fmt_amount(70)} (2 lần) → <b>{app.fmt_amount(1070)}</b>" in text
+    assert f"<b>API 8</b>: +{app.fmt_amount(5)} (1 lần)" in text
+
+
+def test_render_digest_splits_long_messages(app):
+    rows = [_row(i, i, 1, i, name="x" * 200) for i in range(1, 101)]
+    parts = app.render_digest(rows)
+    assert len(parts) > 1
+    assert all(len(p) <= app.TELEGRAM_MAX_CHARS for p in parts)
+    assert parts[0].split("\n", 1)[0].endswith(f"(1/{len(parts)})")
+    assert sum(p.count("• ") for p in parts) == 100
+
+
+def test_digest_parts_track_row_ids(app):
+    rows = [_row(i, i % 30, 1, i, name="y" * 200) for i in range(1, 121)]
+    parts = app._digest_parts(rows)
+    ids = [nid for _, part_ids in parts for nid in part_ids]
+    assert sorted(ids) == list(range(1, 121))
+    # Mọi dòng của 1 API nằm trọn trong 1 phần
+    for _, part_ids in parts:
+        apis = {i % 30 for i in part_ids}
+        assert all(i in part_ids for i in range(1, 121) if i % 30 in apis)
+
+
+def test_coalesce_groups_changes_by_chat_and_bot(app):
+    rows = [
+        _row(1, 1, 10, 10),
+        _row(2, 2, 20, 20, attempts=3),
+        _row(3, 1, 5, 15, chat_id="200"),
+        _row(4, 1, 1, 16, token="tok2"),
+        _row(5, 1, 0, 16, kind="threshold"),
+    ]
+    jobs = app.coalesce_notifications(rows)
+    by_ids = {tuple(r["id"] for r in job["rows"]): job for job in jobs}
+    assert set(by_ids) == {(1, 2), (3,), (4,), (5,)}
+    digest = by_ids[(1, 2)]
+    assert digest["attempts"] == 3 and digest["created_at"] == 1001.0
+    assert digest["part_ids"] == [[1, 2]]
+    assert "TỔNG HỢP BIẾN ĐỘNG" in digest["parts"][0]
+    # 1 dòng đơn lẻ giữ nguyên nội dung gốc
+    assert by_ids[(3,)]["parts"] == ["tin 3"] and by_ids[(5,)]["part_ids"] == [[5]]
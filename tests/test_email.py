@@ -0,0 +1,115 @@
+import smtplib
+import threading
+import time
+
+CONFIG = ("smtp.test", 587, "me@test", "secret")
+
+
+class FakeSMTP:
+    """smtplib.SMTP giả: ghi lại kết nối / tin đã gửi, có thể ngắt kết nối ở lần gửi kế tiếp"""
+
+    instances = []
+
+    def __init__(self, host, port, timeout=None):
+        self.host, self.port = host, port
+        self.sent = []
+        self.disconnect_next = False
+        self.fail_with = None
+        FakeSMTP.instances.append(self)
+
+    def starttls(self, context=None):
+        pass
+
+    def login(self, user, password):
+        self.user = user
+
+    def send_message(self, msg):
+        if self.disconnect_next:
+            self.disconnect_next = False
+            raise smtplib.SMTPServerDisconnected("gone")
+        if self.fail_with:
+            raise self.fail_with
+        self.sent.append(msg["To"])
+
+    def quit(self):
+        pass
+
+
+def _patch_smtp(monkeypatch):
+    FakeSMTP.instances = []
+    monkeypatch.setattr(smtplib, "SMTP", FakeSMTP)
+
+
+def _job(to="a@test"):
+    return {"subject": "s", "to_email": to, "html": "<b>x</b>"}
+
+
+def _configure(app):
+    for key, value in zip(("smtp_server", "smtp_port", "smtp_user", "smtp_pass"), CONFIG):
+        app.set_setting(key, str(value))
+
+
+def test_connection_is_reused_until_config_changes(app, monkeypatch):
+    _patch_smtp(monkeypatch)
+    d = app.EmailDispatcher()
+    d._deliver(CONFIG, _job("a@test"))
+    d._deliver(CONFIG, _job("b@test"))
+    assert len(FakeSMTP.instances) == 1 and FakeSMTP.instances[0].sent == ["a@test", "b@test"]
+    d._deliver(("smtp2.test",) + CONFIG[1:], _job("c@test"))
+    assert len(FakeSMTP.instances) == 2 and d.connects == 2
+
+
+def test_reconnects_once_when_server_dropped_connection(app, monkeypatch):
+    _patch_smtp(monkeypatch)
+    d = app.EmailDispatcher()
+    d._deliver(CONFIG, _job("a@test"))
+    FakeSMTP.instances[0].disconnect_next = True
+    d._deliver(CONFIG, _job("b@test"))
+    assert [s.sent for s in FakeSMTP.instances] == [["a@test"], ["b@test"]]
+
+
+def test_send_email_validates_config_and_queues(app):
+    assert app.send_email("a@test", "s", "x") == "Thiếu thông tin cấu hình SMTP."
+    assert app.email_counts() == {}
+    _configure(app)
+    assert app.send_email("a@test", "s", "x") is None
+    assert app.email_counts() == {"pending": 1}
+
+
+def test_claim_email_is_exclusive_until_ttl(app):
+    app.enqueue_email_db("a@test", "s", "x")
+    now = time.time() + 1
+    job = app.claim_email(now)
+    assert job["attempts"] == 1
+    assert app.claim_email(now + 1) is None
+    again = app.claim_email(now + app.EMAIL_CLAIM_TTL + 1)
+    assert again["id"] == job["id"] and again["attempts"] == 2
+    app.complete_email(job["id"], "sent", now, None)
+    assert app.email_counts() == {"sent": 1}
+
+
+def test_failed_send_is_rescheduled_without_blocking(app, monkeypatch):
+    _patch_smtp(monkeypatch)
+    _configure(app)
+    monkeypatch.setattr(app, "watcher_is_leader", True)
+    real_init = FakeSMTP.__init__
+
+    def failing_init(self, *args, **kwargs):
+        real_init(self, *args, **kwargs)
+        self.fail_with = smtplib.SMTPDataError(451, "try later")
+
+    monkeypatch.setattr(FakeSMTP, "__init__", failing_init)
+    app.enqueue_email_db("a@test", "s", "x")
+    d = app.EmailDispatcher()
+    started = time.time()
+    threading.Thread(target=d._run, daemon=True).start()
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        with app.db.read() as c:
+            row = dict(c.execute("SELECT * FROM email_outbox").fetchone())
+        if row["status"] == "pending" and row["attempts"] == 1 and row["last_error"]:
+            break
+        time.sleep(0.02)
+    assert (row["status"], row["attempts"]) == ("pending", 1)
+    assert row["next_attempt_at"] > started + app.NOTIFY_RETRY_BASE
+    assert d.server is None and d.failed == 0
@@ -0,0 +1,55 @@
+def _seed(app, n=25):
+    a = app.add_api_db("Shop A", "http://shop-a.test", "")
+    b = app.add_api_db("Shop B", "http://shop-b.test", "")
+    rows = []
+    for i in range(n):
+        api_id = a if i % 2 == 0 else b
+        amount = 1.0 if i % 3 else -1.0
+        rows.append((api_id, "x", f"2026-01-{1 + i // 24:02d}T{i % 24:02d}:00:00Z", amount, float(i)))
+    with app.db.write() as c:
+        c.executemany(
+            "INSERT INTO balance_history (api_id, name, timestamp, change_amount, new_balance) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        app._fold_into_rollups(c, rows)
+    return a, b
+
+
+def _all_pages(fetch):
+    out, cursor = [], None
+    while True:
+        rows, cursor = fetch(cursor)
+        out.extend(rows)
+        if cursor is None:
+            return out
+
+
+def test_history_pages_cover_every_row_once(app):
+    _seed(app)
+    rows = _all_pages(lambda cur: app.query_balance_history(before_id=cur, limit=7))
+    ids = [r["id"] for r in rows]
+    assert ids == sorted(ids, reverse=True) and len(ids) == 25
+
+
+def test_history_filters(app):
+    a, _ = _seed(app)
+    rows, _ = app.query_balance_history(api_id=a, direction="out", limit=100)
+    assert rows and all(r["api_id"] == a and r["change_amount"] < 0 for r in rows)
+    rows, _ = app.query_balance_history(since="2026-01-01T10:00:00", until="2026-01-01T12:00:00", limit=100)
+    assert sorted(r["timestamp"] for r in rows) == ["2026-01-01T10:00:00Z", "2026-01-01T11:00:00Z"]
+
+
+def test_history_limit_is_capped(app):
+    _seed(app)
+    rows, cursor = app.query_balance_history(limit=0)
+    assert len(rows) == 1 and cursor == rows[0]["id"]
+
+
+def test_rollup_pages_follow_period_and_api(app):
+    _seed(app)
+    rows = _all_pages(lambda cur: app.query_balance_rollups("hour", before=cur, limit=4))
+    keys = [(r["period"], r["api_id"]) for r in rows]
+    assert keys == sorted(keys, reverse=True) and len(set(keys)) == len(keys) == 25
+    assert all(r["name"] in ("Shop A", "Shop B") for r in rows)
+    day, _ = app.query_balance_rollups("day", limit=100)
+    assert sum(r["count"] for r in day) == 25
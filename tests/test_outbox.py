@@ -0,0 +1,115 @@
+import threading
+import time
+
+
+def _enqueue(app, text, kind="manual", chat_id="100", tokens=("tok",), key=None, delay=0.0, payload=None):
+    rows = app.outbox_rows(list(tokens), chat_id, text, kind, payload or {}, key or f"{kind}:{text}", delay)
+    with app.db.write() as c:
+        app._insert_notifications(c, rows)
+
+
+def _status(app):
+    with app.db.read() as c:
+        return {r["text"]: (r["status"], r["attempts"]) for r in c.execute("SELECT * FROM notification_outbox")}
+
+
+def test_same_key_is_enqueued_once(app):
+    _enqueue(app, "a", key="k")
+    _enqueue(app, "a", key="k")
+    _enqueue(app, "b", tokens=("t1", "t2"))
+    with app.db.read() as c:
+        assert c.execute("SELECT COUNT(*) FROM notification_outbox").fetchone()[0] == 3
+
+
+def test_claim_is_exclusive_until_ttl(app):
+    _enqueue(app, "a")
+    now = 1e12
+    rows = app.claim_notifications("A", 10, now=now)
+    assert [r["text"] for r in rows] == ["a"] and rows[0]["attempts"] == 1
+    assert app.claim_notifications("B", 10, now=now + 1) == []
+    again = app.claim_notifications("B", 10, now=now + app.NOTIFY_CLAIM_TTL + 1)
+    assert [r["id"] for r in again] == [rows[0]["id"]]
+    assert again[0]["attempts"] == 2
+
+
+def test_complete_ignores_rows_reclaimed_by_another_owner(app):
+    _enqueue(app, "a")
+    now = 1e12
+    nid = app.claim_notifications("A", 10, now=now)[0]["id"]
+    app.claim_notifications("B", 10, now=now + app.NOTIFY_CLAIM_TTL + 1)
+    app.complete_notifications("A", [(nid, "failed", now, "late", None)])
+    assert _status(app)["a"][0] == "sending"
+    app.complete_notifications("B", [(nid, "sent", now, None, "2026-01-01T00:00:00Z")])
+    assert _status(app)["a"][0] == "sent"
+    assert app.claim_notifications("C", 10, now=now + 10 * app.NOTIFY_CLAIM_TTL) == []
+
+
+def test_extend_claim_fails_once_reclaimed(app):
+    _enqueue(app, "a")
+    _enqueue(app, "b")
+    now = 1e12
+    ids = [r["id"] for r in app.claim_notifications("A", 10, now=now)]
+    assert app.extend_claim("A", ids, now=now + app.NOTIFY_CLAIM_TTL - 1)
+    # Gia hạn xong: process khác chưa lấy lại được
+    assert app.claim_notifications("B", 10, now=now + app.NOTIFY_CLAIM_TTL + 1) == []
+    later = now + 3 * app.NOTIFY_CLAIM_TTL
+    assert app.claim_notifications("B", 1, now=later)
+    assert not app.extend_claim("A", ids, now=later)
+    assert app.extend_claim("A", [], now=later)
+
+
+def test_retry_waits_for_next_attempt(app):
+    _enqueue(app, "a")
+    now = 1e12
+    nid = app.claim_notifications("A", 10, now=now)[0]["id"]
+    app.complete_notifications("A", [(nid, "pending", now + 30, "HTTP 500", None)])
+    assert app.claim_notifications("A", 10, now=now + 29) == []
+    assert [r["id"] for r in app.claim_notifications("A", 10, now=now + 30)] == [nid]
+
+
+def test_due_change_pulls_in_pending_changes_of_same_chat(app):
+    # outbox_rows hẹn giờ theo time.time(): claim ngay lúc này để tin hoãn 1 giờ chưa đến hạn
+    now = time.time() + 1
+    _enqueue(app, "c1", kind="change")
+    _enqueue(app, "c2", kind="change", delay=3600)
+    _enqueue(app, "other chat", kind="change", chat_id="200", delay=3600)
+    rows = app.claim_notifications("A", 10, now=now)
+    assert sorted(r["text"] for r in rows) == ["c1", "c2"]
+    assert _status(app)["other chat"] == ("pending", 0)
+
+
+def test_parts_sent_before_losing_the_claim_are_marked_sent(app, monkeypatch):
+    for i in range(60):
+        payload = {"api_id": i, "api_name": "x" * 200, "diff": 1, "new_balance": i}
+        _enqueue(app, f"c{i}", kind="change", payload=payload)
+    rows = app.claim_notifications(app.WATCHER_ID, 100)
+    (job,) = app.coalesce_notifications(rows)
+    assert len(job["parts"]) > 1
+    first_ids, rest_ids = job["part_ids"][0], [nid for ids in job["part_ids"][1:] for nid in ids]
+
+    sent = []
+    monkeypatch.setattr(app, "deliver_telegram", lambda token, chat_id, text: sent.append(text) or ("ok", None, None))
+    monkeypatch.setattr(app, "bot_pool", app.BotPool("least_loaded"))
+    real_extend = app.extend_claim
+    calls = []
+
+    def extend_then_lose(owner, ids, now=None):
+        calls.append(1)
+        if len(calls) == 2:
+            # Process khác nhận lại phần chưa gửi ngay sau khi phần đầu đã gửi xong
+            with app.db.write() as c:
+                c.executemany("UPDATE notification_outbox SET claimed_by='other' WHERE id=?", [(n,) for n in rest_ids])
+        return real_extend(owner, ids, now)
+
+    monkeypatch.setattr(app, "extend_claim", extend_then_lose)
+    dispatcher = app.NotificationDispatcher(1)
+    threading.Thread(target=dispatcher._run, daemon=True).start()
+    dispatcher.jobs.put(job)
+    dispatcher.jobs.join()
+    dispatcher._write_results()
+
+    assert sent == job["parts"][:1]
+    with app.db.read() as c:
+        status = {r["id"]: (r["status"], r["claimed_by"]) for r in c.execute("SELECT * FROM notification_outbox")}
+    assert all(status[n] == ("sent", None) for n in first_ids)
+    assert all(status[n] == ("sending", "other") for n in rest_ids)
@@ -0,0 +1,75 @@
+from datetime import datetime
+
+
+def _insert(app, rows):
+    with app.db.write() as c:
+        c.executemany(
+            "INSERT INTO balance_history (api_id, name, timestamp, change_amount, new_balance) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        app._fold_into_rollups(c, rows)
+
+
+def _rollups(app, granularity):
+    table = app.ROLLUP_TABLES[granularity][0]
+    with app.db.read() as c:
+        return {r["period"]: dict(r) for r in c.execute(f"SELECT * FROM {table} ORDER BY period")}
+
+
+def test_vn_period(app):
+    assert app.vn_period("2026-01-01T18:30:00Z", 13) == "2026-01-02T01"
+    assert app.vn_period("2026-01-01T16:59:59.5Z", 10) == "2026-01-01"
+    assert app.vn_period("2026-01-01T17:00:00Z", 10) == "2026-01-02"
+
+
+def test_rollups_split_on_vn_midnight(app):
+    a = app.add_api_db("Shop A", "http://shop-a.test", "")
+    _insert(app, [
+        (a, "x", "2026-01-01T16:30:00Z", 10.0, 110.0),
+        (a, "x", "2026-01-01T16:45:00Z", -30.0, 80.0),
+        (a, "x", "2026-01-01T17:10:00Z", 5.0, 85.0),
+    ])
+    day = _rollups(app, "day")
+    assert set(day) == {"2026-01-01", "2026-01-02"}
+    first = day["2026-01-01"]
+    assert (first["count"], first["sum_in"], first["sum_out"]) == (2, 10.0, 30.0)
+    assert (first["min_balance"], first["max_balance"], first["close_balance"]) == (80.0, 110.0, 80.0)
+    assert set(_rollups(app, "hour")) == {"2026-01-01T23", "2026-01-02T00"}
+
+
+def test_late_row_does_not_move_close_balance(app):
+    a = app.add_api_db("Shop A", "http://shop-a.test", "")
+    _insert(app, [(a, "x", "2026-01-01T03:10:00Z", 5.0, 50.0)])
+    _insert(app, [(a, "x", "2026-01-01T03:05:00Z", 5.0, 45.0)])
+    (hour,) = _rollups(app, "hour").values()
+    assert (hour["count"], hour["close_balance"], hour["close_ts"]) == (2, 50.0, "2026-01-01T03:10:00Z")
+
+
+def test_legacy_utc_rollups_are_migrated(app):
+    a = app.add_api_db("Shop A", "http://shop-a.test", "")
+    with app.db.write() as c:
+        c.execute(
+            "INSERT INTO balance_rollup_hourly (api_id, period, count, sum_in, sum_out, min_balance, max_balance, "
+            "close_balance, close_ts) VALUES (?, '2026-01-01T18', 2, 10, 0, 5, 15, 15, '2026-01-01T18:40:00Z')",
+            (a,),
+        )
+        c.execute("UPDATE meta SET value=0 WHERE key='rollup_vn'")
+    app.init_db()
+    assert list(_rollups(app, "hour")) == ["2026-01-02T01"]
+    day = _rollups(app, "day")["2026-01-02"]
+    assert (day["count"], day["close_balance"]) == (2, 15.0)
+
+
+def test_prune_history_deletes_in_batches_and_keeps_rollups(app, monkeypatch):
+    a = app.add_api_db("Shop A", "http://shop-a.test", "")
+    _insert(app, [(a, "x", f"2026-01-01T00:{i:02d}:00Z", 1.0, float(i)) for i in range(10)])
+    _insert(app, [(a, "x", "2026-03-01T00:00:00Z", 1.0, 11.0)])
+    monkeypatch.setattr(app, "RETENTION_DELETE_BATCH", 3)
+    writes = []
+    write = app.db.write
+    monkeypatch.setattr(app.db, "write", lambda: writes.append(1) or write())
+    assert app.prune_history(30, now=datetime(2026, 3, 1)) == 10
+    assert len(writes) == 4
+    with app.db.read() as c:
+        assert c.execute("SELECT COUNT(*) FROM balance_history").fetchone()[0] == 1
+    assert sum(r["count"] for r in _rollups(app, "day").values()) == 11
@@ -0,0 +1,44 @@
+def _result(api, balance):
+    return {"api": api, "data": {"balance": balance}, "balance": None, "unchanged": False,
+            "validators": {"url": api["url"], "etag": None, "last_modified": None, "digest": "d"},
+            "error": None, "error_kind": None, "latency": 0.05}
+
+
+def test_append_and_read(app, tmp_path):
+    store = app.SampleStore(str(tmp_path / "samples"), True)
+    store.append(1, 1_767_225_600.0, 10.0, 0.02, "ok")
+    store.append(1, 1_767_225_660.0, None, 0.5, "timeout")
+    store.flush()
+    rows = store.read(1)
+    assert [(r[1], r[3]) for r in rows] == [(10.0, "ok"), (None, "timeout")]
+    store.close()
+
+
+def test_sample_store_failure_does_not_lose_alerts(app, monkeypatch):
+    def broken_append(*args):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(app.sample_store, "append", broken_append)
+    monkeypatch.setattr(app.sample_store, "errors", 0)
+    monkeypatch.setattr(app, "breakers", app.BreakerBoard())
+    api_id = app.add_api_db("Shop A", "http://shop-a.test", "balance")
+    app.set_setting("default_chat_id", "100")
+    with app.db.write() as c:
+        c.execute("UPDATE apis SET last_balance=100, last_change='2026-01-02T00:00:00Z' WHERE id=?", (api_id,))
+        app._bump_version(c, "apis")
+    api = app.get_apis()[0]
+    scheduler = app.ApiScheduler()
+    scheduler.sync([api], 30, now=0.0)
+    scheduler.pop_due(100.0)
+
+    events = []
+    app.handle_poll_result(_result(api, 40), scheduler, events)
+    assert len(events) == 1 and app.sample_store.errors == 1
+    assert scheduler.entries[api_id]["next_due"] is not None
+
+    app.write_buffer.add_notifications(app.evaluate_alerts(
+        events, app.get_rule_set(), app.default_alert_rule(app.get_settings()), [], ["tok"],
+    ))
+    app.write_buffer.flush(force=True)
+    assert app.outbox_counts() == {"pending": 1}
+    assert app.get_apis()[0]["last_balance"] == 40.0
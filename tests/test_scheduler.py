@@ -0,0 +1,63 @@
+def _apis(*specs):
+    return [{"id": i, "url": f"http://shop{i}.test", "poll_interval": iv} for i, iv in specs]
+
+
+def test_first_sync_spreads_apis_over_one_interval(app):
+    sched = app.ApiScheduler()
+    sched.sync(_apis(*[(i, 60) for i in range(1, 51)]), 30, now=1000.0)
+    dues = [e["next_due"] for e in sched.entries.values()]
+    assert all(1000.0 <= d <= 1060.0 for d in dues)
+    assert len(set(dues)) > 1
+
+
+def test_pop_due_returns_each_api_once(app):
+    sched = app.ApiScheduler()
+    sched.sync(_apis((1, 10), (2, 10)), 30, now=0.0)
+    assert sorted(sched.pop_due(100.0)) == [1, 2]
+    assert sched.pop_due(100.0) == []
+    assert all(e["next_due"] is None for e in sched.entries.values())
+
+
+def test_running_api_is_not_rescheduled(app):
+    sched = app.ApiScheduler()
+    apis = _apis((1, 10), (2, 10))
+    sched.sync(apis, 30, now=0.0)
+    sched.pop_due(100.0)
+    sched.sync(apis, 30, now=100.0, running={1})
+    assert sched.entries[1]["next_due"] is None
+    assert sched.entries[2]["next_due"] == 100.0
+    assert sched.pop_due(100.0) == [2]
+
+
+def test_failures_back_off_exponentially(app, monkeypatch):
+    monkeypatch.setattr(app.random, "uniform", lambda a, b: 0.0)
+    sched = app.ApiScheduler()
+    sched.sync(_apis((1, 10)), 30, now=0.0)
+    sched.pop_due(100.0)
+    delays = []
+    for _ in range(3):
+        sched.reschedule(1, 100.0, ok=False, changed=False)
+        delays.append(sched.entries[1]["next_due"] - 100.0)
+        sched.pop_due(10_000.0)
+    assert delays == [10.0, 20.0, 40.0]
+    sched.reschedule(1, 100.0, ok=True, changed=True)
+    assert sched.entries[1]["next_due"] == 110.0
+
+
+def test_interval_change_pulls_next_due_forward(app):
+    sched = app.ApiScheduler()
+    sched.sync(_apis((1, 600)), 30, now=0.0)
+    sched.entries[1]["next_due"] = 500.0
+    sched._push(1, 500.0)
+    sched.sync(_apis((1, 10)), 30, now=100.0)
+    assert sched.entries[1]["interval"] == 10.0
+    assert sched.entries[1]["next_due"] == 110.0
+    assert sched.pop_due(110.0) == [1]
+
+
+def test_sync_reports_removed_apis(app):
+    sched = app.ApiScheduler()
+    sched.sync(_apis((1, 10), (2, 10)), 30, now=0.0)
+    assert sched.sync(_apis((2, 10)), 30, now=1.0) == [1]
+    assert list(sched.entries) == [2]
+    assert sched.pop_due(10_000.0) == [2]
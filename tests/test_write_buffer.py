@@ -0,0 +1,72 @@
+from datetime import datetime
+
+
+def _api(app, name="Shop A"):
+    return app.add_api_db(name, f"http://{name.replace(' ', '-').lower()}.test", "")
+
+
+def _row(app, api_id):
+    with app.db.read() as c:
+        return dict(c.execute("SELECT * FROM apis WHERE id=?", (api_id,)).fetchone())
+
+
+def test_flush_waits_for_interval_unless_forced(app):
+    buf = app.WriteBuffer(60)
+    assert buf.due() is None and not buf.flush(force=True)
+    buf.set_setting("last_run", "x")
+    assert 0 < buf.due() <= 60
+    assert not buf.flush()
+    assert buf.flush(force=True) and not buf.pending()
+    assert app.get_setting_fresh("last_run") == "x"
+
+
+def test_flush_writes_everything_in_one_pass(app):
+    a, b = _api(app), _api(app, "Shop B")
+    buf = app.write_buffer
+    buf.set_state(a, 20.0, "2026-01-02T00:00:05Z")
+    buf.add_history(a, "Shop A", "2026-01-02T00:00:00Z", 5.0, 15.0)
+    buf.add_history(a, "Shop A", "2026-01-02T00:00:05Z", 5.0, 20.0)
+    buf.set_learned_path(a, "data.balance")
+    buf.add_failure(b, "http", "HTTP 500", "2026-01-02T00:00:05Z", "closed")
+    buf.add_failure(b, "http", "HTTP 502", "2026-01-02T00:00:06Z", "open")
+    assert buf.flush(force=True)
+    row_a, row_b = _row(app, a), _row(app, b)
+    assert (row_a["last_balance"], row_a["learned_path"]) == (20.0, "data.balance")
+    assert (row_b["err_http"], row_b["last_error"], row_b["breaker_state"]) == (2, "HTTP 502", "open")
+    with app.db.read() as c:
+        assert c.execute("SELECT COUNT(*) FROM balance_history").fetchone()[0] == 2
+        assert c.execute("SELECT SUM(count) FROM balance_rollup_hourly").fetchone()[0] == 2
+    # Lỗi được cộng dồn qua các lần flush
+    buf.add_failure(b, "http", "HTTP 503", "2026-01-02T00:01:00Z", "open")
+    buf.flush(force=True)
+    assert _row(app, b)["err_http"] == 3
+
+
+def test_pending_state_overrides_db_until_flushed(app):
+    a = _api(app)
+    buf = app.write_buffer
+    assert buf.pending_balance(a, 5.0) == 5.0
+    buf.set_state(a, 7.0, "t1")
+    assert (buf.pending_balance(a, 5.0), buf.pending_change(a, "t0")) == (7.0, "t1")
+    buf.flush(force=True)
+    assert buf.pending_balance(a, 5.0) == 5.0
+
+
+def test_revert_first_balance_drops_state(app):
+    a = _api(app)
+    buf = app.write_buffer
+    at = datetime(2026, 1, 2, 0, 0, 5)
+    buf.set_state(a, 7.0, at.isoformat() + "Z")
+    buf.add_history(a, "Shop A", at.isoformat() + "Z", 7.0, 7.0)
+    buf.revert_events([{"api": {"id": a}, "old": 0.0, "prev_change": "", "at": at}])
+    assert buf.states == {} and buf.history == []
+
+
+def test_discard_drops_unflushed_rows(app):
+    a = _api(app)
+    buf = app.write_buffer
+    buf.set_state(a, 7.0, "t1")
+    buf.add_history(a, "Shop A", "2026-01-02T00:00:00Z", 7.0, 7.0)
+    assert buf.discard() == 2
+    assert not buf.flush(force=True)
+    assert _row(app, a)["last_balance"] is None